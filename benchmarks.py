@@ -0,0 +1,1182 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+from data_cleaning import DataCleaning, VALID_CARD_PROVIDERS
+from data_extraction import DataExtractor
+from database_utils import DatabaseConnector
+
+
+class StubStoreApiHandler(BaseHTTPRequestHandler):
+    '''
+    This class is a stand-in for the store details API, used so benchmarks can run offline.
+
+    Every GET request to /store_details/{n} returns a JSON record shaped like the real API
+    response after a short delay, which simulates network latency. Each response has an ETag,
+    and a request whose If-None-Match matches it gets an empty 304 response. Adding a store
+    number to changed_stores changes its details and ETag.
+    '''
+    latency = 0.02
+    changed_stores = set()
+    # HTTP/1.1 keeps connections alive, like the real API. Buffering the response sends headers
+    # and body in one packet, avoiding delayed-ACK stalls on kept-alive connections.
+    protocol_version = 'HTTP/1.1'
+    wbufsize = 64 * 1024
+
+    def do_GET(self):
+        store = int(self.path.rstrip('/').split('/')[-1])
+        time.sleep(self.latency)
+        version = 2 if store in self.changed_stores else 1
+        etag = f'"store-{store}-v{version}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        body = json.dumps({'index': store, 'address': f'{store} High Street', 'longitude': '-0.1',
+                           'lat': None, 'locality': 'London', 'store_code': f'ST-{store:05d}',
+                           'staff_numbers': str(25 * version), 'opening_date': '2010-01-01', 'store_type': 'Local',
+                           'latitude': '51.5', 'country_code': 'GB', 'continent': 'Europe'}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Silences the default per-request logging to stderr
+        pass
+
+
+def start_stub_server(handler):
+    '''
+    This function starts a local HTTP server in a background thread.
+
+    Args:
+        handler: the BaseHTTPRequestHandler subclass which serves requests.
+
+    Returns:
+        server: the running server. Its base URL is built from server.server_address.
+    '''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def bench_retrieve_stores_data(num_stores=200, concurrency_levels=(1, 4, 8, 16, 32)):
+    '''
+    This function measures how many stores per second retrieve_stores_data fetches from a
+    local stub API at each concurrency level.
+    '''
+    server = start_stub_server(StubStoreApiHandler)
+    host, port = server.server_address
+    endpoint_base = f'http://{host}:{port}/store_details/'
+    print(f'retrieve_stores_data ({num_stores} stores, {StubStoreApiHandler.latency * 1000:.0f} ms latency)')
+    for max_workers in concurrency_levels:
+        # The store cache is disabled so every store is downloaded
+        extractor = DataExtractor(store_api_options={'cache_dir': None, 'pool_size': max_workers})
+        start = time.perf_counter()
+        extractor.retrieve_stores_data(endpoint_base, {'x-api-key': 'benchmark'}, num_stores, max_workers=max_workers)
+        elapsed = time.perf_counter() - start
+        print(f'  max_workers={max_workers:<3} {num_stores / elapsed:8.1f} stores/s')
+    server.shutdown()
+
+
+def bench_store_api_cache(num_stores=200, changed_fraction=0.05, max_workers=8):
+    '''
+    This function measures how much the StoreApiClient cache saves on a rerun. Stores are fetched
+    once into an empty cache, then a few stores are changed and all stores are fetched again.
+    '''
+    server = start_stub_server(StubStoreApiHandler)
+    host, port = server.server_address
+    endpoint_base = f'http://{host}:{port}/store_details/'
+    print(f'StoreApiClient cache ({num_stores} stores, {changed_fraction:.0%} changed between runs)')
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for run in ['first run', 'rerun']:
+            if run == 'rerun':
+                StubStoreApiHandler.changed_stores = set(range(0, num_stores, int(1 / changed_fraction)))
+            extractor = DataExtractor(store_api_options={'cache_dir': cache_dir, 'pool_size': max_workers})
+            start = time.perf_counter()
+            extractor.retrieve_stores_data(endpoint_base, {'x-api-key': 'benchmark'}, num_stores, max_workers=max_workers)
+            elapsed = time.perf_counter() - start
+            print(f'  {run:<10} {elapsed:6.2f} s  ' + next(iter(extractor.store_api_clients.values())).report())
+    StubStoreApiHandler.changed_stores = set()
+    server.shutdown()
+
+
+def bench_s3_cache(num_rows=50_000):
+    '''
+    This function checks the S3 download cache of extract_from_s3 against a stubbed S3 client.
+
+    A botocore Stubber answers the client's requests without AWS. Every request must have been
+    queued with the Stubber, so an unexpected download fails the check. The file is extracted
+    once into an empty cache, again with the same ETag (only a HEAD request is expected), and
+    again once its ETag has changed (it is downloaded again and the new content is read).
+    The file is kept under boto3's 8 MiB multipart threshold, so it is downloaded with one GET.
+    '''
+    import io
+    import boto3
+    from botocore.response import StreamingBody
+    from botocore.stub import Stubber
+    s3_client = boto3.client('s3', region_name='eu-west-1', aws_access_key_id='benchmark', aws_secret_access_key='benchmark')
+    stubber = Stubber(s3_client)
+    versions = {etag: make_date_events(num_rows, seed=seed).to_json().encode() for seed, etag in enumerate(['"v1"', '"v2"'])}
+
+    def expect_head(etag):
+        stubber.add_response('head_object', {'ETag': etag, 'ContentLength': len(versions[etag])},
+                             {'Bucket': 'benchmark-bucket', 'Key': 'date_details.json'})
+
+    def expect_download(etag):
+        # download_file asks for the object's size and then gets its body
+        expect_head(etag)
+        stubber.add_response('get_object', {'ETag': etag, 'ContentLength': len(versions[etag]),
+                                            'Body': StreamingBody(io.BytesIO(versions[etag]), len(versions[etag]))})
+
+    file_size = len(versions['"v1"'])
+    print(f'S3 download cache ({num_rows} date events, {file_size / 1024 ** 2:.1f} MiB)')
+    with tempfile.TemporaryDirectory() as cache_dir, stubber:
+        extractor = DataExtractor(s3_cache_dir=cache_dir, s3_client=s3_client)
+        for run, etag, downloads in [('empty cache', '"v1"', True), ('same ETag', '"v1"', False), ('new ETag', '"v2"', True)]:
+            expect_head(etag)
+            if downloads:
+                expect_download(etag)
+            start = time.perf_counter()
+            raw_date_events = extractor.extract_from_s3('s3://benchmark-bucket/date_details.json')
+            elapsed = time.perf_counter() - start
+            stubber.assert_no_pending_responses()
+            pd.testing.assert_frame_equal(raw_date_events, pd.read_json(io.BytesIO(versions[etag])))
+            print(f"  {run:<12} {elapsed:6.2f} s  {'downloaded' if downloads else 'cache hit, download skipped'}  "
+                  f"{extractor.s3_cache_stats}")
+    assert extractor.s3_cache_stats['hits'] == 1 and extractor.s3_cache_stats['misses'] == 2
+
+
+def make_orders_table(num_rows, seed=0):
+    '''
+    This function generates a synthetic dataframe shaped like the raw orders_table in the RDS.
+
+    Args:
+        num_rows: number of orders to generate.
+        seed: seed for the random number generator, so the same data is generated each run.
+
+    Returns:
+        orders_table: a pandas dataframe of synthetic order data.
+    '''
+    rng = np.random.default_rng(seed)
+    uuids = np.array([str(uuid.UUID(int=int(n))) for n in rng.integers(0, 2**63, 1000)])
+    return pd.DataFrame({
+        'level_0': np.arange(num_rows),
+        'index': np.arange(num_rows),
+        'date_uuid': rng.choice(uuids, num_rows),
+        'first_name': None,
+        'last_name': None,
+        'user_uuid': rng.choice(uuids, num_rows),
+        'card_number': rng.integers(10**11, 10**16, num_rows),
+        'store_code': rng.choice(['WEB-1388012W', 'BL-8387506C', 'FR-63DE2F91'], num_rows),
+        'product_code': rng.choice(['R7-3126933h', 'C2-7287916l', 'S7-1175877v'], num_rows),
+        '1': None,
+        'product_quantity': rng.integers(1, 14, num_rows),
+    })
+
+
+def bench_read_rds_table(num_rows=2_000_000, chunk_size=50_000):
+    '''
+    This function compares the peak memory of reading and cleaning a synthetic orders table
+    in full against streaming it in chunks. A local SQLite database stands in for the RDS.
+
+    The rows are first checked to be cleaned the same either way. They are stored out of
+    index order, so chunks of the rows in storage order would be cleaned differently.
+    '''
+    engine = create_engine('sqlite://')
+    for start in range(0, num_rows, 500_000):
+        orders_chunk = make_orders_table(min(500_000, num_rows - start), seed=start)
+        orders_chunk[['level_0', 'index']] += start
+        orders_chunk.sample(frac=1, random_state=start).to_sql('orders_table', engine, if_exists='append', index=False)
+    extractor = DataExtractor()
+    cleaner = DataCleaning()
+    for clean_method in [cleaner.clean_orders_data, cleaner.clean_user_data]:
+        sample = make_user_data(20_000) if clean_method == cleaner.clean_user_data else make_orders_table(20_000)
+        sample.sample(frac=1, random_state=0).to_sql('equivalence_table', engine, if_exists='replace', index=False)
+        chunks = extractor.read_rds_table(engine, 'equivalence_table', chunk_size=3_000)
+        pd.testing.assert_frame_equal(pd.concat(cleaner.clean_chunks(clean_method, chunks)),
+                                      clean_method(extractor.read_rds_table(engine, 'equivalence_table')))
+    print('streamed chunks are cleaned the same as full reads of orders and user data')
+    print(f'read_rds_table ({num_rows} rows, chunk_size={chunk_size})')
+
+    def full_read():
+        return len(cleaner.clean_orders_data(extractor.read_rds_table(engine, 'orders_table')))
+
+    def chunked_read():
+        chunks = extractor.read_rds_table(engine, 'orders_table', chunk_size=chunk_size)
+        return sum(len(chunk) for chunk in cleaner.clean_chunks(cleaner.clean_orders_data, chunks))
+
+    for mode, read in [('full', full_read), ('chunked', chunked_read)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        rows = read()
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'  {mode:<8} {rows} rows in {elapsed:6.2f} s, peak memory {peak / 2**20:8.1f} MiB')
+    engine.dispose()
+
+
+def bench_partitioned_reads(num_rows=2_000_000, partition_counts=(1, 2, 4, 8, 16), indexed=True):
+    '''
+    This function measures the read throughput of read_rds_table as a synthetic orders table is
+    split into more partitions, each read over its own pooled connection. Every partitioned read
+    is checked to return the same rows as a single query.
+
+    Partitioned reads are range queries, so the database is read from the BENCHMARK_DATABASE_URL
+    environment variable (a local PostgreSQL database standing in for the RDS) and the benchmark
+    is skipped without it. With indexed set, the partition column is indexed, as it should be
+    for each range to be read without scanning the whole table.
+    '''
+    database_url = os.environ.get('BENCHMARK_DATABASE_URL', '')
+    if not database_url.startswith('postgresql'):
+        print('partitioned reads: skipped, set BENCHMARK_DATABASE_URL to a PostgreSQL database to run')
+        return
+    engine = create_engine(database_url, pool_size=max(partition_counts))
+    orders_table = make_orders_table(num_rows)
+    # Uploaded with 'index' as the dataframe's index, so it is written as the "index" column
+    DatabaseConnector(table_schemas={}).upload_to_db(engine, orders_table.set_index('index'), 'benchmark_rds_orders')
+    with engine.begin() as conn:
+        if indexed:
+            conn.execute(text('CREATE INDEX ON benchmark_rds_orders ("index")'))
+        conn.execute(text('ANALYZE benchmark_rds_orders'))
+    extractor = DataExtractor()
+    expected = None
+    print(f'partitioned reads ({num_rows} rows, {"indexed" if indexed else "unindexed"} partition column, '
+          f'{os.cpu_count()} cores)')
+    for partitions in partition_counts:
+        start = time.perf_counter()
+        table = extractor.read_rds_table(engine, 'benchmark_rds_orders', partitions=partitions)
+        elapsed = time.perf_counter() - start
+        table = table.sort_values('index', ignore_index=True)
+        if expected is None:
+            expected = table
+        pd.testing.assert_frame_equal(table, expected)
+        print(f'  {partitions:>3} partitions {elapsed:7.2f} s {num_rows / elapsed:10.0f} rows/s')
+    with engine.begin() as conn:
+        conn.execute(text('DROP TABLE benchmark_rds_orders'))
+    engine.dispose()
+
+
+def bench_upload_to_db(num_rows=200_000):
+    '''
+    This function measures the rows per second loaded by each upload_to_db method.
+
+    The target database is read from the BENCHMARK_DATABASE_URL environment variable (e.g. a
+    local PostgreSQL database). Without it, an in-memory SQLite database is used, in which case
+    the 'copy' method falls back to 'multi'.
+    '''
+    engine = create_engine(os.environ.get('BENCHMARK_DATABASE_URL', 'sqlite://'))
+    orders_table = DataCleaning().clean_orders_data(make_orders_table(num_rows))
+    connection = DatabaseConnector()
+    print(f'upload_to_db ({num_rows} rows, {engine.dialect.name})')
+    for method in ['insert', 'multi', 'copy']:
+        start = time.perf_counter()
+        connection.upload_to_db(engine, orders_table, 'benchmark_orders_table', method=method)
+        elapsed = time.perf_counter() - start
+        print(f'  {method:<8} {num_rows / elapsed:10.0f} rows/s')
+    engine.dispose()
+
+
+def legacy_convert_to_kg(weight):
+    '''
+    This function is the original row-by-row weight conversion used by convert_product_weights
+    before it was vectorised. It is kept as a reference to check the two give identical results.
+    '''
+    unit_match = re.match(r'([\d.]+)\s*[xX]\s*([\d.]+)\s*([a-zA-Z]+)', weight)
+    if unit_match:
+        quantity, num, unit = unit_match.groups()
+        total_value = float(quantity) * float(num)
+    else:
+        unit_match = re.match(r'([\d.]+)\s*([a-zA-Z]+)', weight)
+        if not unit_match:
+            return None
+        total_value, unit = unit_match.groups()
+        total_value = float(total_value)
+    if unit == 'kg':
+        return total_value
+    elif unit == 'g' or unit == 'ml':
+        return total_value / 1000
+    elif unit == 'oz':
+        return total_value * 0.0283495
+    return None
+
+
+def legacy_convert_product_weights(raw_product_data):
+    '''
+    This function applies legacy_convert_to_kg the way convert_product_weights originally did.
+    '''
+    raw_product_data['weight'] = raw_product_data['weight'].fillna('NaN').apply(legacy_convert_to_kg)
+    raw_product_data['weight'] = pd.to_numeric(raw_product_data['weight'])
+    return raw_product_data.dropna(how='any')
+
+
+def make_product_weights(num_rows, seed=0):
+    '''
+    This function generates a synthetic dataframe of product weights shaped like products.csv,
+    including multipacks, mixed units, stray characters, unknown units and nulls.
+    '''
+    rng = np.random.default_rng(seed)
+    weights = np.array(['1.5kg', '100g', '12 x 100g', '3 X 2.5oz', '77g .', '250ml', '16oz',
+                        '0.5 kg', '8 x 85g', '2x', 'NaN', '9GO7', 'Missing weight'], dtype=object)
+    weight_col = rng.choice(weights, num_rows)
+    weight_col[rng.random(num_rows) < 0.01] = None
+    return pd.DataFrame({'weight': weight_col, 'product_code': 'R7-3126933h'})
+
+
+def bench_convert_product_weights(num_rows=10_000_000, legacy_rows=1_000_000):
+    '''
+    This function checks convert_product_weights gives the same result as the original row-by-row
+    conversion, then compares their throughput on synthetic weights. A sample of products.csv is
+    checked by tests/test_cleaning.py.
+    '''
+    cleaner = DataCleaning()
+    sample = make_product_weights(100_000)
+    pd.testing.assert_frame_equal(cleaner.convert_product_weights(sample.copy()),
+                                  legacy_convert_product_weights(sample.copy()), check_exact=True)
+    print('convert_product_weights matches the original conversion on synthetic weights')
+    print(f'convert_product_weights ({num_rows} rows)')
+    for method, rows in [(legacy_convert_product_weights, legacy_rows), (cleaner.convert_product_weights, num_rows)]:
+        product_weights = make_product_weights(rows)
+        start = time.perf_counter()
+        method(product_weights)
+        elapsed = time.perf_counter() - start
+        print(f'  {method.__name__:<32} {rows / elapsed:12.0f} rows/s')
+
+
+def make_card_pdf(num_pages, rows_per_page=40, seed=0):
+    '''
+    This function writes a PDF shaped like card_details.pdf, with a table of card details on
+    every page, using only the PDF text operators so no PDF library is needed.
+
+    Returns:
+        pdf_bytes: the contents of the PDF file.
+    '''
+    rng = np.random.default_rng(seed)
+    providers = ['VISA 16 digit', 'Mastercard', 'American Express', 'JCB 15 digit', 'Maestro']
+    header = ['card_number', 'expiry_date', 'card_provider', 'date_payment_confirmed']
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>', None,
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>']
+    page_ids = []
+    for _ in range(num_pages):
+        rows = [header] + [[str(rng.integers(10**11, 10**16)), f'{rng.integers(1, 13):02d}/{rng.integers(24, 31)}',
+                            providers[rng.integers(len(providers))], f'20{rng.integers(10, 23)}-0{rng.integers(1, 10)}-1{rng.integers(0, 10)}']
+                           for _ in range(rows_per_page)]
+        text_ops = ''.join(f'BT /F1 9 Tf {x} {770 - 18 * row_num} Td ({cell}) Tj ET\n'
+                           for row_num, row in enumerate(rows) for x, cell in zip((40, 170, 260, 400), row))
+        objects.append(f'<< /Length {len(text_ops)} >>\nstream\n{text_ops}endstream')
+        objects.append(f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] '
+                       f'/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>')
+        page_ids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{page_id} 0 R' for page_id in page_ids)}] /Count {num_pages} >>"
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for obj_num, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f'{obj_num} 0 obj\n{obj}\nendobj\n'.encode()
+    xref_offset = len(pdf)
+    pdf += f'xref\n0 {len(objects) + 1}\n0000000000 65535 f \n'.encode()
+    pdf += ''.join(f'{offset:010d} 00000 n \n' for offset in offsets).encode()
+    pdf += f'trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n'.encode()
+    return pdf
+
+
+def bench_retrieve_pdf_data(num_pages=300, worker_counts=(1, 2, 4, 8)):
+    '''
+    This function measures how long retrieve_pdf_data takes to read a generated card details
+    PDF, served from a local HTTP server, for each number of worker processes. A fresh cache
+    directory is used for every run so the parsed result is never reused. The last run is then
+    repeated with its cache, which should return the parsed result without downloading the PDF.
+    '''
+    pdf_bytes = make_card_pdf(num_pages)
+    downloads = []
+
+    class StubPdfHandler(BaseHTTPRequestHandler):
+        def do_HEAD(self):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(pdf_bytes)))
+            self.send_header('ETag', '"card-details-v1"')
+            self.end_headers()
+
+        def do_GET(self):
+            downloads.append(self.path)
+            self.do_HEAD()
+            self.wfile.write(pdf_bytes)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = start_stub_server(StubPdfHandler)
+    host, port = server.server_address
+    link = f'http://{host}:{port}/card_details.pdf'
+    print(f'retrieve_pdf_data ({num_pages} pages)')
+    for max_workers in worker_counts:
+        with tempfile.TemporaryDirectory() as cache_dir:
+            start = time.perf_counter()
+            raw_card_data = DataExtractor(s3_cache_dir=cache_dir).retrieve_pdf_data(link, max_workers=max_workers)
+            elapsed = time.perf_counter() - start
+            print(f'  max_workers={max_workers:<3} {elapsed:7.2f} s ({len(raw_card_data)} rows, {num_pages / elapsed:6.1f} pages/s)')
+            if max_workers == worker_counts[-1]:
+                downloads.clear()
+                start = time.perf_counter()
+                cached_card_data = DataExtractor(s3_cache_dir=cache_dir).retrieve_pdf_data(link, max_workers=max_workers)
+                elapsed = time.perf_counter() - start
+                pd.testing.assert_frame_equal(cached_card_data, raw_card_data)
+                assert not downloads, 'the cached PDF was downloaded again'
+                print(f'  cached        {elapsed:7.2f} s (parsed result reused, PDF not downloaded)')
+    server.shutdown()
+
+
+def make_user_dates(num_rows, seed=0):
+    '''
+    This function generates a synthetic series of dates written in the mixed formats found in
+    the user and store data, with some garbage entries and nulls.
+    '''
+    rng = np.random.default_rng(seed)
+    dates = pd.Timestamp('1940-01-01') + pd.to_timedelta(rng.integers(0, 30_000, 20_000), unit='D')
+    formats = ['%Y-%m-%d', '%Y %B %d', '%B %Y %d', '%Y/%m/%d', '%b %d %Y']
+    unique_dates = np.array([date.strftime(formats[i % len(formats)]) for i, date in enumerate(dates)]
+                            + ['NULL', 'GMRBOMI0O1', None], dtype=object)
+    return pd.Series(unique_dates[rng.integers(0, len(unique_dates), num_rows)], name='date_of_birth')
+
+
+def bench_parse_dates(num_rows=5_000_000, legacy_rows=500_000):
+    '''
+    This function checks parse_dates gives the same result as mixed-format pd.to_datetime, then
+    compares their throughput on a synthetic user table's date column.
+    '''
+    cleaner = DataCleaning()
+
+    def legacy_parse_dates(raw_dates):
+        return pd.to_datetime(raw_dates, format='mixed', errors='coerce')
+
+    sample = make_user_dates(200_000, seed=1)
+    pd.testing.assert_series_equal(cleaner.parse_dates(sample), legacy_parse_dates(sample), check_dtype=False)
+    print('parse_dates matches mixed-format pd.to_datetime')
+    print(f'parse_dates ({num_rows} rows)')
+    for method, rows in [(legacy_parse_dates, legacy_rows), (cleaner.parse_dates, num_rows)]:
+        raw_dates = make_user_dates(rows)
+        start = time.perf_counter()
+        method(raw_dates)
+        elapsed = time.perf_counter() - start
+        print(f'  {method.__name__:<32} {rows / elapsed:12.0f} rows/s')
+
+
+def make_user_data(num_rows, seed=0):
+    '''
+    This function generates a synthetic dataframe shaped like the raw legacy_users table, with
+    mixed date formats, newlines in addresses and some garbage rows.
+    '''
+    rng = np.random.default_rng(seed)
+    countries = np.array([('United Kingdom', 'GB'), ('Germany', 'DE'), ('United States', 'US'), ('NULL', 'NULL'),
+                          ('5EFAFD0JLI', 'XKI'), ('United Kingdom', 'GGB')], dtype=object)
+    country_rows = countries[rng.choice(len(countries), num_rows, p=[0.5, 0.25, 0.2, 0.02, 0.02, 0.01])]
+    uuids = np.array([str(uuid.UUID(int=int(n))) for n in rng.integers(0, 2**63, 5000)], dtype=object)
+    return pd.DataFrame({
+        'index': rng.permutation(num_rows),
+        'first_name': rng.choice(['Sigfried', 'Guy', 'Harry', 'Darren', 'NULL'], num_rows),
+        'last_name': rng.choice(['Noack', 'Allen', 'Lawrence', 'Hussain', 'NULL'], num_rows),
+        'date_of_birth': make_user_dates(num_rows, seed=seed + 1).to_numpy(),
+        'company': rng.choice(['Heydrich Junitz KG', 'Fox Ltd', 'Ladeck', 'NULL'], num_rows),
+        'email_address': rng.choice(['rudi79@winkler.de', 'daniellebryan@thompson.org', 'NULL'], num_rows),
+        'address': rng.choice(['Zimmerstr. 1/0\n59015 Gießen', 'Studio 22a\nLynne terrace\nMcCarthymouth', 'NULL'], num_rows),
+        'country': country_rows[:, 0],
+        'country_code': country_rows[:, 1],
+        'phone_number': rng.choice(['+49(0) 047905356', '(0161) 496 0674', 'NULL'], num_rows),
+        'join_date': make_user_dates(num_rows, seed=seed + 2).to_numpy(),
+        'user_uuid': rng.choice(uuids, num_rows),
+    })
+
+
+def make_card_data(num_rows, seed=0):
+    '''
+    This function generates a synthetic dataframe shaped like the card data read from
+    card_details.pdf, with '?'-prefixed card numbers and garbage card providers.
+    '''
+    rng = np.random.default_rng(seed)
+    card_numbers = rng.integers(10**11, 10**16, num_rows).astype(object)
+    mangled = rng.random(num_rows) < 0.02
+    card_numbers[mangled] = ['??' + str(number) for number in card_numbers[mangled]]
+    providers = ['VISA 16 digit', 'Mastercard', 'American Express', 'JCB 15 digit', 'Maestro',
+                 'Discover', 'Diners Club / Carte Blanche', 'NULL', 'OGJTXI6X1H', None]
+    return pd.DataFrame({
+        'card_number': card_numbers,
+        'expiry_date': rng.choice(['09/26', '10/23', '11/25', 'NULL'], num_rows),
+        'card_provider': rng.choice(providers, num_rows, p=[0.2, 0.2, 0.15, 0.1, 0.1, 0.1, 0.1, 0.02, 0.02, 0.01]),
+        'date_payment_confirmed': rng.choice(['2015-11-25', '2001-06-18', 'December 2021 17', 'NULL'], num_rows),
+    })
+
+
+def make_store_data(num_rows, seed=0):
+    '''
+    This function generates a synthetic dataframe shaped like the store details API responses,
+    with 'ee'-prefixed continents, letters in staff numbers and garbage rows.
+    '''
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'address': rng.choice(['Flat 72W\nSally isle\nEast Deantown', 'N/A', 'NULL'], num_rows),
+        'longitude': rng.choice(['-1.5', '13.37', 'N/A', 'NULL', '-0.12752'], num_rows),
+        'lat': None,
+        'locality': rng.choice(['High Wycombe', 'Chapeltown', 'N/A'], num_rows),
+        'store_code': rng.choice(['WEB-1388012W', 'HI-9B97EE4E', 'BL-8387506C'], num_rows),
+        'staff_numbers': rng.choice(['325', '34', 'J78', '3n9', 'NULL'], num_rows),
+        'opening_date': make_user_dates(num_rows, seed=seed + 1).to_numpy(),
+        'store_type': rng.choice(['Web Portal', 'Local', 'Super Store', 'Mall Kiosk', 'Outlet', 'NULL'], num_rows),
+        'latitude': rng.choice(['51.62907', '-0.9', 'N/A', 'NULL'], num_rows),
+        'country_code': rng.choice(['GB', 'DE', 'US', 'NULL', 'YELVM536YT'], num_rows),
+        'continent': rng.choice(['Europe', 'America', 'eeEurope', 'eeAmerica', 'NULL', 'QMAVR5H3LD'], num_rows),
+    }, index=pd.Index(np.arange(num_rows), name='index'))
+
+
+def legacy_clean_store_data(raw_store_data):
+    '''
+    This function is the original multi-pass clean_store_data, kept as a reference to check the
+    single-pass version against. Its regex also removed the signs and decimal points of the coordinates.
+    '''
+    raw_store_data = raw_store_data.drop(['lat'], axis=1)
+    raw_store_data['continent'] = raw_store_data['continent'].str.lstrip('ee')
+    raw_store_data = raw_store_data.drop(raw_store_data[~raw_store_data['continent'].isin(['Europe','America','nan'])].index)
+    numeric_cols = ['longitude', 'latitude', 'staff_numbers']
+    raw_store_data[numeric_cols] = raw_store_data[numeric_cols].astype('string')
+    raw_store_data[numeric_cols] = raw_store_data[numeric_cols].replace(r'[^0-9]+', '', regex=True)
+    raw_store_data[numeric_cols] = raw_store_data[numeric_cols].apply(pd.to_numeric, errors='coerce')
+    raw_store_data['opening_date'] = DataCleaning().parse_dates(raw_store_data['opening_date'])
+    raw_store_data.reset_index(drop = True, inplace=True)
+    return raw_store_data
+
+
+def bench_clean_store_data(num_rows=1_000_000):
+    '''
+    This function checks clean_store_data gives the same result as the original multi-pass
+    version, apart from the coordinates which now keep their signs and decimal points, then
+    compares their throughput on a synthetic store table.
+    '''
+    cleaner = DataCleaning()
+    coordinates = ['longitude', 'latitude']
+    raw_store_data = make_store_data(100_000)
+    clean_store_data = cleaner.clean_store_data(raw_store_data.copy())
+    pd.testing.assert_frame_equal(clean_store_data.drop(columns=coordinates),
+                                  legacy_clean_store_data(raw_store_data.copy()).drop(columns=coordinates))
+    valid_rows = raw_store_data['continent'].str.lstrip('ee').isin(['Europe', 'America'])
+    for col in coordinates:
+        expected = pd.to_numeric(raw_store_data.loc[valid_rows, col], errors='coerce').reset_index(drop=True)
+        pd.testing.assert_series_equal(clean_store_data[col].astype(float), expected, check_names=False)
+    print('clean_store_data matches the original cleaning, with signed decimal coordinates')
+    print(f'clean_store_data ({num_rows} rows)')
+    for method in [legacy_clean_store_data, cleaner.clean_store_data]:
+        raw_store_data = make_store_data(num_rows)
+        start = time.perf_counter()
+        method(raw_store_data)
+        elapsed = time.perf_counter() - start
+        print(f'  {method.__name__:<32} {num_rows / elapsed:12.0f} rows/s')
+
+
+def legacy_clean_card_data(raw_card_data):
+    '''
+    This function is the original method-by-method clean_card_data, kept as a reference to check
+    the CLEANING_RULES version against.
+    '''
+    raw_card_data['card_number'] = raw_card_data['card_number'].astype('string').str.replace(r'[^0-9]+', '', regex=True)
+    raw_card_data = raw_card_data[(raw_card_data['card_provider'].isin(VALID_CARD_PROVIDERS))]
+    raw_card_data.reset_index(drop = True, inplace=True)
+    return raw_card_data
+
+
+def legacy_clean_date_events(raw_date_events):
+    '''
+    This function is the original method-by-method clean_date_events, kept as a reference to
+    check the CLEANING_RULES version against.
+    '''
+    raw_date_events['timestamp'] = pd.to_datetime(raw_date_events['timestamp'], format='%H:%M:%S', errors='coerce').dt.time
+    raw_date_events = raw_date_events.drop(raw_date_events[raw_date_events['timestamp'].isnull()].index)
+    raw_date_events['month'] = pd.to_datetime(raw_date_events['month'], format='%m').dt.month
+    raw_date_events['year'] = pd.to_datetime(raw_date_events['year'], format='%Y').dt.year
+    raw_date_events['day'] = pd.to_datetime(raw_date_events['day'], format='%d').dt.day
+    raw_date_events.reset_index(drop = True, inplace=True)
+    return raw_date_events
+
+
+def bench_cleaning_rules(num_rows=2_000_000):
+    '''
+    This function checks that cleaning the card and date events tables with their CLEANING_RULES
+    keeps the same rows as the original method-by-method cleaning, then compares their times and
+    prints how many rows each rule quarantined.
+    '''
+    cleaner = DataCleaning()
+    print(f'cleaning rules ({num_rows} rows)')
+    for table_name, make_raw_data, legacy_method, method in [
+            ('dim_card_details', make_card_data, legacy_clean_card_data, cleaner.clean_card_data),
+            ('dim_date_times', make_date_events, legacy_clean_date_events, cleaner.clean_date_events)]:
+        raw_data = make_raw_data(num_rows)
+        seconds = {}
+        results = {}
+        for name, clean_method in [('legacy', legacy_method), ('rules', method)]:
+            start = time.perf_counter()
+            results[name] = clean_method(raw_data.copy())
+            seconds[name] = time.perf_counter() - start
+        pd.testing.assert_frame_equal(results['rules'], results['legacy'])
+        rejections = ', '.join(f'{rule_name}: {count}' for rule_name, count in cleaner.rejection_counts[table_name].items() if count)
+        print(f"  {table_name:<18} legacy {seconds['legacy']:6.2f} s  rules {seconds['rules']:6.2f} s  "
+              f"({len(cleaner.quarantine[table_name])} rows quarantined; {rejections})")
+
+
+def make_product_data(num_rows, seed=0):
+    '''
+    This function generates a synthetic dataframe shaped like products.csv, with malformed
+    weights, prices with a '£' prefix and some null rows.
+    '''
+    rng = np.random.default_rng(seed)
+    product_data = pd.DataFrame({
+        'product_name': rng.choice(['FurReal Dazzlin\' Dimblebee', 'Tiffany Style Lamp', 'Lavender Scented Candle'], num_rows),
+        'product_price': rng.choice(['£39.99', '£9.99', '£115.49'], num_rows),
+        'weight': make_product_weights(num_rows, seed=seed)['weight'].to_numpy(),
+        'category': rng.choice(['toys-and-games', 'homeware', 'pets', 'diy', 'health-and-beauty'], num_rows),
+        'EAN': rng.choice(['7425710935115', '487127635418', '1945816904649'], num_rows),
+        'date_added': rng.choice(['2005-12-02', '2006-01-09', '2018-10-22'], num_rows),
+        'uuid': rng.choice(['83dc0a69-f96f-4c34-bcb7-928acae19a94', '712254d7-aea7-4310-aed8-7d78c0e3c2b0'], num_rows),
+        'removed': rng.choice(['Still_avaliable', 'Removed'], num_rows),
+        'product_code': rng.choice(['R7-3126933h', 'C2-7287916l', 'S7-1175877v'], num_rows),
+    })
+    return product_data
+
+
+def make_date_events(num_rows, seed=0):
+    '''
+    This function generates a synthetic dataframe shaped like date_details.json, with some
+    garbage rows where every column holds the same random string.
+    '''
+    rng = np.random.default_rng(seed)
+    date_events = pd.DataFrame({
+        'timestamp': [f'{h:02d}:{m:02d}:{sec:02d}' for h, m, sec in rng.integers(0, [24, 60, 60], (num_rows, 3))],
+        'month': rng.integers(1, 13, num_rows).astype(str),
+        'year': rng.integers(1992, 2023, num_rows).astype(str),
+        'day': rng.integers(1, 29, num_rows).astype(str),
+        'time_period': rng.choice(['Evening', 'Morning', 'Midday', 'Late_Hours'], num_rows),
+        'date_uuid': rng.choice(['3b7ca996-37f9-433f-b6d0-ce8391b615ad', 'adc86836-6c35-49ca-bb0d-65b6507a00fa'], num_rows),
+    })
+    garbage = rng.random(num_rows) < 0.001
+    date_events.loc[garbage, :] = 'NULL'
+    return date_events
+
+
+# Cleaning method name -> synthetic data generator for its input
+CLEANING_BENCHMARKS = {
+    'clean_user_data': make_user_data,
+    'clean_card_data': make_card_data,
+    'clean_store_data': make_store_data,
+    'convert_product_weights': make_product_data,
+    'clean_product_data': lambda num_rows, seed=0: DataCleaning().convert_product_weights(make_product_data(num_rows, seed)),
+    'clean_orders_data': make_orders_table,
+    'clean_date_events': make_date_events,
+}
+
+
+def _read_status_kib(field):
+    '''
+    This function reads a memory figure, in KiB, from /proc/self/status. Linux only.
+    '''
+    with open('/proc/self/status') as status_file:
+        return next(int(line.split()[1]) for line in status_file if line.startswith(f'{field}:'))
+
+
+def _clean_peak_memory(method_name, lean_dtypes, num_rows):
+    '''
+    This function runs one DataCleaning method on synthetic data and measures the memory it used.
+    It is run in a fresh process by bench_cleaning_methods and bench_lean_dtypes, and resets the process' peak memory
+    (VmHWM) once the raw data is built, so only the cleaning itself is measured.
+
+    Returns:
+        (peak_mib, result_mib): the peak memory used while cleaning above what the raw data
+                                used, and the memory of the cleaned dataframe.
+    '''
+    raw_data = CLEANING_BENCHMARKS[method_name](num_rows)
+    method = getattr(DataCleaning(lean_dtypes=lean_dtypes), method_name)
+    with open('/proc/self/clear_refs', 'w') as clear_refs:
+        clear_refs.write('5')
+    baseline_kib = _read_status_kib('VmRSS')
+    clean_data = method(raw_data)
+    peak_kib = _read_status_kib('VmHWM')
+    return (peak_kib - baseline_kib) / 1024, clean_data.memory_usage(deep=True).sum() / 2**20
+
+
+def bench_cleaning_methods(sizes=(10_000, 1_000_000, 10_000_000), results_dir='benchmark_results'):
+    '''
+    This function runs every DataCleaning method on seeded synthetic data at each size and
+    records its throughput and peak memory.
+
+    Each method is run twice per size: once in this process to measure throughput, then once in
+    a fresh process by _clean_peak_memory to measure peak memory. Peak memory is read from the
+    kernel's high-water mark (VmHWM) rather than tracemalloc, which doesn't see the memory
+    allocated by pyarrow for string columns. Results are printed and saved as JSON in results_dir,
+    named after the current git commit, so two commits can be compared with --compare. Linux only,
+    as peak memory is read from /proc.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    cleaner = DataCleaning()
+    results = []
+    print('DataCleaning methods')
+    for method_name, make_data in CLEANING_BENCHMARKS.items():
+        method = getattr(cleaner, method_name)
+        for num_rows in sizes:
+            raw_data = make_data(num_rows)
+            start = time.perf_counter()
+            method(raw_data)
+            elapsed = time.perf_counter() - start
+            del raw_data
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                peak_mib = executor.submit(_clean_peak_memory, method_name, False, num_rows).result()[0]
+            results.append({'method': method_name, 'rows': num_rows, 'seconds': elapsed,
+                            'rows_per_second': num_rows / elapsed, 'peak_mib': peak_mib})
+            print(f'  {method_name:<24} {num_rows:>10} rows {num_rows / elapsed:12.0f} rows/s {peak_mib:10.1f} MiB peak')
+    try:
+        label = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        label = 'latest'
+    os.makedirs(results_dir, exist_ok=True)
+    results_path = os.path.join(results_dir, f'{label}.json')
+    with open(results_path, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f'Results saved to {results_path}')
+
+
+def bench_lean_dtypes(num_rows=1_000_000, check_rows=20_000):
+    '''
+    This function compares the peak memory of every DataCleaning method with and without
+    lean_dtypes, after checking both give the same values. Each run is in its own process so
+    the peak memory it reports is its own. Linux only, as peak memory is read from /proc.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    for method_name, make_data in CLEANING_BENCHMARKS.items():
+        results = [getattr(DataCleaning(lean_dtypes=lean_dtypes), method_name)(make_data(check_rows))
+                   for lean_dtypes in (False, True)]
+        pd.testing.assert_frame_equal(results[0], results[1], check_dtype=False, check_categorical=False, check_exact=True)
+    print('lean dtypes give the same values as full-width cleaning')
+    print(f'lean dtypes ({num_rows} rows): peak memory while cleaning / cleaned data, in MiB')
+    for method_name in CLEANING_BENCHMARKS:
+        measurements = []
+        for lean_dtypes in (False, True):
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                measurements.append(executor.submit(_clean_peak_memory, method_name, lean_dtypes, num_rows).result())
+        (full_peak, full_size), (lean_peak, lean_size) = measurements
+        print(f'  {method_name:<24} full {full_peak:8.1f} / {full_size:8.1f}   lean {lean_peak:8.1f} / {lean_size:8.1f}')
+
+
+def compare_results(old_path, new_path):
+    '''
+    This function prints the change in throughput and peak memory of each cleaning benchmark
+    between two results files saved by bench_cleaning_methods.
+    '''
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old_results = {(result['method'], result['rows']): result for result in json.load(old_file)}
+        new_results = {(result['method'], result['rows']): result for result in json.load(new_file)}
+    print(f"{'method':<24} {'rows':>10} {'speedup':>8} {'peak memory':>12}")
+    for key in sorted(old_results.keys() & new_results.keys()):
+        old, new = old_results[key], new_results[key]
+        speedup = new['rows_per_second'] / old['rows_per_second']
+        memory_change = new['peak_mib'] / old['peak_mib'] if old['peak_mib'] else float('nan')
+        print(f'{key[0]:<24} {key[1]:>10} {speedup:>7.2f}x {memory_change:>11.2f}x')
+
+
+def bench_cleaning_backends(num_rows=5_000_000):
+    '''
+    This function checks that the pandas and DuckDB backends of clean_orders_data return equal
+    results on a synthetic orders table, given as a dataframe and as a Parquet file, then
+    compares how long each backend takes.
+    '''
+    raw_orders_table = make_orders_table(num_rows)
+    with tempfile.TemporaryDirectory() as parquet_dir:
+        parquet_path = os.path.join(parquet_dir, 'orders_table.parquet')
+        raw_orders_table.to_parquet(parquet_path)
+        expected = DataCleaning(backend='pandas').clean_orders_data(raw_orders_table.copy())
+        print(f'clean_orders_data backends ({num_rows} rows)')
+        for backend in ['pandas', 'duckdb']:
+            cleaner = DataCleaning(backend=backend)
+            for input_name, raw_input in [('dataframe', raw_orders_table), ('parquet', parquet_path)]:
+                start = time.perf_counter()
+                clean_orders_table = cleaner.clean_orders_data(raw_input)
+                elapsed = time.perf_counter() - start
+                pd.testing.assert_frame_equal(clean_orders_table, expected)
+                print(f'  {backend:<8} {input_name:<10} {num_rows / elapsed:12.0f} rows/s')
+
+
+def make_sales_database(num_orders, seed=0):
+    '''
+    This function generates synthetic cleaned tables shaped like the star schema of the
+    sales_data database: an orders table and the product, store and date dimensions it joins to.
+
+    Returns:
+        tables: dict of table name to a pandas dataframe of its cleaned data.
+    '''
+    rng = np.random.default_rng(seed)
+    num_products, num_stores = 1800, 450
+    product_codes = np.array([f'P{n}-{n * 7919 % 10**7:07d}' for n in range(num_products)])
+    store_codes = np.array([f'ST-{n:08X}' for n in range(num_stores)])
+    date_uuids = np.array([str(uuid.UUID(int=int(n))) for n in rng.integers(0, 2**63, num_orders)])
+    sale_times = pd.Timestamp('1992-01-01') + pd.to_timedelta(rng.integers(0, 30 * 365 * 86400, num_orders), unit='s')
+    country_codes = rng.choice(['GB', 'DE', 'US'], num_stores, p=[0.6, 0.25, 0.15])
+    country_codes[0] = 'N/A'
+    store_types = rng.choice(['Local', 'Super Store', 'Mall Kiosk', 'Outlet'], num_stores)
+    store_types[0] = 'Web Portal'
+    return {
+        'orders_table': pd.DataFrame({
+            'date_uuid': date_uuids,
+            'user_uuid': rng.choice(date_uuids[:10_000], num_orders),
+            'card_number': rng.integers(10**11, 10**16, num_orders),
+            'store_code': rng.choice(store_codes, num_orders),
+            'product_code': rng.choice(product_codes, num_orders),
+            'product_quantity': rng.integers(1, 14, num_orders),
+        }),
+        'dim_products': pd.DataFrame({
+            'product_code': product_codes,
+            'product_price': rng.integers(99, 50_000, num_products) / 100,
+        }),
+        'dim_store_details': pd.DataFrame({
+            'store_code': store_codes,
+            'locality': rng.choice(['High Wycombe', 'Chapeltown', 'Belper', 'Bushey', 'Exeter', 'Arbroath',
+                                    'Rutherglen', 'Lancaster', 'Berlin', 'Munich'], num_stores),
+            'store_type': store_types,
+            'country_code': country_codes,
+            'staff_numbers': rng.integers(2, 120, num_stores),
+        }),
+        'dim_date_times': pd.DataFrame({
+            'date_uuid': date_uuids,
+            'year': sale_times.year,
+            'month': sale_times.month,
+            'day': sale_times.day,
+            'timestamp': sale_times.time,
+        }),
+    }
+
+
+# Summary table -> clause a dashboard uses to show it, matching the order and limit of the
+# original query in Milestone_4_Queries.zip (with tie-breakers so the results are stable)
+DASHBOARD_QUERIES = {
+    'summary_stores_by_country': 'ORDER BY total_no_stores DESC, country',
+    'summary_stores_by_locality': 'ORDER BY total_no_stores DESC, locality LIMIT 7',
+    'summary_sales_by_month': 'ORDER BY total_sales DESC, month LIMIT 6',
+    'summary_sales_by_location': 'ORDER BY number_of_sales, location',
+    'summary_sales_by_store_type': 'ORDER BY total_sales DESC, store_type',
+    'summary_sales_by_year_month': 'ORDER BY total_sales DESC, year, month LIMIT 10',
+    'summary_staff_by_country': 'ORDER BY total_staff_numbers DESC, country',
+    'summary_sales_by_country_store_type': "WHERE country_code = 'DE' ORDER BY total_sales, store_type",
+    'summary_time_between_sales': 'ORDER BY time_interval DESC, year LIMIT 5',
+}
+
+
+def bench_business_queries(num_orders=2_000_000, repeats=5, new_fraction=0.01):
+    '''
+    This function compares the latency of the business questions when answered by joining the
+    loaded tables (without and then with the schema spec's keys and indexes) against reading the summary
+    tables built by refresh_summary_tables. Each summary is checked to give the same answer as
+    its live query.
+
+    A new_fraction of orders (and their dates) is then appended, as an incremental run of
+    main.py would, and refreshing the summaries with only the new orders is timed against
+    rebuilding them from every order. The summaries are checked against the live queries again
+    after each.
+
+    The queries are written for PostgreSQL, so the database is read from the
+    BENCHMARK_DATABASE_URL environment variable and the benchmark is skipped without it.
+    '''
+    database_url = os.environ.get('BENCHMARK_DATABASE_URL', '')
+    if not database_url.startswith('postgresql'):
+        print('business queries: skipped, set BENCHMARK_DATABASE_URL to a PostgreSQL database to run')
+        return
+    from database_utils import SUMMARY_TABLES, TABLE_SCHEMAS
+    engine = create_engine(database_url)
+    # Loaded without the schema spec first, so the live queries are timed without indexes
+    for table_name, table in make_sales_database(num_orders).items():
+        # Column types are taken from the schema spec, so the summaries are built from the same types as in the pipeline
+        column_types = TABLE_SCHEMAS[table_name]['columns']
+        DatabaseConnector(table_schemas={}).upload_to_db(engine, table, table_name,
+                                                         dtype={column: column_types[column] for column in table if column in column_types})
+    connection = DatabaseConnector()
+
+    def median_latency(query):
+        latencies = []
+        with engine.connect() as conn:
+            for _ in range(repeats):
+                start = time.perf_counter()
+                answer = pd.read_sql(query, conn)
+                latencies.append(time.perf_counter() - start)
+        return float(np.median(latencies)), answer
+
+    live_queries = {name: f'SELECT * FROM ({SUMMARY_TABLES[name]}) AS live {clause}' for name, clause in DASHBOARD_QUERIES.items()}
+    without_indexes = {name: median_latency(query) for name, query in live_queries.items()}
+    connection.create_indexes(engine)
+    with_indexes = {name: median_latency(query) for name, query in live_queries.items()}
+    start = time.perf_counter()
+    connection.refresh_summary_tables(engine)
+    refresh_seconds = time.perf_counter() - start
+    summaries = {name: median_latency(f'SELECT * FROM {name} {clause}') for name, clause in DASHBOARD_QUERIES.items()}
+    print(f'business queries ({num_orders} orders, median of {repeats} runs, ms)')
+    print(f"  {'query':<36} {'live':>10} {'indexed':>10} {'summary':>10}")
+    for name in DASHBOARD_QUERIES:
+        pd.testing.assert_frame_equal(summaries[name][1], with_indexes[name][1])
+        print(f'  {name:<36} {without_indexes[name][0] * 1000:10.1f} {with_indexes[name][0] * 1000:10.1f} '
+              f'{summaries[name][0] * 1000:10.1f}')
+    totals = [sum(latency for latency, _ in results.values()) * 1000 for results in (without_indexes, with_indexes, summaries)]
+    print(f"  {'all queries':<36} {totals[0]:10.1f} {totals[1]:10.1f} {totals[2]:10.1f}")
+    print(f'  refresh_summary_tables took {refresh_seconds:.2f} s')
+    new_tables = make_sales_database(int(num_orders * new_fraction), seed=1)
+    new_tables['orders_table'].index += num_orders
+    for table_name in ('dim_date_times', 'orders_table'):
+        connection.upload_to_db(engine, new_tables[table_name], table_name, if_exists='append')
+    for full_refresh in (False, True):
+        start = time.perf_counter()
+        refresh = connection.refresh_summary_tables(engine, full_refresh=full_refresh)
+        refresh_seconds = time.perf_counter() - start
+        for name in DASHBOARD_QUERIES:
+            pd.testing.assert_frame_equal(pd.read_sql(f'SELECT * FROM {name} {DASHBOARD_QUERIES[name]}', engine),
+                                          pd.read_sql(live_queries[name], engine))
+        mode = 'rebuilt from every order' if refresh['rebuilt'] else 'refreshed with the new orders'
+        print(f"  {len(new_tables['orders_table'])} orders appended: summaries {mode} "
+              f"({refresh['orders']} aggregated) in {refresh_seconds:.2f} s")
+    engine.dispose()
+
+
+def bench_clean_parallel(num_rows=2_000_000, worker_counts=(2, 4, 8, 16, 32), chunk_rows=None):
+    '''
+    This function measures the speedup of clean_parallel over cleaning in a single process as the
+    number of workers grows, for each cleaning method it supports. Worker counts above the number
+    of cores are skipped. The parallel result is checked against the single process result.
+    '''
+    cleaner = DataCleaning()
+    worker_counts = [workers for workers in worker_counts if workers <= os.cpu_count()]
+    print(f'clean_parallel ({num_rows} rows, chunk_rows={chunk_rows or "rows / workers"}, {os.cpu_count()} cores)')
+    print(f"  {'method':<24} {'serial':>8} " + ' '.join(f'{workers:>6}w' for workers in worker_counts))
+    for method_name in ['clean_user_data', 'clean_card_data', 'clean_store_data', 'convert_product_weights', 'clean_orders_data']:
+        raw_data = CLEANING_BENCHMARKS[method_name](num_rows)
+        clean_method = getattr(cleaner, method_name)
+        start = time.perf_counter()
+        expected = clean_method(raw_data.copy())
+        serial_seconds = time.perf_counter() - start
+        speedups = []
+        for workers in worker_counts:
+            start = time.perf_counter()
+            clean_data = cleaner.clean_parallel(clean_method, raw_data.copy(), n_workers=workers, chunk_rows=chunk_rows)
+            speedups.append(serial_seconds / (time.perf_counter() - start))
+            pd.testing.assert_frame_equal(clean_data, expected)
+        print(f'  {method_name:<24} {serial_seconds:7.2f}s ' + ' '.join(f'{speedup:6.2f}x' for speedup in speedups))
+
+
+def _run_orders_pipeline(mode, source_url, target_url, chunk_rows, max_queued):
+    '''
+    This function extracts, cleans and uploads the orders table either all at once ('materialized')
+    or streamed in chunks ('streaming'). It is run in a fresh process by bench_streaming_pipeline,
+    so the peak memory it reports is its own. Linux only, as peak memory is read from /proc.
+
+    Returns:
+        (rows, seconds, peak_rss_mib): rows uploaded, wall time and the process' peak memory.
+    '''
+    from streaming import prefetch
+    source_engine = create_engine(source_url)
+    target_engine = create_engine(target_url)
+    extractor = DataExtractor()
+    cleaner = DataCleaning()
+    # The schema spec and COPY are PostgreSQL only, and SQLite limits the variables in a multi-row INSERT
+    is_postgresql = target_engine.dialect.name == 'postgresql'
+    connection = DatabaseConnector(table_schemas=None if is_postgresql else {})
+    method = 'copy' if is_postgresql else 'insert'
+    start = time.perf_counter()
+    if mode == 'materialized':
+        orders_table = cleaner.clean_orders_data(extractor.read_rds_table(source_engine, 'orders_table'))
+        connection.upload_to_db(target_engine, orders_table, 'orders_table', method=method)
+        rows = len(orders_table)
+    else:
+        raw_chunks = prefetch(extractor.stream_rds_table(source_engine, 'orders_table', chunk_size=chunk_rows), max_queued)
+        clean_chunks = prefetch(cleaner.clean_chunks(cleaner.clean_orders_data, raw_chunks), max_queued)
+        rows = connection.upload_chunks(target_engine, clean_chunks, 'orders_table', method=method)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss carries over from the parent process through fork and exec, VmHWM (in KiB) starts again
+    with open('/proc/self/status') as status_file:
+        peak_rss_kib = next(int(line.split()[1]) for line in status_file if line.startswith('VmHWM:'))
+    return rows, elapsed, peak_rss_kib / 1024
+
+
+def bench_streaming_pipeline(num_rows=20_000_000, chunk_rows=100_000, max_queued=2, modes=('materialized', 'streaming')):
+    '''
+    This function compares the end-to-end wall time and peak memory of loading a synthetic orders
+    table all at once against streaming it through extract, clean and upload in chunks.
+
+    The orders are read from a local SQLite database standing in for the RDS, and uploaded to
+    the database in the BENCHMARK_DATABASE_URL environment variable (or another SQLite database
+    without it). Each mode runs in its own process; a mode which runs out of memory is reported
+    rather than stopping the benchmark.
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_url = f"sqlite:///{os.path.join(temp_dir, 'rds.db')}"
+        target_url = os.environ.get('BENCHMARK_DATABASE_URL', f"sqlite:///{os.path.join(temp_dir, 'sales_data.db')}")
+        source_engine = create_engine(source_url)
+        for start in range(0, num_rows, 1_000_000):
+            orders_chunk = make_orders_table(min(1_000_000, num_rows - start), seed=start)
+            orders_chunk[['level_0', 'index']] += start
+            orders_chunk.to_sql('orders_table', source_engine, if_exists='append', index=False)
+        source_engine.dispose()
+        print(f'streaming pipeline ({num_rows} rows, chunk_rows={chunk_rows}, max_queued={max_queued}, '
+              f'{create_engine(target_url).dialect.name} target)')
+        for mode in modes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                try:
+                    rows, seconds, peak_rss_mib = executor.submit(_run_orders_pipeline, mode, source_url, target_url,
+                                                                  chunk_rows, max_queued).result()
+                except BrokenProcessPool:
+                    print(f'  {mode:<13} failed: the process was killed, most likely for running out of memory')
+                    continue
+            print(f'  {mode:<13} {rows} rows in {seconds:7.1f} s ({rows / seconds:9.0f} rows/s), '
+                  f'peak RSS {peak_rss_mib:8.1f} MiB')
+
+
+def bench_dimension_changes(num_rows=1_000_000, changed_fraction=0.01):
+    '''
+    This function compares reloading a dimension table in full on every run against the change
+    detection used by main.py's load_dimension: skipping the load when the raw data's
+    fingerprint is unchanged, and otherwise uploading only the changed rows with upload_changes.
+    Each changed run is checked to leave the same rows as a full reload.
+
+    The diff is applied with PostgreSQL-only SQL, so the database is read from the
+    BENCHMARK_DATABASE_URL environment variable and the benchmark is skipped without it.
+    '''
+    database_url = os.environ.get('BENCHMARK_DATABASE_URL', '')
+    if not database_url.startswith('postgresql'):
+        print('dimension changes: skipped, set BENCHMARK_DATABASE_URL to a PostgreSQL database to run')
+        return
+    engine = create_engine(database_url)
+    extractor = DataExtractor()
+    cleaner = DataCleaning()
+    connection = DatabaseConnector()
+    raw_date_events = make_date_events(num_rows)
+    raw_date_events['date_uuid'] = [str(uuid.UUID(int=row)) for row in range(num_rows)]
+
+    def load(raw_data, changes_only=True):
+        start = time.perf_counter()
+        fingerprint = extractor.fingerprint(raw_data)
+        if changes_only and connection.read_fingerprint(engine, 'dim_date_times') == fingerprint:
+            return time.perf_counter() - start, 'skipped'
+        clean_data = cleaner.clean_date_events(raw_data.copy())
+        with engine.begin() as conn:
+            changes = connection.upload_changes(conn, clean_data, 'dim_date_times', full_reload=not changes_only)
+            connection.write_fingerprint(conn, 'dim_date_times', fingerprint)
+        return time.perf_counter() - start, ', '.join(f'{count} {change}' for change, count in changes.items())
+
+    def loaded_rows():
+        table = pd.read_sql('SELECT * FROM dim_date_times', engine).drop(columns='index')
+        return table.astype(str).sort_values('date_uuid').reset_index(drop=True)
+
+    rng = np.random.default_rng(1)
+    changed_date_events = raw_date_events.copy()
+    changed_rows = rng.random(num_rows) < changed_fraction
+    changed_date_events.loc[changed_rows, 'time_period'] = 'Midday'
+    # Some rows are removed and some new ones added, as well as the updates
+    changed_date_events = pd.concat([changed_date_events.iloc[num_rows // 100:],
+                                     make_date_events(num_rows // 100, seed=2).assign(
+                                         date_uuid=[str(uuid.uuid4()) for _ in range(num_rows // 100)])],
+                                    ignore_index=True)
+    print(f'dimension changes ({num_rows} date events, {changed_fraction:.0%} updated, 1% deleted, 1% inserted)')
+    for name, raw_data, changes_only in [('full reload', raw_date_events, False),
+                                         ('unchanged', raw_date_events, True),
+                                         ('full reload of changes', changed_date_events, False)]:
+        seconds, changes = load(raw_data, changes_only)
+        print(f'  {name:<24} {seconds:7.2f} s  ({changes})')
+    expected = loaded_rows()
+    load(raw_date_events, changes_only=False)
+    seconds, changes = load(changed_date_events)
+    pd.testing.assert_frame_equal(loaded_rows(), expected)
+    print(f"  {'changed rows only':<24} {seconds:7.2f} s  ({changes})")
+    engine.dispose()
+
+
+# Module -> the most time (in seconds) importing it may take before bench_import_time fails
+IMPORT_TIME_BUDGETS = {'data_cleaning': 1.0, 'data_extraction': 1.5, 'database_utils': 1.0, 'main': 2.0}
+
+
+def bench_import_time():
+    '''
+    This function measures the cumulative import time of each pipeline module with
+    python -X importtime, in a fresh interpreter per module, and checks it against the budget
+    in IMPORT_TIME_BUDGETS. It exits with an error if any module is over budget, so it can be
+    used as a check before merging changes.
+    '''
+    over_budget = []
+    print('import time')
+    for module, budget in IMPORT_TIME_BUDGETS.items():
+        importtime = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                    capture_output=True, text=True, check=True)
+        # Lines look like 'import time:  self [us] | cumulative | imported package'
+        cumulative_us = next(int(line.split('|')[1]) for line in importtime.stderr.splitlines()
+                             if line.startswith('import time:') and line.split('|')[2].strip() == module)
+        seconds = cumulative_us / 1e6
+        print(f'  {module:<16} {seconds:6.3f} s (budget {budget:.1f} s)')
+        if seconds > budget:
+            over_budget.append(module)
+    if over_budget:
+        sys.exit(f'Import time over budget for: {", ".join(over_budget)}')
+
+
+BENCHMARKS = {
+    'stores': bench_retrieve_stores_data,
+    'store_cache': bench_store_api_cache,
+    's3_cache': bench_s3_cache,
+    'rds': bench_read_rds_table,
+    'upload': bench_upload_to_db,
+    'weights': bench_convert_product_weights,
+    'pdf': bench_retrieve_pdf_data,
+    'dates': bench_parse_dates,
+    'store_cleaning': bench_clean_store_data,
+    'cleaning_rules': bench_cleaning_rules,
+    'cleaning': bench_cleaning_methods,
+    'lean_dtypes': bench_lean_dtypes,
+    'imports': bench_import_time,
+    'backends': bench_cleaning_backends,
+    'business_queries': bench_business_queries,
+    'parallel': bench_clean_parallel,
+    'streaming': bench_streaming_pipeline,
+    'dimension_changes': bench_dimension_changes,
+    'partitioned_reads': bench_partitioned_reads,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs benchmarks for the data centralisation pipeline.')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help=f'names of the benchmarks to run ({", ".join(BENCHMARKS)}). Runs all of them by default.')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10_000, 1_000_000, 10_000_000],
+                        help='row counts used by the cleaning benchmark.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files saved by the cleaning benchmark instead of running benchmarks.')
+    args = parser.parse_args()
+    if args.compare:
+        compare_results(*args.compare)
+        parser.exit()
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+    for name in args.benchmarks or BENCHMARKS:
+        if name == 'cleaning':
+            bench_cleaning_methods(sizes=args.sizes)
+        else:
+            BENCHMARKS[name]()
@@ -1,7 +1,57 @@
 import pandas as pd
+import hashlib
+import inspect
+import multiprocessing
+import os
 import re
+import tempfile
 import numpy as np
-from pandasgui import show
+from concurrent.futures import ProcessPoolExecutor
+from cleaning_rules import CleaningRules
+
+# Matches weights such as '1.5kg', '100 g' and multipacks such as '12 x 100g'. Only the start
+# of the weight has to match, so trailing characters (e.g. '77g .') are ignored.
+WEIGHT_PATTERN = re.compile(r'^(?:(?P<quantity>[\d.]+)\s*[xX]\s*)?(?P<value>[\d.]+)\s*(?P<unit>[a-zA-Z]+)')
+# Unit -> (multiplier, divisor) used to convert a weight to kg
+WEIGHT_UNIT_CONVERSIONS = {'kg': (1, 1), 'g': (1, 1000), 'ml': (1, 1000), 'oz': (0.0283495, 1)}
+# Date formats found in the user and store data, most common first. Tried by parse_dates before
+# falling back to slower mixed-format parsing.
+DATE_FORMATS = ['%Y-%m-%d', '%Y %B %d', '%B %Y %d', '%Y/%m/%d']
+# Continents kept by clean_store_data once their 'ee' typos are removed
+VALID_CONTINENTS = ['Europe', 'America', 'nan']
+# Card providers kept by clean_card_data. Rows with any other value (e.g. null or random text) are rejected
+VALID_CARD_PROVIDERS = ['Diners Club / Carte Blanche', 'American Express', 'JCB 16 digit', 'JCB 15 digit', 'Maestro',
+                        'Mastercard', 'Discover', 'VISA 19 digit', 'VISA 16 digit', 'VISA 13 digit']
+# Rules applied by apply_rules to each table's columns (see CleaningRules for what each rule does).
+# Rows failing a rule are quarantined rather than uploaded.
+CLEANING_RULES = {
+    'dim_card_details': {
+        'card_number': {'replace': (r'[^0-9]+', '')},
+        'card_provider': {'allowed': VALID_CARD_PROVIDERS},
+    },
+    'dim_date_times': {
+        'timestamp': {'cast': 'time', 'format': '%H:%M:%S'},
+        'month': {'cast': 'int32', 'range': (1, 12)},
+        'year': {'cast': 'int32', 'range': (1, 9999)},
+        'day': {'cast': 'int32', 'range': (1, 31)},
+    },
+}
+# Characters removed from numeric columns before conversion. Signs and decimal points are kept
+# so that coordinates such as '-0.12752' survive.
+NON_NUMERIC_PATTERN = re.compile(r'[^0-9.\-]+')
+# Columns with few distinct values, stored as categories when lean_dtypes is enabled
+LOW_CARDINALITY_COLUMNS = ['country', 'country_code', 'continent', 'store_type', 'card_provider',
+                           'category', 'removed', 'time_period']
+# Cleaning methods which only look at one row at a time, so clean_parallel can split a table
+# into chunks for them: name -> whether the method sorts the rows by their first column, whether
+# it resets the index of the rows it returns, and the table name it passes to shrink_dtypes
+PARALLEL_CLEANING_METHODS = {
+    'clean_user_data': {'sorts_by_first_column': True, 'resets_index': True, 'table_name': 'dim_users'},
+    'clean_card_data': {'sorts_by_first_column': False, 'resets_index': True, 'table_name': 'dim_card_details'},
+    'clean_store_data': {'sorts_by_first_column': False, 'resets_index': True, 'table_name': 'dim_store_details'},
+    'convert_product_weights': {'sorts_by_first_column': False, 'resets_index': False, 'table_name': None},
+    'clean_orders_data': {'sorts_by_first_column': False, 'resets_index': True, 'table_name': 'orders_table'},
+}
 
 class DataCleaning:
     '''
@@ -11,12 +61,42 @@ class DataCleaning:
         clean_user_data: cleans raw user data.
         clean_card_data: cleans raw card data.
         clean_store_data: cleans raw store data.
-        convert_product_weights: cleans product weight data.
-            convert_to_kg: nested method to convert product weights to kg.
+        convert_product_weights: cleans product weight data, converting all weights to kg.
         clean_product_data: cleans raw product data.
         clean_orders_data: cleans raw orders data.
+        _clean_orders_data_duckdb: cleans raw orders data with DuckDB.
         clean_date_events: cleans raw date events data.
+        apply_rules: applies a table's CLEANING_RULES, quarantining the rows which fail them.
+        cleaning_fingerprint: returns a hash of the cleaning code and options, used to tell whether cleaning has changed.
+        clean_chunks: applies a cleaning method to each chunk of a streamed table.
+        clean_parallel: applies a cleaning method to chunks of a table in parallel worker processes.
+        parse_dates: converts a column of dates in mixed formats to datetime64.
+        parse_numbers: converts a column of numbers with stray characters to a numeric datatype.
+        shrink_dtypes: converts cleaned data to categories and narrower numeric types to save memory.
+        _float32_if_lossless: narrows floats to float32 when no value changes.
+        _string_dtype: picks the datatype a string column is parsed to.
+        show_in_gui: opens a dataframe in PandasGUI for inspecting data while debugging.
     '''
+    def __init__(self, lean_dtypes=False, backend='pandas'):
+        '''
+        This function sets up the cleaning options.
+
+        Args:
+            lean_dtypes: if True, every cleaning method passes its result through shrink_dtypes,
+                         making the cleaned tables smaller without changing their values.
+            backend: the engine used to clean the orders table. 'pandas' (the default) or 'duckdb',
+                     which runs the cleaning as a multithreaded query that can spill to disk.
+        '''
+        if backend not in ('pandas', 'duckdb'):
+            raise ValueError(f'Sorry, {backend} is not a valid backend.\nValid backends are: pandas, duckdb.')
+        self.lean_dtypes = lean_dtypes
+        self.backend = backend
+        self.cleaning_rules = {table_name: CleaningRules(column_rules) for table_name, column_rules in CLEANING_RULES.items()}
+        # Table name -> rows rejected by its last apply_rules, and the number each rule rejected (a
+        # row failing several rules is counted by each)
+        self.quarantine = {}
+        self.rejection_counts = {}
+
     def clean_user_data (self, raw_user_data):
         '''
         This function takes in raw user data and cleans it.
@@ -40,11 +120,13 @@ class DataCleaning:
         raw_user_data['address'] = raw_user_data['address'].str.replace('\n', ', ')
         string_cols = list(raw_user_data[['first_name', 'last_name', 'company', 'email_address',
                              'country', 'country_code', 'user_uuid', 'address', 'phone_number']])
-        raw_user_data[string_cols] = raw_user_data[string_cols].astype('string')
+        # Columns are cast one at a time to avoid copying all of them at once
+        for col in string_cols:
+            raw_user_data[col] = raw_user_data[col].astype(self._string_dtype(col))
         # Casting date columns
-        # using pd.to_datetime to convert date formats, errors return NaT
-        raw_user_data['date_of_birth'] = pd.to_datetime(raw_user_data['date_of_birth'], format='mixed', infer_datetime_format=True, errors='coerce')
-        raw_user_data['join_date'] = pd.to_datetime(raw_user_data['join_date'], format='mixed', infer_datetime_format=True, errors='coerce')
+        # using parse_dates to convert date formats, errors return NaT
+        raw_user_data['date_of_birth'] = self.parse_dates(raw_user_data['date_of_birth'])
+        raw_user_data['join_date'] = self.parse_dates(raw_user_data['join_date'])
         # removing rows where date_of_birth or join_date are null
         null_dobs = raw_user_data['date_of_birth'].isnull()
         null_join_dates = raw_user_data['join_date'].isnull()
@@ -52,6 +134,8 @@ class DataCleaning:
         raw_user_data = raw_user_data.drop(problem_dates.index)
         # Resets index column on dataframe and returns to main.py
         raw_user_data.reset_index(drop = True, inplace=True)
+        if self.lean_dtypes:
+            raw_user_data = self.shrink_dtypes(raw_user_data, 'dim_users')
         return raw_user_data
     
     def clean_card_data(self, raw_card_data):
@@ -63,8 +147,11 @@ class DataCleaning:
         are removed.
         
         After this, the values in the card_provider column are checked and any rows with invalid
-        entries (e.g. null or random text strings) are dropped. Finally the index column is reset
-        and the card_data dataframe is returned to main.py 
+        entries (e.g. null or random text strings) are quarantined. Both steps are rules in
+        CLEANING_RULES, run by apply_rules. This takes about as long as cleaning the card data
+        step by step did, as nearly all of the time is spent converting card numbers to text and
+        removing characters from them. Finally the index column is reset and the card_data
+        dataframe is returned to main.py 
 
         Args:
             raw_card_data: a pandas dataframe containing the raw card data to be cleaned.
@@ -72,18 +159,13 @@ class DataCleaning:
         Returns:
             raw_card_data: a pandas dataframe which as now been cleaned. Will be reassigned as clean_card_data in main.py
         '''
-        # Cleans card_number column by casting as string and uses regex to match rows
-        # with only numeric characters.
-        raw_card_data['card_number'] = raw_card_data['card_number'].astype('string').str.replace(r'[^0-9]+', '', regex=True)
-        # Removes null data by getting unique values in card_provider column. Any rows with card_provider
-        # values not matching the list below are dropped.
-        valid_card_providers = ['Diners Club / Carte Blanche', 'American Express',
-                                'JCB 16 digit', 'JCB 15 digit', 'Maestro',
-                                'Mastercard', 'Discover', 'VISA 19 digit',
-                                'VISA 16 digit', 'VISA 13 digit']
-        raw_card_data = raw_card_data[(raw_card_data['card_provider'].isin(valid_card_providers))]
+        # Removes non-numeric characters from card_number and quarantines rows whose card_provider
+        # isn't in VALID_CARD_PROVIDERS
+        raw_card_data = self.apply_rules(raw_card_data, 'dim_card_details')
         # Resets index column on dataframe and returns to main.py
         raw_card_data.reset_index(drop = True, inplace=True)
+        if self.lean_dtypes:
+            raw_card_data = self.shrink_dtypes(raw_card_data, 'dim_card_details')
         return raw_card_data
     
     def clean_store_data(self, raw_store_data):
@@ -91,7 +173,8 @@ class DataCleaning:
         This function takes in raw store data and cleans it.
 
         Columns are converted to their intended data types and null values are identified and removed.
-        A regex expression is used to identify erroneous data in some columns.
+        A regex expression is used to identify erroneous data in some columns. Invalid rows are
+        removed in a single pass, and longitude and latitude keep their signs and decimal points.
 
         Args:
             raw_store_data: a pandas dataframe containing the raw store data to be cleaned.
@@ -99,32 +182,36 @@ class DataCleaning:
         Returns:
             raw_store_data: a pandas dataframe which as now been cleaned. Will be reassigned as clean_store_data in main.py
         '''
-        # Removes 'lat' column as it looks erroneous
-        raw_store_data = raw_store_data.drop(['lat'], axis=1)
-        # Strips leading 'ee' string on continent column, then drops rows without valid continents
-        raw_store_data['continent'] = raw_store_data['continent'].str.lstrip('ee')     
-        raw_store_data = raw_store_data.drop(raw_store_data[~raw_store_data['continent'].isin(['Europe','America','nan'])].index)
+        # Strips leading 'ee' string on continent column, then keeps rows with valid continents.
+        # The rows are selected (and 'lat', which looks erroneous, removed) in a single copy
+        continent = raw_store_data['continent'].str.lstrip('ee')
+        valid_rows = continent.isin(VALID_CONTINENTS).to_numpy()
+        kept_cols = raw_store_data.columns.drop('lat')
+        raw_store_data = raw_store_data.loc[valid_rows, kept_cols]
+        raw_store_data['continent'] = continent[valid_rows]
         # Converts numeric cols to numeric datatype
-        numeric_cols = ['longitude', 'latitude', 'staff_numbers']
-        raw_store_data[numeric_cols] = raw_store_data[numeric_cols].astype('string')
-        raw_store_data[numeric_cols] = raw_store_data[numeric_cols].replace(r'[^0-9]+', '', regex=True)
-        raw_store_data[numeric_cols] = raw_store_data[numeric_cols].apply(pd.to_numeric, errors='coerce')
+        for col in ['longitude', 'latitude', 'staff_numbers']:
+            raw_store_data[col] = self.parse_numbers(raw_store_data[col])
         # Converts open_date to datetime64 datatype
-        raw_store_data['opening_date'] = pd.to_datetime(raw_store_data['opening_date'], format='mixed', errors='coerce')
+        raw_store_data['opening_date'] = self.parse_dates(raw_store_data['opening_date'])
         # Resets index column on dataframe and returns to main.py
         raw_store_data.reset_index(drop = True, inplace=True)
+        if self.lean_dtypes:
+            raw_store_data = self.shrink_dtypes(raw_store_data, 'dim_store_details')
         return raw_store_data
 
     def convert_product_weights(self, raw_product_data):
         '''
         This function takes in raw product data and cleans the 'weight' column.
 
-        A nested function, convert_to_kg, is defined. This function converts the weights of each product into kg.
+        A single compiled regex, WEIGHT_PATTERN, is used to extract an optional quantity, a value and
+        a unit from each distinct entry of the 'weight' column at once (e.g. '12 x 100g' or '1.5kg'). The
+        quantity defaults to 1 when a weight is not a multipack. Quantity and value are multiplied
+        together, then converted to kg using the WEIGHT_UNIT_CONVERSIONS lookup table.
 
-        The nested convert_to_kg function is applied to all rows in the 'weight' column of the product data.
-        After this, any null values are dropped. The product data dataframe is then passed to the clean_product_data function.
-        For convert_to_kg to work, any null values are converted to a string that won't be read as a weight unit, 'NaN.
-        Once convert_to_kg is applied, these NaN strings are replaced with np.NaN and then dropped.
+        Weights which do not match the regex, have a unit missing from the lookup table or are null
+        become NaN. After this, any rows with null values are dropped. The product data dataframe
+        is then passed to the clean_product_data function.
 
         Args:
             raw product_data: a pandas dataframe containing the raw store data to be cleaned.
@@ -132,67 +219,21 @@ class DataCleaning:
         Returns:
             raw product_data: a pandas dataframe which as now been cleaned. Will be reassigned as clean_product_data in main.py
         '''
-        def convert_to_kg(weight_col):
-            '''
-            This function uses a regex expression to convert the weight of the product to kg.
-
-            The regex expression searches for 3 groups: a quantity, a value and a unit (kg, g, ml, oz).
-            An if/else block is used to convert the value (depending on its unit), then
-            multiplied by the quantity to get the weight of the product in kg.
-
-            If a quantity value is not found, then the nested if/else block is used. This
-            block converts the value depending on the unit. The else clause catches any
-            weight entries which do not match the regex expression, such as random text
-            or a 'NaN' string that replaced any null values from the
-            convert_product_weights function.
-
-            Args:
-                weight_col: the 'weight' column of the productt data dataframe.
-        
-            Returns:
-                total_value: the weight value once it has been converted into kg.
-            '''
-            # Regex which Looks for a quantity, weight and a unit
-            unit_match = re.match(r'([\d.]+)\s*[xX]\s*([\d.]+)\s*([a-zA-Z]+)', weight_col)
-            # If 3 groups were matched (quantity, weight, unit), multiply qty by weight
-            # then perform unit conversion
-            if unit_match:
-                quantity, num, unit = unit_match.groups()
-                quantity, num = float(quantity), float(num)
-                total_value = quantity * num
-                if unit == 'kg':
-                    return total_value
-                elif unit == 'g' or unit == 'ml':
-                    return total_value / 1000
-                elif unit == 'oz':
-                    return total_value * 0.0283495
-                else:
-                    return None
-            else:
-            # If the regex doesn't match 3 groups, match two (weight and unit) then
-            # perform unit conversion. If no match at all, return None
-                unit_match = re.match(r'([\d.]+)\s*([a-zA-Z]+)', weight_col)
-                if unit_match:
-                    total_value, unit = unit_match.groups()
-                    total_value = float(total_value)
-
-                    if unit == 'kg':
-                        return total_value
-                    elif unit == 'g' or unit == 'ml':
-                        return total_value / 1000
-                    elif unit == 'oz':
-                        return total_value * 0.0283495
-                    else:
-                        return None
-                else:
-                    return None
-        # Null values have to be converted to string in order for the convert_to_kg
-        # function to work. After conversion, these string 'NaNs' are converted
-        # back into np.NaN. Afterwards, NaN values are dropped. These rows looked erroneous.
-        raw_product_data['weight'] = raw_product_data['weight'].fillna('NaN')
-        raw_product_data['weight'] = raw_product_data['weight'].apply(convert_to_kg)
-        raw_product_data['weight'] = raw_product_data['weight'].replace('NaN', np.nan)
-        raw_product_data['weight'] = pd.to_numeric(raw_product_data['weight'])
+        # Weights repeat heavily, so each distinct weight string is only parsed once. Null
+        # weights get a code of -1.
+        codes, unique_weights = pd.factorize(raw_product_data['weight'])
+        # Extracts quantity, value and unit columns. Rows that don't match are all NaN
+        weight_parts = pd.Series(unique_weights, dtype=object).str.extract(WEIGHT_PATTERN)
+        quantity = pd.to_numeric(weight_parts['quantity'], errors='coerce').fillna(1).to_numpy()
+        value = pd.to_numeric(weight_parts['value'], errors='coerce').to_numpy()
+        # Looks up the multiplier and divisor of each unit. Unknown units map to NaN
+        multiplier = weight_parts['unit'].map({unit: factors[0] for unit, factors in WEIGHT_UNIT_CONVERSIONS.items()})
+        divisor = weight_parts['unit'].map({unit: factors[1] for unit, factors in WEIGHT_UNIT_CONVERSIONS.items()})
+        unique_kg = quantity * value * multiplier.to_numpy(dtype=float) / divisor.to_numpy(dtype=float)
+        if self.lean_dtypes:
+            unique_kg = self._float32_if_lossless(unique_kg)
+        # A trailing NaN (of the same width) is appended so that the -1 codes of null weights index it
+        raw_product_data['weight'] = np.append(unique_kg, unique_kg.dtype.type('nan'))[codes]
         raw_product_data = raw_product_data.dropna(how='any')
         return raw_product_data
 
@@ -216,17 +257,21 @@ class DataCleaning:
                               as clean_product_data in main.py
         '''
         string_cols = list(raw_product_data[['product_name', 'category', 'EAN', 'uuid', 'removed', 'product_code']])
-        raw_product_data[string_cols] = raw_product_data[string_cols].astype('string')
+        raw_product_data[string_cols] = raw_product_data[string_cols].astype({col: self._string_dtype(col) for col in string_cols})
         print(f'\nAvailable categories are:\n{raw_product_data["category"].unique()}\n\nItem availability statuses are:\n{raw_product_data["removed"].unique()}\n\n')
         
         raw_product_data['product_price'] = raw_product_data['product_price'].str.lstrip('£')
         raw_product_data['product_price'] = pd.to_numeric(raw_product_data['product_price'])
+        if self.lean_dtypes:
+            raw_product_data['product_price'] = self._float32_if_lossless(raw_product_data['product_price'])
         # Converts date_added column to datetime64. Earliest and latests dates seem sensible, so it
         # looks like the date formats were interpreted correctly. No errors or Null values so this
         # column doesn't seem to require cleaning.
         raw_product_data['date_added'] = pd.to_datetime(raw_product_data['date_added'], format='mixed')
 
         raw_product_data.reset_index(drop = True, inplace=True)
+        if self.lean_dtypes:
+            raw_product_data = self.shrink_dtypes(raw_product_data, 'dim_products')
         return raw_product_data
 
     def clean_orders_data(self, raw_orders_table):
@@ -237,30 +282,64 @@ class DataCleaning:
         No erroneous data was identified, so the index column is reset and the cleaned data is returned
         to main.py.
 
+        With the 'duckdb' backend, the same steps are run by _clean_orders_data_duckdb instead.
+        The raw orders can also be given as the path of a Parquet file (such as a snapshot saved
+        by DataExtractor.save_snapshot), which DuckDB reads without loading it all into pandas first.
+
         Args:
-            raw_orders_table: pandas dataframe of orders table data to be cleaned.
+            raw_orders_table: pandas dataframe of orders table data to be cleaned, or the path of a
+                              Parquet file of it.
         Returns:
             raw_orders_table: pandas dataframe of orders table data which has now been cleaned.
                               It will be reassigned to clean_orders_table in main.py
         '''
-        raw_orders_table = raw_orders_table.drop(['level_0', 'first_name', 'last_name', '1'], axis = 1)
-        raw_orders_table = raw_orders_table.set_index('index', drop=True)
-        raw_orders_table.reset_index(drop = True, inplace=True)
+        if self.backend == 'duckdb':
+            raw_orders_table = self._clean_orders_data_duckdb(raw_orders_table)
+        else:
+            if isinstance(raw_orders_table, str):
+                raw_orders_table = pd.read_parquet(raw_orders_table)
+            raw_orders_table = raw_orders_table.drop(['level_0', 'first_name', 'last_name', '1'], axis = 1)
+            raw_orders_table = raw_orders_table.set_index('index', drop=True)
+            raw_orders_table.reset_index(drop = True, inplace=True)
+        if self.lean_dtypes:
+            raw_orders_table = self.shrink_dtypes(raw_orders_table, 'orders_table')
         return raw_orders_table
 
+    def _clean_orders_data_duckdb(self, raw_orders_table):
+        '''
+        This function cleans the orders table with DuckDB.
+
+        The dropped columns are excluded in a single lazy query plan over the dataframe or Parquet
+        file, which DuckDB runs across all cores. Insertion order is preserved, so the rows come
+        back in the same order as the pandas backend returns them.
+
+        Args:
+            raw_orders_table: pandas dataframe of orders table data, or the path of a Parquet file of it.
+        Returns:
+            clean_orders_table: pandas dataframe of the cleaned orders table data.
+        '''
+        import duckdb
+        with duckdb.connect() as conn:
+            if isinstance(raw_orders_table, str):
+                relation = conn.read_parquet(raw_orders_table)
+            else:
+                relation = conn.from_df(raw_orders_table)
+            clean_orders_table = relation.project('* EXCLUDE (level_0, first_name, last_name, "1", "index")').df()
+        return clean_orders_table
+
     def clean_date_events(self, raw_date_events):
         '''
         This function cleans the data events data before it is uploaded to the PostgreSQL database.
 
-        This is done by casting the 'timestamp' column to datetime64 using a H:M:S. Errors
-        are coerced to identify any erroneous data. The .dt.time function is used to extract the timestamp
-        and remove the Unix Epoch date which would otherwise be added into the column. As a side effect of
-        using .dt.time, the datatype of the 'timestamp' column reverts to object.
+        This is done by parsing the 'timestamp' column as H:M:S times. The times are kept as
+        datetime.time values (without the Unix Epoch date which would otherwise be added), so the
+        datatype of the 'timestamp' column is object.
 
-        The erroneous data is dropped from the table (after being visually checked). The same methodology is applied to the 'month,'
-        'year,' and 'day' columns.
+        The 'month', 'year' and 'day' columns are cast to integers and checked to be in range.
+        Rows which fail any of these rules in CLEANING_RULES are quarantined by apply_rules
+        (after being visually checked, the erroneous rows were found to be garbage in every column).
 
-        Unique time periods are printed to identify typos and erroneous data. Nothing unusual was found.
+        Unique time periods were checked for typos and erroneous data. Nothing unusual was found.
         
         Args:
             raw_date_events: pandas dataframe of date events to be cleaned.
@@ -269,15 +348,359 @@ class DataCleaning:
             raw_date_events: pandas dataframe of date events which has been cleaned. Will be
                              reassigned to clean_date_events in main.py
         '''
-        raw_date_events['timestamp'] = pd.to_datetime(raw_date_events['timestamp'], format='%H:%M:%S', errors='coerce').dt.time
-        null_timestamps_mask = raw_date_events['timestamp'].isnull()
-        null_timestamps = raw_date_events[null_timestamps_mask]
-        raw_date_events = raw_date_events.drop(null_timestamps.index)
-
-        raw_date_events['month'] = pd.to_datetime(raw_date_events['month'], format='%m').dt.month
-        raw_date_events['year'] = pd.to_datetime(raw_date_events['year'], format='%Y').dt.year
-        raw_date_events['day'] = pd.to_datetime(raw_date_events['day'], format='%d').dt.day
-        raw_date_events['time_period'].unique()
-       
+        raw_date_events = self.apply_rules(raw_date_events, 'dim_date_times')
         raw_date_events.reset_index(drop = True, inplace=True)
-        return raw_date_events
\ No newline at end of file
+        if self.lean_dtypes:
+            raw_date_events = self.shrink_dtypes(raw_date_events, 'dim_date_times')
+        return raw_date_events
+
+    def cleaning_fingerprint(self):
+        '''
+        This function returns a fingerprint of the cleaning code and options.
+
+        The source of this module (which holds CLEANING_RULES) and of cleaning_rules.py is hashed
+        along with the lean_dtypes and backend options. main.py stores it with the fingerprint of
+        each table's raw data, so a table is cleaned and loaded again when its cleaning changes,
+        even if its raw data hasn't.
+
+        Returns:
+            fingerprint: a hex string of the cleaning fingerprint.
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        for source_path in (__file__, inspect.getsourcefile(CleaningRules)):
+            with open(source_path, 'rb') as source_file:
+                digest.update(source_file.read())
+        digest.update(f'lean_dtypes={self.lean_dtypes},backend={self.backend}'.encode())
+        return digest.hexdigest()
+
+    def apply_rules(self, raw_data, table_name):
+        '''
+        This function applies a table's rules in CLEANING_RULES to its raw data.
+
+        The rules are compiled into a CleaningRules object when the DataCleaning object is created,
+        and evaluate every column's checks on its distinct values in a single pass. Rows failing
+        any rule are kept in self.quarantine[table_name], with a 'rejected_by' column naming the
+        rules they failed, and the number of rows each rule rejected in
+        self.rejection_counts[table_name]. A row failing several rules is counted by each of them,
+        so the number of rows rejected is len(self.quarantine[table_name]).
+
+        Args:
+            raw_data: pandas dataframe of raw data.
+            table_name: the table whose rules are applied, e.g. 'dim_card_details'.
+
+        Returns:
+            clean_data: the rows of raw_data which passed every rule, with their columns converted.
+        '''
+        clean_data, rejected_data, rejection_counts = self.cleaning_rules[table_name].apply(raw_data)
+        self.quarantine[table_name] = rejected_data
+        self.rejection_counts[table_name] = rejection_counts
+        return clean_data
+
+    def parse_dates(self, raw_dates):
+        '''
+        This function converts a column of dates written in mixed formats to datetime64.
+
+        Each distinct date string is only parsed once, as dates repeat heavily. The distinct
+        dates are parsed with each explicit format in DATE_FORMATS in turn, each pass only
+        trying the dates that earlier formats couldn't parse. Any dates left over are parsed
+        with pandas' slower mixed-format parser. Dates which can't be parsed become NaT, giving
+        the same result as pd.to_datetime(raw_dates, format='mixed', errors='coerce').
+
+        Args:
+            raw_dates: a pandas series of dates to be parsed.
+
+        Returns:
+            parsed_dates: a pandas series of datetime64 values with the same index as raw_dates.
+        '''
+        codes, unique_dates = pd.factorize(raw_dates)
+        unique_dates = pd.Series(unique_dates, dtype=object)
+        parsed_unique_dates = pd.to_datetime(unique_dates, format=DATE_FORMATS[0], errors='coerce').to_numpy(copy=True)
+        unparsed = np.flatnonzero(np.isnat(parsed_unique_dates))
+        for date_format in DATE_FORMATS[1:] + ['mixed']:
+            if len(unparsed) == 0:
+                break
+            attempt = pd.to_datetime(unique_dates.iloc[unparsed], format=date_format, errors='coerce').to_numpy()
+            parsed_unique_dates[unparsed] = attempt
+            unparsed = unparsed[np.isnat(attempt)]
+        # A trailing NaT is appended so that the -1 codes of null dates index it
+        parsed_dates = np.append(parsed_unique_dates, np.datetime64('NaT')).astype(parsed_unique_dates.dtype)[codes]
+        return pd.Series(parsed_dates, index=raw_dates.index, name=raw_dates.name)
+
+    def parse_numbers(self, raw_numbers):
+        '''
+        This function converts a column of numbers containing stray characters to a numeric datatype.
+
+        Characters matched by NON_NUMERIC_PATTERN are removed before conversion, so 'J78' becomes
+        78 and '-0.12752' is kept as it is. Each distinct value is only converted once. Values
+        which still aren't numbers become null.
+
+        Args:
+            raw_numbers: a pandas series of numbers to be converted.
+
+        Returns:
+            numbers: a pandas series of nullable Int64 or Float64 values with the same index as raw_numbers,
+                     or the narrowest nullable integer type (or Float32, if no value changes) when
+                     lean_dtypes is enabled.
+        '''
+        codes, unique_numbers = pd.factorize(raw_numbers)
+        unique_numbers = pd.Series(unique_numbers, dtype='string').str.replace(NON_NUMERIC_PATTERN, '', regex=True)
+        unique_numbers = pd.to_numeric(unique_numbers, errors='coerce')
+        if self.lean_dtypes:
+            # Narrowing the distinct values means the full-length column is built narrow
+            if pd.api.types.is_integer_dtype(unique_numbers):
+                unique_numbers = pd.to_numeric(unique_numbers, downcast='integer')
+            else:
+                unique_numbers = self._float32_if_lossless(unique_numbers)
+        # Nullable arrays fill the -1 codes of null values with <NA>
+        numbers = unique_numbers.array.take(codes, allow_fill=True)
+        return pd.Series(numbers, index=raw_numbers.index, name=raw_numbers.name)
+
+    def shrink_dtypes(self, clean_data, table_name):
+        '''
+        This function reduces the memory used by a cleaned dataframe.
+
+        Columns named in LOW_CARDINALITY_COLUMNS are converted to the category datatype. Integer
+        columns, including nullable ones such as staff_numbers, are downcast to the smallest integer
+        type which holds their values, and float columns are downcast to float32 (or Float32) only
+        when every value survives the round trip, so coordinates and weights keep their values.
+        The memory used before and after is printed.
+
+        Most columns are already narrow by this point, as the cleaning methods parse straight to
+        these types when lean_dtypes is enabled. This makes the cleaned tables smaller, but the
+        peak memory while cleaning is about the same, as it is set by the raw data and the string
+        operations on it.
+
+        DatabaseConnector.upload_to_db maps narrowed columns back to their original SQL types, so
+        the uploaded table's columns are unchanged.
+
+        Args:
+            clean_data: pandas dataframe returned by one of the cleaning methods.
+            table_name: name of the table, used when printing memory usage.
+
+        Returns:
+            clean_data: the same dataframe with narrower column datatypes.
+        '''
+        memory_before = clean_data.memory_usage(deep=True).sum()
+        for col in clean_data.columns:
+            column = clean_data[col]
+            if col in LOW_CARDINALITY_COLUMNS:
+                clean_data[col] = column.astype('category')
+            elif pd.api.types.is_integer_dtype(column):
+                clean_data[col] = pd.to_numeric(column, downcast='integer')
+            elif pd.api.types.is_float_dtype(column):
+                clean_data[col] = self._float32_if_lossless(column)
+        memory_after = clean_data.memory_usage(deep=True).sum()
+        print(f'{table_name} memory usage: {memory_before / 1024 ** 2:.1f} MiB -> {memory_after / 1024 ** 2:.1f} MiB')
+        return clean_data
+
+    def _float32_if_lossless(self, numbers):
+        '''
+        This function narrows floats to float32 (or Float32, for nullable floats), but only if
+        every value is unchanged by the round trip back to 64 bits.
+
+        Args:
+            numbers: a numpy array or pandas series of floats.
+
+        Returns:
+            numbers: the narrowed floats, or the floats as they were if narrowing would change any of them.
+        '''
+        narrowed = numbers.astype('Float32' if pd.api.types.is_extension_array_dtype(numbers) else 'float32')
+        if np.array_equal(pd.Series(narrowed).to_numpy(dtype='float64', na_value=np.nan),
+                          pd.Series(numbers).to_numpy(dtype='float64', na_value=np.nan), equal_nan=True):
+            return narrowed
+        return numbers
+
+    def _string_dtype(self, col):
+        '''
+        This function picks the datatype a string column is parsed to.
+
+        Args:
+            col: name of the column.
+
+        Returns:
+            dtype: 'category' for columns in LOW_CARDINALITY_COLUMNS when lean_dtypes is enabled,
+                   otherwise 'string'.
+        '''
+        if self.lean_dtypes and col in LOW_CARDINALITY_COLUMNS:
+            return 'category'
+        return 'string'
+
+    def clean_chunks(self, clean_method, raw_chunks):
+        '''
+        This function cleans a table one chunk at a time.
+
+        It is used with tables streamed by DataExtractor.stream_rds_table, such as the user data
+        and orders table, so that only one chunk is held in memory at once. Each chunk is passed
+        through clean_method (e.g. clean_orders_data or clean_user_data). Because those methods
+        reset the index of the data they return, each cleaned chunk's index is offset by the
+        number of rows already cleaned so the index stays continuous across chunks.
+
+        Rows are only sorted within their own chunk, so the chunks should be read in index order.
+
+        Args:
+            clean_method: a DataCleaning method which takes in and returns a pandas dataframe.
+            raw_chunks: an iterable of pandas dataframes of raw data.
+
+        Yields:
+            clean_chunk: a pandas dataframe of a cleaned chunk of data.
+        '''
+        rows_cleaned = 0
+        for raw_chunk in raw_chunks:
+            clean_chunk = clean_method(raw_chunk)
+            clean_chunk.index = clean_chunk.index + rows_cleaned
+            rows_cleaned += len(clean_chunk)
+            yield clean_chunk
+
+    def clean_parallel(self, clean_method, raw_data, n_workers=None, chunk_rows=None):
+        '''
+        This function cleans a table by splitting it into chunks of rows and cleaning the chunks
+        in a pool of worker processes, so that every core is used.
+
+        Only the methods in PARALLEL_CLEANING_METHODS can be split up like this. The table is written
+        once to an Arrow IPC file in shared memory (/dev/shm where it exists). Each worker memory-maps
+        the file and reads only the rows of its own chunk, so the table is never pickled and copied
+        to every worker. Cleaned chunks are returned the same way and joined back together in order.
+        Workers are started with the spawn method, so it is safe to call from a thread.
+
+        The result is the same as calling clean_method on the whole table. For methods which sort
+        the table, only the sort order is worked out up front; each worker then gathers its own
+        rows in that order. The index is reset across the whole table for methods which reset it.
+        When lean_dtypes is enabled, shrink_dtypes is applied once to the joined table rather than
+        to each chunk, so that categories are shared by the whole table. Rows quarantined by each
+        worker's apply_rules are joined into self.quarantine, and their rejection counts summed.
+
+        Args:
+            clean_method: a DataCleaning method named in PARALLEL_CLEANING_METHODS, e.g. cleaner.clean_user_data.
+            raw_data: a pandas dataframe of raw data.
+            n_workers: the number of worker processes. Defaults to the number of cores.
+            chunk_rows: the number of rows cleaned by a worker at a time. Defaults to splitting the
+                        rows evenly between the workers. Smaller chunks use less memory per worker,
+                        but distinct values (e.g. dates) are parsed once per chunk.
+
+        Returns:
+            clean_data: a pandas dataframe of the cleaned data.
+        '''
+        method_name = clean_method.__name__
+        if method_name not in PARALLEL_CLEANING_METHODS:
+            raise ValueError(f'Sorry, {method_name} can\'t be run in parallel.\n'
+                             f'Methods which can are: {", ".join(PARALLEL_CLEANING_METHODS)}.')
+        method_options = PARALLEL_CLEANING_METHODS[method_name]
+        n_workers = n_workers or os.cpu_count()
+        chunk_rows = chunk_rows or -(-len(raw_data) // n_workers)
+        if n_workers == 1 or len(raw_data) <= chunk_rows:
+            return clean_method(raw_data)
+        chunk_starts = list(range(0, len(raw_data), chunk_rows))
+        chunk_stops = chunk_starts[1:] + [len(raw_data)]
+        shared_memory_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        with tempfile.TemporaryDirectory(dir=shared_memory_dir) as ipc_dir:
+            raw_path = os.path.join(ipc_dir, 'raw.arrow')
+            _write_arrow_ipc(raw_data, raw_path)
+            order_path = None
+            if method_options['sorts_by_first_column']:
+                order_path = os.path.join(ipc_dir, 'order.npy')
+                np.save(order_path, np.argsort(raw_data[raw_data.columns[0]].to_numpy(), kind='stable'))
+            clean_paths = [os.path.join(ipc_dir, f'clean_{chunk}.arrow') for chunk in range(len(chunk_starts))]
+            num_chunks = len(chunk_starts)
+            # Workers are spawned rather than forked, as this is called from the threads of main.py's
+            # run_stages while other threads may hold locks (connection pools, logging) a fork would copy
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                chunk_results = list(executor.map(_clean_arrow_ipc_rows, [method_name] * num_chunks, [self.backend] * num_chunks,
+                                                  [raw_path] * num_chunks, [order_path] * num_chunks,
+                                                  chunk_starts, chunk_stops, clean_paths))
+            clean_chunks = [_read_arrow_ipc(clean_path) for clean_path, _, _ in chunk_results]
+            table_name = method_options['table_name']
+            if table_name in self.cleaning_rules:
+                self.quarantine[table_name] = pd.concat([_read_arrow_ipc(rejected_path) for _, rejected_path, _ in chunk_results])
+                self.rejection_counts[table_name] = {rule_name: sum(counts[rule_name] for _, _, counts in chunk_results)
+                                                     for rule_name in chunk_results[0][2]}
+        clean_data = pd.concat(clean_chunks, ignore_index=method_options['resets_index'])
+        if self.lean_dtypes and method_options['table_name']:
+            clean_data = self.shrink_dtypes(clean_data, method_options['table_name'])
+        return clean_data
+
+    def show_in_gui(self, dataframe):
+        '''
+        This function opens a dataframe in PandasGUI, which is useful for visually checking data
+        while working out how to clean it.
+
+        PandasGUI loads Qt, so it is only imported when this function is called rather than every
+        time data_cleaning.py is imported.
+
+        Args:
+            dataframe: pandas dataframe to be inspected.
+        '''
+        from pandasgui import show
+        show(dataframe)
+
+
+def _write_arrow_ipc(dataframe, ipc_path):
+    '''
+    This function writes a dataframe, including its index, to an Arrow IPC file.
+
+    Object columns holding a mix of types (e.g. card numbers read as both numbers and text) are
+    stored as strings, as Arrow columns can only have one type.
+    '''
+    import pyarrow as pa
+    dataframe = dataframe.copy(deep=False)
+    for column in dataframe.columns[dataframe.dtypes == object]:
+        if pd.api.types.infer_dtype(dataframe[column], skipna=True) not in ('string', 'empty'):
+            dataframe[column] = dataframe[column].astype('string')
+    # The index is stored as a column so that any subset of the rows keeps its own index
+    table = pa.Table.from_pandas(dataframe, preserve_index=True)
+    with pa.OSFile(ipc_path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def _read_arrow_ipc(ipc_path, rows=None):
+    '''
+    This function memory-maps an Arrow IPC file and returns some or all of its rows as a dataframe.
+
+    Args:
+        ipc_path: path of the Arrow IPC file.
+        rows: a slice of the rows to return, or an array of row positions to gather in order.
+              Defaults to every row.
+    '''
+    import pyarrow as pa
+    with pa.memory_map(ipc_path) as source:
+        table = pa.ipc.open_file(source).read_all()
+        if isinstance(rows, slice):
+            table = table.slice(rows.start, rows.stop - rows.start)
+        elif rows is not None:
+            table = table.take(rows)
+        return table.to_pandas()
+
+
+def _clean_arrow_ipc_rows(method_name, backend, raw_path, order_path, start, stop, clean_path):
+    '''
+    This function cleans a chunk of the rows of an Arrow IPC file and writes the cleaned rows to
+    another Arrow IPC file. Any rows quarantined by the cleaning rules are written to a third.
+
+    It is defined at module level so that it can be sent to worker processes by
+    DataCleaning.clean_parallel.
+
+    Args:
+        method_name: name of the DataCleaning method to clean the rows with.
+        backend: the backend of the DataCleaning object which called clean_parallel.
+        raw_path: path of the Arrow IPC file of raw data.
+        order_path: path of a .npy file of the row positions in sorted order, or None if the
+                    rows are cleaned in the order they are stored.
+        start, stop: the positions of the chunk's first and last (exclusive) rows.
+        clean_path: path of the Arrow IPC file the cleaned rows are written to.
+
+    Returns:
+        clean_path: path of the Arrow IPC file of cleaned rows.
+        rejected_path: path of the Arrow IPC file of quarantined rows, or None if the table has no
+                       cleaning rules.
+        rejection_counts: dict of the number of rows each cleaning rule rejected.
+    '''
+    rows = slice(start, stop) if order_path is None else np.load(order_path, mmap_mode='r')[start:stop]
+    raw_chunk = _read_arrow_ipc(raw_path, rows)
+    cleaner = DataCleaning(backend=backend)
+    clean_chunk = getattr(cleaner, method_name)(raw_chunk)
+    _write_arrow_ipc(clean_chunk, clean_path)
+    table_name = PARALLEL_CLEANING_METHODS[method_name]['table_name']
+    if table_name not in cleaner.quarantine:
+        return clean_path, None, {}
+    rejected_path = clean_path.replace('clean_', 'rejected_')
+    _write_arrow_ipc(cleaner.quarantine[table_name], rejected_path)
+    return clean_path, rejected_path, cleaner.rejection_counts[table_name]
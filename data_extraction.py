@@ -1,11 +1,18 @@
 from sqlalchemy import text
 from sqlalchemy.engine import Engine
 import pandas as pd
-import tabula
-import requests
-import boto3
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import hashlib
+import json
+import multiprocessing
 import os
+import threading
+import time
 import yaml
+from profiling import count_bytes_transferred
+# Source-specific libraries (tabula, requests, boto3, pypdf and pyarrow) are slow to import,
+# so each is imported inside the methods which use it. A stage only pays for the libraries
+# of the sources it reads.
 
 
 class DataExtractor:
@@ -14,15 +21,54 @@ class DataExtractor:
 
     Functions:
         read_rds_table: connects to an RDS table and returns all its data as a pandas dataframe.
+            Key ranges of the table can be read in parallel by setting partitions.
+        _read_partitioned: reads a table as key ranges over several pooled connections at once.
+        stream_rds_table: reads an RDS table through a server-side cursor, yielding dataframe chunks.
+        _select_table_query: builds the query to read a whole table, or only rows past a high-water mark.
         retrieve_pdf_data: reads a PDF file and returns a pandas dataframe of its contents.
+            Pages can be read in parallel by setting max_workers.
         list_number_of_stores: connects to an API endpoint, returning the number of stores in the business.
         retrieve_stores_data: connects to an API endpoint, returning date about all stores in the business.
+            Stores can be fetched concurrently by setting max_workers.
+        get_store_api_client: returns the cached StoreApiClient used for store API requests.
         extract_from_s3: connects to an Amazon S3 bucket and downloads a specified file. Returns
                          a pandas dataframe of the file's content.
+        _download_from_s3: downloads an S3 object into the local cache unless a current copy is cached.
+        get_s3_client: returns the boto3 S3 client shared by every download.
+        _evict_s3_cache: removes the least recently used files once the cache is over its size limit.
+        save_snapshot: saves a raw extract as a compressed Parquet snapshot.
+        load_snapshot: reads a raw extract back from its Parquet snapshot.
+        fingerprint: returns a hash of a raw extract's content, used to tell whether it has changed.
     '''
+    def __init__(self, s3_cache_dir='s3_cache', s3_cache_max_bytes=512 * 1024 ** 2, snapshot_dir='snapshots',
+                 store_api_options=None, s3_client=None):
+        '''
+        This function sets up the local cache used for files downloaded from S3, the
+        directory used for raw extract snapshots and the options of the store API client.
+
+        Args:
+            s3_cache_dir: directory in which downloaded S3 objects are cached.
+            s3_cache_max_bytes: the maximum total size of the cache before old files are evicted.
+            snapshot_dir: directory in which raw extracts are saved by save_snapshot.
+            store_api_options: optional dict of keyword arguments for StoreApiClient, such as
+                               requests_per_second, cache_ttl or cache_dir.
+            s3_client: optional boto3 S3 client used for downloads, e.g. one wrapped in a botocore
+                       Stubber. Defaults to a client created on first use.
+        '''
+        self.store_api_options = store_api_options or {}
+        self.store_api_clients = {}
+        self._store_api_lock = threading.Lock()
+        self.snapshot_dir = os.path.abspath(snapshot_dir)
+        self.s3_cache_dir = os.path.abspath(s3_cache_dir)
+        self.s3_cache_max_bytes = s3_cache_max_bytes
+        self.s3_cache_stats = {'hits': 0, 'misses': 0, 'bytes_saved': 0}
+        self._s3_cache_lock = threading.Lock()
+        self.s3_client = s3_client
+
     # Takes engine and table as arguments, returns table contents as a Pandas Dataframe
     # returns this dataframe to main.py
-    def read_rds_table(self, engine: Engine, chosen_table):
+    def read_rds_table(self, engine: Engine, chosen_table, chunk_size=None, after_index=None, partitions=1,
+                       partition_column='index'):
         '''
         This function retrieves a table and returns it as a pandas dataframe.
 
@@ -30,40 +76,204 @@ class DataExtractor:
         the table for all of its contents. This generates a pandas dataframe which
         is returned to main.py.
 
+        If a chunk_size is given, the table is instead streamed through a server-side
+        cursor by stream_rds_table and a generator of dataframes is returned, so only
+        one chunk of rows is held in memory at a time.
+
+        If after_index is given, only rows with an 'index' greater than it are read. This
+        is used to extract just the rows added since the last incremental load.
+
+        If partitions is more than 1, the table is split into that many ranges of
+        partition_column, which are read at the same time over separate connections from the
+        engine's pool (see _read_partitioned). A single large table is then no longer limited
+        to the throughput of one connection.
+
         Args:
             engine: SQLAlchemy engine returned from the DatabaseConnector.init_db_engine function
             chosen_table: table name index from the list of tables returned from
                           DatabaseConnector.list_db_tables.
+            chunk_size: optional number of rows per chunk. Defaults to None, which reads
+                        the whole table at once.
+            after_index: optional high-water mark. Only rows with a greater 'index' are read.
+            partitions: the number of key ranges read in parallel. Defaults to 1, a single query.
+            partition_column: integer column the table is split on. Defaults to 'index'.
        
         Returns:
-            table_result: a pandas dataframe of the table's contents.
+            table_result: a pandas dataframe of the table's contents, or a generator of
+                          dataframes if chunk_size was given.
         '''
+        if chunk_size is not None:
+            return self.stream_rds_table(engine, chosen_table, chunk_size, after_index)
+        if partitions > 1:
+            return self._read_partitioned(engine, chosen_table, partitions, partition_column, after_index)
         with engine.connect() as conn:
-            result = conn.execute(text(f"SELECT * FROM {chosen_table}"))
-            table_result = pd.DataFrame(result)
+            result = conn.execute(*self._select_table_query(chosen_table, after_index))
+            table_result = pd.DataFrame(result.fetchall(), columns=list(result.keys()))
             return table_result
+
+    def _read_partitioned(self, engine: Engine, chosen_table, partitions, partition_column='index', after_index=None):
+        '''
+        This function reads a table as a number of key ranges at the same time.
+
+        The smallest and largest values of partition_column are looked up first, and the range
+        between them is split into equal parts. Each part is read, in partition_column order, by
+        its own thread using a connection from the engine's pool. The parts are then joined in
+        order. Rows where partition_column is null are read with the first part.
+
+        The engine's pool should allow as many connections as there are partitions (pool_size
+        plus max_overflow in DatabaseConnector), or threads wait for a connection to be free.
+
+        Args:
+            engine: SQLAlchemy engine returned from the DatabaseConnector.init_db_engine function
+            chosen_table: name of the table to be read.
+            partitions: the number of key ranges the table is split into.
+            partition_column: integer column the table is split on.
+            after_index: optional high-water mark. Only rows with a greater 'index' are read.
+
+        Returns:
+            table_result: a pandas dataframe of the table's contents.
+        '''
+        # A high-water mark narrows the range split into partitions as well as the rows read
+        after_condition = ' AND "index" > :after_index' if after_index is not None else ''
+        params = {'after_index': int(after_index)} if after_index is not None else {}
+        with engine.connect() as conn:
+            low, high = conn.execute(text(f'SELECT MIN("{partition_column}"), MAX("{partition_column}") '
+                                          f'FROM {chosen_table} WHERE TRUE{after_condition}'), params).one()
+        if low is None:
+            return self.read_rds_table(engine, chosen_table, after_index=after_index)
+        step = -(-(int(high) - int(low) + 1) // partitions)
+        bounds = [(start, start + step) for start in range(int(low), int(high) + 1, step)]
+
+        def read_partition(partition):
+            start, stop = partition
+            condition = f'"{partition_column}" >= :start AND "{partition_column}" < :stop'
+            if start == low:
+                condition = f'({condition} OR "{partition_column}" IS NULL)'
+            query = text(f'SELECT * FROM {chosen_table} WHERE {condition}{after_condition} ORDER BY "{partition_column}"')
+            with engine.connect() as conn:
+                result = conn.execute(query, {**params, 'start': start, 'stop': stop})
+                return pd.DataFrame(result.fetchall(), columns=list(result.keys()))
+
+        # executor.map yields results in submission order, keeping the ranges in order
+        with ThreadPoolExecutor(max_workers=len(bounds)) as executor:
+            return pd.concat(executor.map(read_partition, bounds), ignore_index=True)
+
+    def stream_rds_table(self, engine: Engine, chosen_table, chunk_size=50000, after_index=None):
+        '''
+        This function streams a table from an RDS as a series of pandas dataframes.
+
+        The query is executed with stream_results enabled so that rows are fetched from
+        a server-side cursor in batches of chunk_size, rather than being loaded into
+        memory all at once. The connection stays open until the generator is exhausted
+        or closed.
+
+        Rows are read in 'index' order, so each chunk holds the same rows on every run and
+        cleaning the chunks one at a time (see DataCleaning.clean_chunks) gives the same
+        result as cleaning the whole table.
+
+        Args:
+            engine: SQLAlchemy engine returned from the DatabaseConnector.init_db_engine function
+            chosen_table: name of the table to be read.
+            chunk_size: number of rows in each dataframe chunk.
+            after_index: optional high-water mark. Only rows with a greater 'index' are read.
+
+        Yields:
+            table_chunk: a pandas dataframe of up to chunk_size rows of the table.
+        '''
+        with engine.connect() as conn:
+            conn = conn.execution_options(stream_results=True, yield_per=chunk_size)
+            result = conn.execute(*self._select_table_query(chosen_table, after_index))
+            columns = list(result.keys())
+            # The size is passed as well, as drivers without server-side cursors (e.g. SQLite) ignore yield_per
+            for partition in result.partitions(chunk_size):
+                yield pd.DataFrame(partition, columns=columns)
+
+    def _select_table_query(self, chosen_table, after_index=None):
+        '''
+        This function builds the query used to read a table from an RDS.
+
+        Rows are selected in 'index' order, so a full read and a streamed read return them in
+        the same order.
+
+        Args:
+            chosen_table: name of the table to be read.
+            after_index: optional high-water mark. If given, only rows with a greater 'index'
+                         are selected.
+
+        Returns:
+            (query, params): the SQLAlchemy text query and its bound parameters.
+        '''
+        if after_index is None:
+            return text(f'SELECT * FROM {chosen_table} ORDER BY "index"'), {}
+        query = text(f'SELECT * FROM {chosen_table} WHERE "index" > :after_index ORDER BY "index"')
+        return query, {'after_index': int(after_index)}
         
-    def retrieve_pdf_data(self, link):
+    def retrieve_pdf_data(self, link, max_workers=1):
         '''
         This function reads a PDF document and returns a pandas dataframe of its contents.
 
-        This function uses Tabula to read a PDF from a link. All pages are returned as a
-        separate pandas dataframe. Once all pages have been read, the dataframes are
-        concatenated together.
+        A HEAD request gets the PDF's ETag (or Last-Modified date), and the PDF and the dataframe
+        parsed from it are cached under a hash of the link and that version. If this version has
+        been read before, the cached dataframe is returned without downloading the PDF. If the
+        server sends neither header, the PDF is downloaded and cached under a hash of its contents.
+
+        Otherwise, Tabula is used to read the PDF. When max_workers is greater than 1, the pages
+        are split into contiguous ranges which are read in parallel worker processes. Each worker
+        keeps its own JVM running between ranges when tabula's jpype mode is available. Workers
+        are spawned rather than forked, as this is called from the threads of main.py's stage
+        runner and forking a process with other threads running can deadlock the child. The
+        dataframes of every page are then concatenated together once, in page order.
 
         Args:
             link: a URL link to the PDF document.
+            max_workers: the number of processes reading pages at the same time. Defaults to 1.
         Returns:
             raw_card_data: a pandas dataframe containing all of the data from each
                            page of the document.
         '''
+        import requests
+        pdf_head = requests.head(link, timeout=60, allow_redirects=True)
+        pdf_head.raise_for_status()
+        pdf_version = pdf_head.headers.get('ETag') or pdf_head.headers.get('Last-Modified')
+        pdf_response = None
+        if pdf_version:
+            pdf_hash = hashlib.sha256(f'{link}/{pdf_version}'.encode()).hexdigest()
+        else:
+            # Without a version header the PDF has to be downloaded to tell whether it has changed
+            pdf_response = requests.get(link, timeout=60)
+            pdf_response.raise_for_status()
+            count_bytes_transferred(len(pdf_response.content))
+            pdf_hash = hashlib.sha256(pdf_response.content).hexdigest()
+        os.makedirs(self.s3_cache_dir, exist_ok=True)
+        pdf_path = os.path.join(self.s3_cache_dir, f'{pdf_hash}.pdf')
+        parsed_path = os.path.join(self.s3_cache_dir, f'{pdf_hash}.pdf.pkl')
+        if pdf_response is None:
+            # Nothing has been downloaded yet; counted so a cached PDF records 0 bytes
+            count_bytes_transferred(0)
+        if os.path.exists(parsed_path):
+            return pd.read_pickle(parsed_path)
+        if not os.path.exists(pdf_path):
+            if pdf_response is None:
+                pdf_response = requests.get(link, timeout=60)
+                pdf_response.raise_for_status()
+                count_bytes_transferred(len(pdf_response.content))
+            with open(pdf_path, 'wb') as pdf_file:
+                pdf_file.write(pdf_response.content)
         # Creates dataframes from a pdf. Returns a dataframe for each page.
-        raw_card_data = tabula.read_pdf(link, pages='all')
-        # Concats the serparate dataframes together and returns dataframe to main.py
-        list_of_dfs = []
-        for df in raw_card_data:
-            list_of_dfs.append(df)
-        raw_card_data = pd.concat(list_of_dfs)
+        if max_workers > 1:
+            from pypdf import PdfReader
+            num_pages = len(PdfReader(pdf_path).pages)
+            pages_per_range = -(-num_pages // max_workers)
+            page_ranges = [f'{first}-{min(first + pages_per_range - 1, num_pages)}'
+                           for first in range(1, num_pages + 1, pages_per_range)]
+            with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+                list_of_dfs = [df for range_dfs in executor.map(_read_pdf_pages, [pdf_path] * len(page_ranges), page_ranges)
+                               for df in range_dfs]
+        else:
+            list_of_dfs = _read_pdf_pages(pdf_path, 'all')
+        # Concats the separate dataframes together and returns dataframe to main.py
+        raw_card_data = pd.concat(list_of_dfs, ignore_index=True)
+        raw_card_data.to_pickle(parsed_path)
         return raw_card_data
 
     def list_number_of_stores(self,num_stores_endpoint, key_header):
@@ -73,20 +283,23 @@ class DataExtractor:
         The function sends a get request endpoint of an API which returns a response
         with the number of stores in the business. This is returned in JSON form.
 
+        The request is sent by the StoreApiClient returned from get_store_api_client, so the
+        API key file is only read once and its connection is reused by retrieve_stores_data.
+
         Args:
             num_stores_endpoint: a link to the API which returns the number of stores.
-            api_key_header: a dictionary containing the API key to authenticate the API
-                         transaction.
+            key_header: a dictionary containing the API key to authenticate the API
+                        transaction, or the path of the YAML file it is stored in.
         Returns:
             num_stores: a JSON response listing the number of stores in the business.
         '''
-        with open(key_header, 'r') as api_key_header_file:
-            api_key_header = yaml.safe_load(api_key_header_file)
-        num_stores_response = requests.get(num_stores_endpoint, headers=api_key_header)
-        num_stores = num_stores_response.json()['number_stores']
+        client = self.get_store_api_client(key_header)
+        bytes_downloaded = client.stats['bytes_downloaded']
+        num_stores = client.get_number_of_stores(num_stores_endpoint)
+        count_bytes_transferred(client.stats['bytes_downloaded'] - bytes_downloaded)
         return num_stores
     
-    def retrieve_stores_data(self, retrieve_store_endpoint_base, api_key_header, num_stores):
+    def retrieve_stores_data(self, retrieve_store_endpoint_base, api_key_header, num_stores, max_workers=1):
         '''
         This function retrieves data for each store and returns it as a pandas dataframe.
 
@@ -94,22 +307,48 @@ class DataExtractor:
         in the business, each request returning a dataframe. Once all requests are made, the 
         returned dataframes are concatenated together.
 
-        Due to the number of requests being made, this function can take a few minutes to complete.
+        Requests are sent by the StoreApiClient returned from get_store_api_client, which
+        reuses one keep-alive session, respects the requests-per-second budget and only
+        downloads stores whose details have changed since they were cached. When max_workers
+        is greater than 1, stores are fetched concurrently. Responses are collected in store
+        order, so the returned dataframe is the same whichever mode is used.
 
         Args:
             retrieve_store_endpoint_base: this is a partial endpoint url. A number representing
                                           a store is added on for each request being made.
+            api_key_header: a dictionary containing the API key to authenticate the API
+                            transaction, or the path of the YAML file it is stored in.
+            num_stores: the number of stores returned from list_number_of_stores.
+            max_workers: the number of stores to fetch at the same time. Defaults to 1 (serial).
         
         Returns:
             store_data: a pandas dataframe containing the data for each store in the business.
         '''
-        store_data_response_list= []
-        for store in range(num_stores):
-            retrieve_store_endpoint = retrieve_store_endpoint_base + str(store)
-            store_data_response = requests.get(retrieve_store_endpoint, headers=api_key_header)
-            store_data_response_list.append(store_data_response.json())
+        client = self.get_store_api_client(api_key_header)
+        # Stores are fetched in the client's own threads, so the bytes they download are counted here
+        bytes_downloaded = client.stats['bytes_downloaded']
+        store_data_response_list = client.get_stores(retrieve_store_endpoint_base, num_stores, max_workers)
+        count_bytes_transferred(client.stats['bytes_downloaded'] - bytes_downloaded)
         store_data = pd.DataFrame.from_records(store_data_response_list, index= 'index') 
         return store_data
+
+    def get_store_api_client(self, api_key_header):
+        '''
+        This function returns the StoreApiClient for an API key, creating it on first use.
+
+        Args:
+            api_key_header: a dictionary containing the API key, or the path of the YAML file it
+                            is stored in.
+
+        Returns:
+            store_api_client: a StoreApiClient created with the store_api_options given to DataExtractor.
+        '''
+        from store_api import StoreApiClient
+        client_key = api_key_header if isinstance(api_key_header, str) else yaml.safe_dump(api_key_header)
+        with self._store_api_lock:
+            if client_key not in self.store_api_clients:
+                self.store_api_clients[client_key] = StoreApiClient(api_key_header, **self.store_api_options)
+            return self.store_api_clients[client_key]
     
     def extract_from_s3(self, s3_address):
         '''
@@ -117,10 +356,8 @@ class DataExtractor:
 
         The function takes the URL of the file and uses the string.split() function to
         separate the bucket and file name portions of the URL. These portions are supplied to
-        the s3.download_file() function to locate the file to be downloaded.
-
-        The os module is used to access Python's current working directory so that the file save
-        path can be supplied to the s3.download_file() function.
+        _download_from_s3, which only downloads the file if the local cache doesn't already hold
+        the current version of it.
 
         If the file is of CSV or JSON format, it is returned as a pandas dataframe.
 
@@ -130,19 +367,186 @@ class DataExtractor:
         Returns:
             raw_s3_details: a pandas dataframe of the downloaded file.
         '''
-        # Downloads s3 file into current working directory (cwd)
         s3_address = s3_address.split('/')
-        cwd = os.getcwd()
-        save_path = "/".join((cwd, s3_address[-1]))
         file_type = s3_address[-1].split('.')[-1]
-        s3 = boto3.client('s3')
-        s3.download_file(s3_address[-2], s3_address[-1], save_path)
-        # Checks if downloaded file is .csv or .json and returns it as a dataframe.
-        # Dataframe is then returned to main.py 
+        if file_type not in ('csv', 'json'):
+            raise TypeError(f'Sorry, {file_type} file types are not accepted by this function.\nThis function only works with .csv and .json file types.')
+        save_path = self._download_from_s3(s3_address[-2], s3_address[-1])
+        # Reads the cached file as a dataframe. Dataframe is then returned to main.py
         if file_type == 'csv':
-            raw_s3_details = pd.read_csv(s3_address[-1], index_col=0)
-        elif file_type == 'json':
-            raw_s3_details = pd.read_json(s3_address[-1])
+            raw_s3_details = pd.read_csv(save_path, index_col=0)
         else:
-            raise TypeError(f'Sorry, {file_type} file types are not accepted by this function.\nThis function only works with .csv and .json file types.')
-        return raw_s3_details
\ No newline at end of file
+            raw_s3_details = pd.read_json(save_path)
+        return raw_s3_details
+
+    def _download_from_s3(self, bucket, key):
+        '''
+        This function downloads an S3 object into the local cache and returns its path.
+
+        A HEAD request gets the object's ETag, and the cached file is named after a hash of the
+        bucket, key and ETag. If that file already exists the object hasn't changed since it was
+        cached, so the download is skipped. Otherwise the object is downloaded and the cache is
+        trimmed back under its size limit. Hits, misses and bytes saved are counted in
+        s3_cache_stats.
+
+        Args:
+            bucket: name of the S3 bucket.
+            key: key of the object in the bucket.
+
+        Returns:
+            save_path: absolute path of the cached copy of the object.
+        '''
+        s3 = self.get_s3_client()
+        head = s3.head_object(Bucket=bucket, Key=key)
+        cache_key = hashlib.sha256(f"{bucket}/{key}/{head['ETag']}".encode()).hexdigest()
+        save_path = os.path.join(self.s3_cache_dir, f"{cache_key}.{key.split('.')[-1]}")
+        if os.path.exists(save_path):
+            # Touching the file marks it as recently used for eviction
+            os.utime(save_path)
+            with self._s3_cache_lock:
+                self.s3_cache_stats['hits'] += 1
+                self.s3_cache_stats['bytes_saved'] += head['ContentLength']
+            count_bytes_transferred(0)
+            return save_path
+        os.makedirs(self.s3_cache_dir, exist_ok=True)
+        # Downloads to a temporary file first so a failed download never looks like a cache hit
+        temp_path = f'{save_path}.{threading.get_ident()}.part'
+        s3.download_file(bucket, key, temp_path)
+        count_bytes_transferred(os.path.getsize(temp_path))
+        os.replace(temp_path, save_path)
+        with self._s3_cache_lock:
+            self.s3_cache_stats['misses'] += 1
+            self._evict_s3_cache(keep=save_path)
+        return save_path
+
+    def get_s3_client(self):
+        '''
+        This function returns the S3 client used for downloads, creating it on first use.
+
+        boto3 clients can be shared between threads, but creating them from the default session
+        is not thread-safe, so one client is created under a lock and reused by every stage.
+
+        Returns:
+            s3_client: a boto3 S3 client.
+        '''
+        with self._s3_cache_lock:
+            if self.s3_client is None:
+                import boto3
+                self.s3_client = boto3.client('s3')
+            return self.s3_client
+
+    def _evict_s3_cache(self, keep=None):
+        '''
+        This function deletes the least recently used files from the S3 cache until its total
+        size is within s3_cache_max_bytes.
+
+        Args:
+            keep: path of a file which should never be evicted, such as the file just downloaded.
+        '''
+        cached_files = [entry for entry in os.scandir(self.s3_cache_dir)
+                        if entry.is_file() and not entry.name.endswith('.part')]
+        cache_size = sum(entry.stat().st_size for entry in cached_files)
+        for entry in sorted(cached_files, key=lambda entry: entry.stat().st_mtime):
+            if cache_size <= self.s3_cache_max_bytes:
+                break
+            if entry.path == keep:
+                continue
+            cache_size -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def save_snapshot(self, raw_data, name, source):
+        '''
+        This function saves a raw extract as a zstd-compressed Parquet snapshot.
+
+        The snapshot's metadata records the source the data was extracted from, when it was
+        fetched and the pandas dtypes of its columns. Object columns holding a mix of types
+        (e.g. numbers and text read from a PDF) are stored as strings, as Parquet columns can
+        only have one type.
+
+        Args:
+            raw_data: pandas dataframe of raw extracted data.
+            name: name of the snapshot, e.g. 'raw_user_data'.
+            source: description of where the data came from, e.g. a table name or URL.
+
+        Returns:
+            snapshot_path: path of the saved snapshot.
+        '''
+        raw_data = raw_data.copy(deep=False)
+        for column in raw_data.columns[raw_data.dtypes == object]:
+            if pd.api.types.infer_dtype(raw_data[column], skipna=True) not in ('string', 'empty'):
+                raw_data[column] = raw_data[column].astype('string')
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        table = pa.Table.from_pandas(raw_data)
+        snapshot_metadata = {'source': source, 'fetched_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                             'dtypes': {str(column): str(dtype) for column, dtype in raw_data.dtypes.items()}}
+        table = table.replace_schema_metadata({**table.schema.metadata,
+                                               b'snapshot': json.dumps(snapshot_metadata).encode()})
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        snapshot_path = os.path.join(self.snapshot_dir, f'{name}.parquet')
+        pq.write_table(table, snapshot_path, compression='zstd')
+        return snapshot_path
+
+    def load_snapshot(self, name):
+        '''
+        This function reads a raw extract back from the snapshot saved by save_snapshot.
+
+        The Parquet file is memory-mapped and converted into a dataframe with pyarrow-backed
+        dtypes, so column data is not copied into numpy arrays.
+
+        Args:
+            name: name of the snapshot, e.g. 'raw_user_data'.
+
+        Returns:
+            raw_data: pandas dataframe of the raw extracted data.
+            snapshot_metadata: dict of the snapshot's source, fetch time and dtypes.
+        '''
+        snapshot_path = os.path.join(self.snapshot_dir, f'{name}.parquet')
+        if not os.path.exists(snapshot_path):
+            raise FileNotFoundError(f'Sorry, there is no {name} snapshot to replay.\nRun this stage without replaying first.')
+        import pyarrow.parquet as pq
+        table = pq.read_table(snapshot_path, memory_map=True)
+        snapshot_metadata = json.loads(table.schema.metadata[b'snapshot'])
+        raw_data = table.to_pandas(types_mapper=pd.ArrowDtype)
+        return raw_data, snapshot_metadata
+
+    def fingerprint(self, raw_data, chunk_rows=1_000_000):
+        '''
+        This function returns a fingerprint of a raw extract's content.
+
+        Each row (along with its index) is hashed by pandas' hash_pandas_object, a chunk of rows
+        at a time, and the row hashes are fed in order into a BLAKE2 digest along with the column
+        names. Extracts with the same rows in the same order have the same fingerprint, so
+        comparing it with the fingerprint of the last load tells whether a table has changed.
+
+        Args:
+            raw_data: pandas dataframe of raw extracted data.
+            chunk_rows: the number of rows hashed at a time, limiting the memory used.
+
+        Returns:
+            fingerprint: a hex string of the extract's fingerprint.
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(json.dumps([str(column) for column in raw_data.columns]).encode())
+        for start in range(0, len(raw_data), chunk_rows):
+            row_hashes = pd.util.hash_pandas_object(raw_data.iloc[start:start + chunk_rows], index=True)
+            digest.update(row_hashes.to_numpy().tobytes())
+        return digest.hexdigest()
+
+
+def _read_pdf_pages(pdf_path, pages):
+    '''
+    This function reads the tables on a range of pages of a PDF with Tabula.
+
+    It is defined at module level so that it can be sent to worker processes by
+    DataExtractor.retrieve_pdf_data.
+
+    Args:
+        pdf_path: path of the PDF document.
+        pages: the pages to read, e.g. '1-20' or 'all'.
+
+    Returns:
+        list of pandas dataframes, one for each page.
+    '''
+    import tabula
+    return tabula.read_pdf(pdf_path, pages=pages)
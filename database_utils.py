@@ -1,69 +1,940 @@
+import atexit
+import csv
+import io
+import threading
+from contextlib import nullcontext
 import yaml
 from sqlalchemy.engine import Engine
 from sqlalchemy import create_engine
 from sqlalchemy import inspect
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.types import BigInteger, Date, Float, SmallInteger, Uuid, VARCHAR
 from pandas import DataFrame
+from pandas import read_sql
+from pandas.util import hash_pandas_object
+
+# Schema of each table in the sales_data database, applied by upload_to_db:
+#   columns: column name -> SQL type. VARCHAR without a length is sized from the data loaded.
+#            Columns not listed keep the type pandas gives them.
+#   primary_key: column made the primary key once the rows are loaded.
+#   foreign_keys: column -> (table, column) it references, added by create_foreign_keys.
+#   indexes: columns indexed once the rows are loaded.
+TABLE_SCHEMAS = {
+    'dim_users': {
+        'columns': {'first_name': VARCHAR(255), 'last_name': VARCHAR(255), 'date_of_birth': Date(),
+                    'country_code': VARCHAR, 'user_uuid': Uuid(as_uuid=False), 'join_date': Date()},
+        'primary_key': 'user_uuid',
+    },
+    'dim_card_details': {
+        'columns': {'card_number': VARCHAR, 'expiry_date': VARCHAR},
+        'primary_key': 'card_number',
+    },
+    'dim_store_details': {
+        'columns': {'longitude': Float(precision=53), 'latitude': Float(precision=53), 'locality': VARCHAR(255),
+                    'store_code': VARCHAR, 'opening_date': Date(), 'store_type': VARCHAR(255),
+                    'country_code': VARCHAR, 'continent': VARCHAR(255)},
+        'primary_key': 'store_code',
+    },
+    'dim_products': {
+        'columns': {'product_price': Float(precision=53), 'weight': Float(precision=53), 'EAN': VARCHAR,
+                    'product_code': VARCHAR, 'date_added': Date(), 'uuid': Uuid(as_uuid=False), 'removed': VARCHAR},
+        'primary_key': 'product_code',
+    },
+    'dim_date_times': {
+        'columns': {'month': SmallInteger(), 'year': SmallInteger(), 'day': SmallInteger(),
+                    'time_period': VARCHAR, 'date_uuid': Uuid(as_uuid=False)},
+        'primary_key': 'date_uuid',
+    },
+    'orders_table': {
+        'columns': {'date_uuid': Uuid(as_uuid=False), 'user_uuid': Uuid(as_uuid=False), 'card_number': VARCHAR,
+                    'store_code': VARCHAR, 'product_code': VARCHAR, 'product_quantity': SmallInteger()},
+        'foreign_keys': {'date_uuid': ('dim_date_times', 'date_uuid'), 'user_uuid': ('dim_users', 'user_uuid'),
+                         'card_number': ('dim_card_details', 'card_number'),
+                         'store_code': ('dim_store_details', 'store_code'),
+                         'product_code': ('dim_products', 'product_code')},
+        'indexes': ['date_uuid', 'user_uuid', 'card_number', 'store_code', 'product_code'],
+    },
+}
+# Summary tables answering the business questions in Milestone_4_Queries.zip: name -> query
+# materialised into the table. The queries keep every row rather than the top few, so a
+# dashboard can order and limit them as it needs.
+SUMMARY_TABLES = {
+    'summary_stores_by_country': """
+        SELECT country_code AS country, COUNT(country_code) AS total_no_stores
+        FROM dim_store_details
+        WHERE country_code != 'N/A'
+        GROUP BY country_code""",
+    'summary_stores_by_locality': """
+        SELECT locality, COUNT(locality) AS total_no_stores
+        FROM dim_store_details
+        WHERE country_code != 'N/A'
+        GROUP BY locality""",
+    'summary_sales_by_month': """
+        SELECT ROUND(SUM(products.product_price * orders.product_quantity)::numeric, 2) AS total_sales,
+               dates.month
+        FROM orders_table orders
+        JOIN dim_products products ON products.product_code = orders.product_code
+        JOIN dim_date_times dates ON dates.date_uuid = orders.date_uuid
+        GROUP BY dates.month""",
+    'summary_sales_by_location': """
+        SELECT COUNT(*) AS number_of_sales,
+               SUM(orders.product_quantity) AS product_quantity_count,
+               CASE WHEN store.store_type = 'Web Portal' THEN 'Web' ELSE 'Offline' END AS location
+        FROM orders_table orders
+        JOIN dim_store_details store ON store.store_code = orders.store_code
+        GROUP BY location""",
+    'summary_sales_by_store_type': """
+        SELECT store.store_type,
+               ROUND(SUM(products.product_price * orders.product_quantity)::numeric, 2) AS total_sales,
+               ROUND((SUM(products.product_price * orders.product_quantity) / (
+                   SELECT SUM(dim_products.product_price * orders_table.product_quantity)
+                   FROM orders_table
+                   JOIN dim_products ON dim_products.product_code = orders_table.product_code
+               ) * 100)::numeric, 2) AS percentage_total
+        FROM orders_table orders
+        JOIN dim_products products ON products.product_code = orders.product_code
+        JOIN dim_store_details store ON store.store_code = orders.store_code
+        GROUP BY store.store_type""",
+    'summary_sales_by_year_month': """
+        SELECT ROUND(SUM(products.product_price * orders.product_quantity)::numeric, 2) AS total_sales,
+               dates.year,
+               dates.month
+        FROM orders_table orders
+        JOIN dim_products products ON products.product_code = orders.product_code
+        JOIN dim_date_times dates ON dates.date_uuid = orders.date_uuid
+        GROUP BY dates.year, dates.month""",
+    'summary_staff_by_country': """
+        SELECT SUM(staff_numbers) AS total_staff_numbers,
+               CASE WHEN country_code = 'N/A' THEN 'GB' ELSE country_code END AS country
+        FROM dim_store_details
+        GROUP BY country""",
+    'summary_sales_by_country_store_type': """
+        SELECT ROUND(SUM(products.product_price * orders.product_quantity)::numeric, 2) AS total_sales,
+               store.store_type,
+               store.country_code
+        FROM dim_store_details store
+        JOIN orders_table orders ON orders.store_code = store.store_code
+        JOIN dim_products products ON products.product_code = orders.product_code
+        GROUP BY store.country_code, store.store_type""",
+    'summary_time_between_sales': """
+        WITH sale_times AS (
+            SELECT year, MAKE_DATE(year::int, month::int, day::int) + "timestamp" AS datetimes
+            FROM dim_date_times
+        ), time_differences AS (
+            SELECT year, datetimes - LEAD(datetimes, 1) OVER (ORDER BY datetimes DESC) AS time_difference
+            FROM sale_times
+        )
+        SELECT year,
+               AVG(time_difference) AS time_interval,
+               CONCAT('"hours": ', EXTRACT(HOUR FROM AVG(time_difference)), ',',
+                      '"minutes": ', EXTRACT(MINUTE FROM AVG(time_difference)), ',',
+                      '"seconds": ', EXTRACT(SECOND FROM AVG(time_difference)), ',',
+                      '"milliseconds": ', EXTRACT(MILLISECOND FROM AVG(time_difference))) AS actual_time_taken
+        FROM time_differences
+        GROUP BY year""",
+}
+# Orders aggregated by every dimension column the sales summaries group by, materialised into
+# summary_order_totals. The dimensions are left joined, with flags recording which of them
+# matched, so each sales summary can keep exactly the orders its own inner joins would. Only
+# orders past after_index are aggregated, so new orders can be added to the totals on their own.
+ORDER_TOTALS_QUERY = """
+    SELECT products.product_code IS NOT NULL AS has_product,
+           store.store_code IS NOT NULL AS has_store,
+           dates.date_uuid IS NOT NULL AS has_date,
+           store.store_type,
+           store.country_code,
+           dates.year,
+           dates.month,
+           COUNT(*) AS number_of_sales,
+           SUM(orders.product_quantity) AS product_quantity,
+           SUM(products.product_price * orders.product_quantity) AS sales
+    FROM orders_table orders
+    LEFT JOIN dim_products products ON products.product_code = orders.product_code
+    LEFT JOIN dim_store_details store ON store.store_code = orders.store_code
+    LEFT JOIN dim_date_times dates ON dates.date_uuid = orders.date_uuid
+    WHERE orders."index" > :after_index
+    GROUP BY 1, 2, 3, 4, 5, 6, 7"""
+# Tables read by ORDER_TOTALS_QUERY. Replacing one, or updating or deleting its rows, means the
+# totals have to be rebuilt from the whole orders table.
+ORDER_TOTALS_SOURCES = ['orders_table', 'dim_products', 'dim_store_details', 'dim_date_times']
+# The summaries in SUMMARY_TABLES which read the orders table, built from summary_order_totals
+# instead. Each gives the same answer as its query in SUMMARY_TABLES.
+ORDER_SUMMARY_TABLES = {
+    'summary_sales_by_month': """
+        SELECT ROUND(SUM(sales)::numeric, 2) AS total_sales, month
+        FROM summary_order_totals
+        WHERE has_product AND has_date
+        GROUP BY month""",
+    'summary_sales_by_location': """
+        SELECT SUM(number_of_sales)::bigint AS number_of_sales,
+               SUM(product_quantity)::bigint AS product_quantity_count,
+               CASE WHEN store_type = 'Web Portal' THEN 'Web' ELSE 'Offline' END AS location
+        FROM summary_order_totals
+        WHERE has_store
+        GROUP BY location""",
+    'summary_sales_by_store_type': """
+        SELECT store_type,
+               ROUND(SUM(sales)::numeric, 2) AS total_sales,
+               ROUND((SUM(sales) / (
+                   SELECT SUM(sales) FROM summary_order_totals WHERE has_product
+               ) * 100)::numeric, 2) AS percentage_total
+        FROM summary_order_totals
+        WHERE has_product AND has_store
+        GROUP BY store_type""",
+    'summary_sales_by_year_month': """
+        SELECT ROUND(SUM(sales)::numeric, 2) AS total_sales, year, month
+        FROM summary_order_totals
+        WHERE has_product AND has_date
+        GROUP BY year, month""",
+    'summary_sales_by_country_store_type': """
+        SELECT ROUND(SUM(sales)::numeric, 2) AS total_sales, store_type, country_code
+        FROM summary_order_totals
+        WHERE has_store AND has_product
+        GROUP BY country_code, store_type""",
+}
 
 
 class DatabaseConnector:
     '''
     This class provides functionality to interact with databases.
 
+    Engines are kept in a registry keyed by their connection URL, so each database gets a single
+    pooled engine per run no matter how many times init_db_engine is called. Credentials files
+    and table listings are also cached. All engines are disposed of when the process exits.
+
+    Tables named in the schema spec (TABLE_SCHEMAS by default) are created with its column types,
+    loaded, and then given their primary key and indexes, so each load produces the full star schema.
+
     Functions:
         read_db_creds: reads the credentials of a database from a YAML file.
         init_db_engine: creates an SQLAlchemy engine object for connecting to a database.
+        get_engine: returns the engine for a credentials file.
+        dispose_engines: closes the connection pools of all cached engines.
         list_db_tables: lists the tables in a database.
         upload_to_db: uploads data to a target database.
+        upload_chunks: uploads a table to a target database one chunk at a time.
+        read_watermark: reads the high-water mark recorded for a table's last incremental load.
+        write_watermark: records the high-water mark of a table's latest load.
+        read_fingerprint: reads the fingerprint of the raw data a table was last loaded from.
+        write_fingerprint: records the fingerprint of the raw data a table was loaded from.
+        upload_changes: applies the rows which differ from a table's last load as inserts, updates and deletes.
+        create_indexes: builds the primary keys and indexes in the schema spec for tables already loaded.
+        create_foreign_keys: adds the foreign keys in the schema spec once all the tables are loaded.
+        refresh_summary_tables: brings the summary tables of the business queries up to date.
+        _widened_sql_types: maps columns narrowed by DataCleaning.shrink_dtypes back to full-width SQL types.
+        _widen_float32_values: converts float32 columns back to float64 before they are uploaded.
+        _schema_sql_types: finds the SQL types of a table's columns from its schema spec.
+        _widen_varchar_columns: lengthens VARCHAR columns too short for rows being appended.
+        _build_indexes: builds a table's primary key and indexes.
+        _create_change_tables: creates the tables in which fingerprints and row hashes are kept.
+        _forget_changes: removes a table's fingerprint and row hashes when it is replaced.
+        _forget_order_totals: makes the next summary refresh rebuild the order totals in full.
+        _row_hashes: hashes each row of a dataframe, keyed by its primary key.
+        _drop_referencing_foreign_keys: drops the foreign keys referencing a table.
+        _copy_insert: bulk loads rows into a PostgreSQL table with COPY.
     '''
 
+    def __init__(self, pool_size=5, max_overflow=10, pool_pre_ping=True, table_schemas=None):
+        '''
+        This function sets up the empty engine, credentials and table name caches.
+
+        Args:
+            pool_size: number of connections kept open in each engine's connection pool.
+            max_overflow: number of extra connections each pool may open when all are in use.
+            pool_pre_ping: whether connections are tested for liveness before being used.
+            table_schemas: dict of table names to their schema spec. Defaults to TABLE_SCHEMAS;
+                           pass {} to let pandas choose the schema of every table.
+        '''
+        self.table_schemas = TABLE_SCHEMAS if table_schemas is None else table_schemas
+        self.pool_size = pool_size
+        self.max_overflow = max_overflow
+        self.pool_pre_ping = pool_pre_ping
+        self._db_creds = {}
+        self._engines = {}
+        # Stages call init_db_engine from several threads at once, so only one may create an engine
+        self._engines_lock = threading.Lock()
+        self._table_names = {}
+        atexit.register(self.dispose_engines)
+
     def read_db_creds(self, credentials_file):
         '''
         This function is used to read database credentials.
 
+        Each file is only parsed once; later calls return a copy of the cached credentials.
+
         Args:
             credentials_file: YAML file containing the credentials of the database.
 
         Returns:
             db_creds: dict of the database credentials
         '''
-        with open(credentials_file, 'r') as creds:
-            db_creds = yaml.safe_load(creds)
-            return db_creds
+        if credentials_file not in self._db_creds:
+            with open(credentials_file, 'r') as creds:
+                self._db_creds[credentials_file] = yaml.safe_load(creds)
+        db_creds = dict(self._db_creds[credentials_file])
+        return db_creds
         
     def init_db_engine(self, db_creds: dict):
         '''
         This function creates an SQLAlchemy engine from the database credentials dict.
 
+        If an engine has already been created for the same database, that engine (and its
+        connection pool) is returned instead of creating a new one. Engines are created under a
+        lock, so threads asking for the same database at the same time share one engine.
+
         Args:
             db_creds: Python dict returned from the read_db_creds function.
         
         Returns:
             engine: SQLAlchemy engine object allowing connection to a database.
         '''
-        engine = create_engine(f"postgresql+psycopg2://{db_creds['RDS_USER']}:{db_creds['RDS_PASSWORD']}@{db_creds['RDS_HOST']}:{db_creds['RDS_PORT']}/{db_creds['RDS_DATABASE']}")  
+        db_url = f"postgresql+psycopg2://{db_creds['RDS_USER']}:{db_creds['RDS_PASSWORD']}@{db_creds['RDS_HOST']}:{db_creds['RDS_PORT']}/{db_creds['RDS_DATABASE']}"
+        with self._engines_lock:
+            if db_url not in self._engines:
+                self._engines[db_url] = create_engine(db_url, pool_size=self.pool_size, max_overflow=self.max_overflow,
+                                                      pool_pre_ping=self.pool_pre_ping)
+            engine = self._engines[db_url]
         return engine
+
+    def get_engine(self, credentials_file):
+        '''
+        This function returns the engine for the database described in a credentials file.
+
+        Args:
+            credentials_file: YAML file containing the credentials of the database.
+
+        Returns:
+            engine: SQLAlchemy engine object allowing connection to a database.
+        '''
+        return self.init_db_engine(self.read_db_creds(credentials_file))
+
+    def dispose_engines(self):
+        '''
+        This function closes the connection pools of every cached engine and clears the caches.
+        It is called automatically when the process exits.
+        '''
+        with self._engines_lock:
+            for engine in self._engines.values():
+                engine.dispose()
+            self._engines.clear()
+        self._table_names.clear()
     
-    def list_db_tables(self, engine: Engine):
+    def list_db_tables(self, engine: Engine, refresh=False):
         '''
         This function connects to a database and lists the tables it contains.
 
+        The schema is only reflected once per engine; later calls return the cached list
+        unless refresh is True.
+
         Args:
             engine: SQLAlchemy engine object returned from init_db_engine.
+            refresh: whether to reflect the database again rather than using the cached list.
         
         Returns:
-            inspector.get_table_names(): a list of tables within the database.
+            table_names: a list of tables within the database.
         '''
-        with engine.connect() as conn:
+        if refresh or engine.url not in self._table_names:
             inspector = inspect(engine)
-            return inspector.get_table_names()
+            self._table_names[engine.url] = inspector.get_table_names()
+        table_names = list(self._table_names[engine.url])
+        return table_names
     
-    def upload_to_db(self, engine: Engine, dataframe: DataFrame, table_name: str):
+    def upload_to_db(self, engine: Engine, dataframe: DataFrame, table_name: str,
+                     method='copy', chunksize=50000, dtype=None, if_exists='replace', build_indexes=True):
         '''
         This function creates a table in the connected database.
 
+        The table is created by pandas from the dataframe's columns (and any types given in dtype),
+        then rows are loaded in chunks of chunksize using one of three methods:
+            'copy': streams each chunk with PostgreSQL's COPY FROM STDIN (see _copy_insert).
+                    Falls back to 'multi' for engines which are not PostgreSQL.
+            'multi': sends each chunk as a single multi-row INSERT statement.
+            'insert': sends one INSERT per row (pandas' default behaviour).
+
         Args:
             engine: SQLAlchemy engine object returned from init_db_engine.
             dataframe: a pandas dataframe of business data.
             table_name: a string representing the name of the table to be created.
+            method: the loading method described above. Defaults to 'copy'.
+            chunksize: the number of rows loaded per chunk.
+            dtype: optional dict of column names to SQLAlchemy types for the created table.
+            if_exists: 'replace' to recreate the table, or 'append' to add rows to an existing table.
+                       An open connection can be passed as engine so an append is part of a
+                       larger transaction.
+            build_indexes: whether to build the primary key and indexes of a table created from its
+                           schema spec. upload_chunks builds them itself once every chunk is loaded.
+
+        If the table has a schema spec, the load happens in one transaction: the table is dropped
+        (along with any foreign keys referencing it, and its fingerprint and row hashes from
+        upload_changes) and created with the spec's column types,
+        the rows are loaded, and only then are its primary key and indexes built, as building
+        them once is much faster than updating them for every row. When appending, VARCHAR
+        columns are lengthened first if the new rows need it.
+        '''
+        if method == 'copy' and engine.dialect.name != 'postgresql':
+            method = 'multi'
+        schema = self.table_schemas.get(table_name)
+        dtype = {**self._widened_sql_types(dataframe), **self._schema_sql_types(dataframe, schema), **(dtype or {})}
+        dataframe = self._widen_float32_values(dataframe)
+        insert_methods = {'copy': self._copy_insert, 'multi': 'multi', 'insert': None}
+        if method not in insert_methods:
+            raise ValueError(f'Sorry, {method} is not a valid upload method.\nValid methods are: {", ".join(insert_methods)}.')
+        if schema is None:
+            dataframe.to_sql(table_name, engine, if_exists=if_exists, chunksize=chunksize,
+                             method=insert_methods[method], dtype=dtype)
+            return
+        # A connection passed in is already part of the caller's transaction
+        with engine.begin() if isinstance(engine, Engine) else nullcontext(engine) as conn:
+            create_table = if_exists == 'replace' or not inspect(conn).has_table(table_name)
+            if create_table:
+                conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}" CASCADE'))
+                self._forget_changes(conn, table_name)
+            else:
+                self._widen_varchar_columns(conn, table_name, dtype)
+            dataframe.to_sql(table_name, conn, if_exists='append', chunksize=chunksize,
+                             method=insert_methods[method], dtype=dtype)
+            if create_table and build_indexes:
+                self._build_indexes(conn, table_name, schema, dataframe.columns)
+
+    def upload_chunks(self, engine: Engine, chunks, table_name: str, method='copy', if_exists='replace'):
+        '''
+        This function uploads a table to the connected database one chunk at a time, so the whole
+        table never has to be held in memory.
+
+        It consumes an iterable of dataframes, such as cleaned chunks from DataCleaning.clean_chunks
+        (optionally run ahead in another thread with streaming.prefetch). The first chunk replaces
+        or is appended to the table as if_exists says, and the rest are appended. Every chunk is
+        loaded in one transaction, and for tables with a schema spec the primary key and indexes
+        are only built once the last chunk is in.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine, or an open connection.
+            chunks: an iterable of pandas dataframes of business data.
+            table_name: a string representing the name of the table to be created.
+            method: the loading method used by upload_to_db. Defaults to 'copy'.
+            if_exists: 'replace' to recreate the table, or 'append' to add rows to an existing table.
+
+        Returns:
+            rows_uploaded: the number of rows uploaded.
+        '''
+        schema = self.table_schemas.get(table_name)
+        rows_uploaded = 0
+        columns = None
+        with engine.begin() if isinstance(engine, Engine) else nullcontext(engine) as conn:
+            create_table = if_exists == 'replace' or not inspect(conn).has_table(table_name)
+            for chunk in chunks:
+                self.upload_to_db(conn, chunk, table_name, method=method, if_exists=if_exists if columns is None else 'append',
+                                  build_indexes=False)
+                columns = chunk.columns
+                rows_uploaded += len(chunk)
+            if schema is not None and create_table and columns is not None:
+                self._build_indexes(conn, table_name, schema, columns)
+        return rows_uploaded
+
+    def _widened_sql_types(self, dataframe: DataFrame):
+        '''
+        This function finds the SQL types of columns narrowed by DataCleaning.shrink_dtypes.
+
+        Without this, pandas would create SMALLINT/INTEGER columns for downcast integers and REAL
+        columns for float32, rather than the BIGINT and DOUBLE PRECISION columns created for
+        the full-width data.
+
+        Args:
+            dataframe: a pandas dataframe about to be uploaded.
+
+        Returns:
+            sql_types: dict of column names to the SQLAlchemy types they would have at full width.
+        '''
+        sql_types = {}
+        for col, col_dtype in dataframe.dtypes.items():
+            if col_dtype.kind == 'i' and col_dtype.itemsize < 8:
+                sql_types[col] = BigInteger()
+            elif col_dtype.kind == 'u':
+                sql_types[col] = BigInteger()
+            elif col_dtype.kind == 'f' and col_dtype.itemsize < 8:
+                sql_types[col] = Float(precision=53)
+        return sql_types
+
+    def _widen_float32_values(self, dataframe: DataFrame):
+        '''
+        This function widens float32 columns narrowed by DataCleaning.shrink_dtypes to float64.
+
+        shrink_dtypes only narrows floats which survive the round trip, so widening them gives
+        back exactly the values they were cleaned to. The dataframe passed in is not modified.
+
+        Args:
+            dataframe: a pandas dataframe about to be uploaded.
+
+        Returns:
+            dataframe: the dataframe with float32 and Float32 columns converted to float64.
+        '''
+        narrow_floats = [col for col, col_dtype in dataframe.dtypes.items()
+                         if col_dtype.kind == 'f' and col_dtype.itemsize < 8]
+        if not narrow_floats:
+            return dataframe
+        return dataframe.assign(**{
+            col: dataframe[col].to_numpy(dtype='float64', na_value=float('nan'))
+            for col in narrow_floats})
+
+    def _schema_sql_types(self, dataframe: DataFrame, schema):
+        '''
+        This function finds the SQL types given to a dataframe's columns by a table's schema spec.
+
+        Columns typed as VARCHAR without a length are given the length of their longest value.
+
+        Args:
+            dataframe: a pandas dataframe about to be uploaded.
+            schema: the table's schema spec from table_schemas, or None.
+
+        Returns:
+            sql_types: dict of column names to SQLAlchemy types.
+        '''
+        sql_types = {}
+        for col, sql_type in (schema or {}).get('columns', {}).items():
+            if col not in dataframe.columns:
+                continue
+            if sql_type is VARCHAR:
+                lengths = dataframe[col].dropna().astype(str).str.len()
+                sql_type = VARCHAR(max(int(lengths.max()) if len(lengths) else 0, 1))
+            sql_types[col] = sql_type
+        return sql_types
+
+    def _widen_varchar_columns(self, conn, table_name: str, sql_types):
+        '''
+        This function lengthens the VARCHAR columns of an existing table which are too short for
+        the rows about to be appended to it.
+
+        Args:
+            conn: open SQLAlchemy connection to the target database.
+            table_name: name of the table being appended to.
+            sql_types: dict of column names to the SQL types the new rows need, from _schema_sql_types.
+        '''
+        for column in inspect(conn).get_columns(table_name):
+            needed = sql_types.get(column['name'])
+            length = getattr(column['type'], 'length', None)
+            if isinstance(needed, VARCHAR) and length and needed.length and needed.length > length:
+                conn.execute(text(f'ALTER TABLE "{table_name}" ALTER COLUMN "{column["name"]}" TYPE VARCHAR({needed.length})'))
+
+    def _build_indexes(self, conn, table_name: str, schema, columns, primary_key=True):
+        '''
+        This function builds the primary key and indexes of a loaded table from its schema spec,
+        then updates the table's planner statistics.
+
+        Args:
+            conn: open SQLAlchemy connection to the target database.
+            table_name: name of the loaded table.
+            schema: the table's schema spec from table_schemas.
+            columns: the table's columns. Keys and indexes on other columns are skipped.
+            primary_key: whether to add the primary key.
+        '''
+        if primary_key and schema.get('primary_key') in columns:
+            conn.execute(text(f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{table_name}_pkey" PRIMARY KEY ("{schema["primary_key"]}")'))
+        for column in schema.get('indexes', []):
+            if column in columns:
+                conn.execute(text(f'CREATE INDEX IF NOT EXISTS "{table_name}_{column}_idx" ON "{table_name}" ("{column}")'))
+        conn.execute(text(f'ANALYZE "{table_name}"'))
+
+    def _create_change_tables(self, engine: Engine):
+        '''
+        This function creates the etl_fingerprints and etl_row_hashes tables if they don't exist.
+
+        They are created in their own transaction, so the tables are there for every stage
+        loading a table at the same time, rather than only once the first stage's load commits.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine.
+        '''
+        try:
+            with engine.begin() as conn:
+                conn.execute(text("CREATE TABLE IF NOT EXISTS etl_fingerprints ("
+                                  "table_name TEXT PRIMARY KEY, "
+                                  "fingerprint TEXT NOT NULL, "
+                                  "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"))
+                conn.execute(text("CREATE TABLE IF NOT EXISTS etl_row_hashes ("
+                                  "table_name TEXT NOT NULL, "
+                                  "key TEXT NOT NULL, "
+                                  "row_hash BIGINT NOT NULL, "
+                                  "PRIMARY KEY (table_name, key))"))
+        except DBAPIError:
+            # Another stage created them at the same moment
+            pass
+
+    def _forget_changes(self, conn, table_name: str):
+        '''
+        This function removes the fingerprint and row hashes of a table which is being replaced,
+        so upload_changes and the fingerprint check never compare against rows no longer loaded.
+
+        Args:
+            conn: open SQLAlchemy connection to the target database.
+            table_name: name of the table being replaced.
+        '''
+        for change_table in ('etl_fingerprints', 'etl_row_hashes'):
+            if inspect(conn).has_table(change_table):
+                conn.execute(text(f'DELETE FROM {change_table} WHERE table_name = :table_name'), {'table_name': table_name})
+        self._forget_order_totals(conn, table_name)
+
+    def _forget_order_totals(self, conn, table_name: str):
+        '''
+        This function removes the high-water mark of summary_order_totals when a table it is built
+        from is replaced or has rows updated or deleted, so refresh_summary_tables rebuilds the
+        totals from the whole orders table instead of adding new orders to totals which no longer hold.
+
+        Args:
+            conn: open SQLAlchemy connection to the target database.
+            table_name: name of the table being changed.
+        '''
+        if table_name in ORDER_TOTALS_SOURCES and inspect(conn).has_table('etl_watermarks'):
+            conn.execute(text("DELETE FROM etl_watermarks WHERE table_name = 'summary_order_totals'"))
+
+    def _row_hashes(self, dataframe: DataFrame, key: str):
+        '''
+        This function hashes every row of a dataframe with pandas' hash_pandas_object.
+
+        The index is left out of the hash, so rows are matched by their primary key alone and
+        a row moving position in the source doesn't count as a change.
+
+        Args:
+            dataframe: a pandas dataframe about to be uploaded.
+            key: the table's primary key column.
+
+        Returns:
+            row_hashes: dataframe of each row's key (as text) and its 64-bit hash.
+        '''
+        row_hashes = hash_pandas_object(dataframe, index=False).to_numpy().view('int64')
+        return DataFrame({'key': dataframe[key].astype(str).to_numpy(), 'row_hash': row_hashes})
+
+    def _drop_referencing_foreign_keys(self, conn, table_name: str):
+        '''
+        This function drops the foreign keys in the schema spec which reference a table, as
+        replacing the table would, so rows can be removed from it. create_foreign_keys adds
+        them again once every table is loaded.
+
+        Args:
+            conn: open SQLAlchemy connection to the target database.
+            table_name: name of the referenced table.
+        '''
+        for referencing_table, schema in self.table_schemas.items():
+            for column, (referenced_table, _) in schema.get('foreign_keys', {}).items():
+                if referenced_table == table_name:
+                    conn.execute(text(f'ALTER TABLE IF EXISTS "{referencing_table}" '
+                                      f'DROP CONSTRAINT IF EXISTS "{referencing_table}_{column}_fkey"'))
+
+    def read_watermark(self, engine: Engine, table_name: str):
+        '''
+        This function reads the high-water mark recorded by the last load of a table.
+
+        Watermarks are kept in the etl_watermarks table of the target database. This is created
+        by write_watermark, so there is no watermark until a table has been loaded once.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine.
+            table_name: name of the loaded table.
+
+        Returns:
+            high_water_mark: the largest source 'index' loaded into the table, or None.
+        '''
+        if 'etl_watermarks' not in inspect(engine).get_table_names():
+            return None
+        with engine.connect() as conn:
+            high_water_mark = conn.execute(text("SELECT high_water_mark FROM etl_watermarks WHERE table_name = :table_name"),
+                                           {'table_name': table_name}).scalar()
+        return high_water_mark
+
+    def write_watermark(self, conn, table_name: str, high_water_mark):
+        '''
+        This function records the high-water mark of the latest load of a table.
+
+        It should be called on the same connection (and transaction) that loaded the rows, so
+        the watermark only moves forward if the load succeeds.
+
+        Args:
+            conn: open SQLAlchemy connection to the target database.
+            table_name: name of the loaded table.
+            high_water_mark: the largest source 'index' loaded into the table.
+        '''
+        conn.execute(text("CREATE TABLE IF NOT EXISTS etl_watermarks ("
+                          "table_name TEXT PRIMARY KEY, "
+                          "high_water_mark BIGINT NOT NULL, "
+                          "updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"))
+        conn.execute(text("INSERT INTO etl_watermarks (table_name, high_water_mark) VALUES (:table_name, :high_water_mark) "
+                          "ON CONFLICT (table_name) DO UPDATE "
+                          "SET high_water_mark = excluded.high_water_mark, updated_at = CURRENT_TIMESTAMP"),
+                     {'table_name': table_name, 'high_water_mark': int(high_water_mark)})
+
+    def read_fingerprint(self, engine: Engine, table_name: str):
+        '''
+        This function reads the fingerprint of the raw data a table was last loaded from.
+
+        Fingerprints are kept in the etl_fingerprints table of the target database, alongside
+        the row hashes used by upload_changes.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine.
+            table_name: name of the loaded table.
+
+        Returns:
+            fingerprint: the fingerprint from DataExtractor.fingerprint, or None if there isn't one.
         '''
-        dataframe.to_sql(table_name, engine, if_exists='replace')
\ No newline at end of file
+        if 'etl_fingerprints' not in inspect(engine).get_table_names():
+            return None
+        with engine.connect() as conn:
+            fingerprint = conn.execute(text("SELECT fingerprint FROM etl_fingerprints WHERE table_name = :table_name"),
+                                       {'table_name': table_name}).scalar()
+        return fingerprint
+
+    def write_fingerprint(self, conn, table_name: str, fingerprint):
+        '''
+        This function records the fingerprint of the raw data a table was loaded from.
+
+        It should be called on the same connection (and transaction) that loaded the rows, so
+        the fingerprint is only recorded if the load succeeds.
+
+        Args:
+            conn: open SQLAlchemy connection to the target database.
+            table_name: name of the loaded table.
+            fingerprint: the fingerprint from DataExtractor.fingerprint.
+        '''
+        self._create_change_tables(conn.engine)
+        conn.execute(text("INSERT INTO etl_fingerprints (table_name, fingerprint) VALUES (:table_name, :fingerprint) "
+                          "ON CONFLICT (table_name) DO UPDATE "
+                          "SET fingerprint = excluded.fingerprint, updated_at = CURRENT_TIMESTAMP"),
+                     {'table_name': table_name, 'fingerprint': fingerprint})
+
+    def upload_changes(self, engine: Engine, dataframe: DataFrame, table_name: str, full_reload=False):
+        '''
+        This function uploads a table with a primary key by applying only the rows which have
+        changed since its last load, rather than replacing the whole table.
+
+        Every row is hashed, and the hashes are kept by primary key in the etl_row_hashes table.
+        Comparing them with the hashes of the last load finds the keys which were inserted,
+        updated and deleted. Deleted and updated rows are removed, then inserted and updated
+        rows are appended, all in one transaction. As when a table is replaced, the foreign keys
+        referencing it are dropped, to be added again by create_foreign_keys.
+
+        The table is replaced in full instead (by upload_to_db) on its first load, when full_reload
+        is set, or if the table has no primary key in the schema spec.
+
+        Rows whose primary key is missing can't be loaded, as building the primary key would fail.
+        Where rows share a primary key, only the last of them is loaded. The rows which aren't
+        loaded are kept in a duplicates_<table_name> table (e.g. duplicates_dim_store_details)
+        instead, which is replaced on every load and dropped when there are none.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine, or an open connection.
+            dataframe: a pandas dataframe of business data.
+            table_name: a string representing the name of the table.
+            full_reload: whether to replace the whole table even if its last load is known.
+
+        Returns:
+            changes: dict of the number of rows 'inserted', 'updated', 'deleted' and held back as 'duplicates'.
+        '''
+        key = self.table_schemas.get(table_name, {}).get('primary_key')
+        duplicate_rows = dataframe.iloc[:0]
+        if key in dataframe.columns:
+            bad_keys = (dataframe[key].isna() | dataframe[key].duplicated(keep='last')).to_numpy()
+            duplicate_rows = dataframe[bad_keys]
+            dataframe = dataframe[~bad_keys]
+        new_hashes = self._row_hashes(dataframe, key) if key in dataframe.columns else None
+        with engine.begin() if isinstance(engine, Engine) else nullcontext(engine) as conn:
+            if len(duplicate_rows):
+                self.upload_to_db(conn, duplicate_rows, f'duplicates_{table_name}')
+            else:
+                conn.execute(text(f'DROP TABLE IF EXISTS "duplicates_{table_name}"'))
+            old_hashes = None
+            if not full_reload and new_hashes is not None and inspect(conn).has_table(table_name) \
+                    and inspect(conn).has_table('etl_row_hashes'):
+                old_hashes = read_sql(text("SELECT key, row_hash FROM etl_row_hashes WHERE table_name = :table_name"),
+                                      conn, params={'table_name': table_name})
+            if old_hashes is None or old_hashes.empty:
+                self.upload_to_db(conn, dataframe, table_name)
+                if new_hashes is not None:
+                    self._create_change_tables(conn.engine)
+                    new_hashes.assign(table_name=table_name).to_sql('etl_row_hashes', conn, if_exists='append',
+                                                                    index=False, method=self._copy_insert)
+                return {'inserted': len(dataframe), 'updated': 0, 'deleted': 0, 'duplicates': len(duplicate_rows)}
+            compared = new_hashes.merge(old_hashes, on='key', how='outer', suffixes=('', '_old'), indicator=True)
+            inserted = compared.loc[compared['_merge'] == 'left_only', 'key']
+            deleted = compared.loc[compared['_merge'] == 'right_only', 'key']
+            updated = compared.loc[(compared['_merge'] == 'both') & (compared['row_hash'] != compared['row_hash_old']), 'key']
+            changes = {'inserted': len(inserted), 'updated': len(updated), 'deleted': len(deleted),
+                       'duplicates': len(duplicate_rows)}
+            if not (len(inserted) or len(updated) or len(deleted)):
+                return changes
+            self._drop_referencing_foreign_keys(conn, table_name)
+            stale_keys = DataFrame({'key': list(updated) + list(deleted)})
+            if len(stale_keys):
+                self._forget_order_totals(conn, table_name)
+                # Removed with a join against a temporary table, as there may be thousands of keys
+                conn.execute(text('CREATE TEMPORARY TABLE etl_stale_keys (key TEXT PRIMARY KEY)'))
+                stale_keys.to_sql('etl_stale_keys', conn, if_exists='append', index=False, method=self._copy_insert)
+                conn.execute(text(f'DELETE FROM "{table_name}" USING etl_stale_keys '
+                                  f'WHERE "{table_name}"."{key}"::text = etl_stale_keys.key'))
+                conn.execute(text('DELETE FROM etl_row_hashes USING etl_stale_keys '
+                                  'WHERE etl_row_hashes.table_name = :table_name AND etl_row_hashes.key = etl_stale_keys.key'),
+                             {'table_name': table_name})
+                conn.execute(text('DROP TABLE etl_stale_keys'))
+            changed = new_hashes['key'].isin(set(inserted) | set(updated)).to_numpy()
+            if changed.any():
+                self.upload_to_db(conn, dataframe[changed], table_name, if_exists='append')
+                new_hashes[changed].assign(table_name=table_name).to_sql('etl_row_hashes', conn, if_exists='append',
+                                                                         index=False, method=self._copy_insert)
+            conn.execute(text(f'ANALYZE "{table_name}"'))
+        return changes
+
+    def create_indexes(self, engine: Engine):
+        '''
+        This function builds the primary keys and indexes in the schema spec for tables which are
+        already loaded, e.g. tables created before the spec was introduced. upload_to_db builds
+        them itself for the tables it creates.
+
+        Primary keys which already exist are left as they are, as are tables which don't exist yet.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine.
+        '''
+        inspector = inspect(engine)
+        table_names = inspector.get_table_names()
+        with engine.begin() as conn:
+            for table_name, schema in self.table_schemas.items():
+                if table_name not in table_names:
+                    continue
+                columns = [column['name'] for column in inspector.get_columns(table_name)]
+                has_primary_key = bool(inspector.get_pk_constraint(table_name)['constrained_columns'])
+                self._build_indexes(conn, table_name, schema, columns, primary_key=not has_primary_key)
+
+    def create_foreign_keys(self, engine: Engine):
+        '''
+        This function adds the foreign keys in the schema spec, linking the orders table to the
+        dimension tables.
+
+        It is run once every table is loaded, as replacing a dimension table drops the foreign
+        keys referencing it. Existing foreign keys are dropped and added again, so every order
+        is checked against the newly loaded dimensions. Tables which don't exist are skipped.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine.
+        '''
+        table_names = inspect(engine).get_table_names()
+        with engine.begin() as conn:
+            for table_name, schema in self.table_schemas.items():
+                if table_name not in table_names:
+                    continue
+                for column, (referenced_table, referenced_column) in schema.get('foreign_keys', {}).items():
+                    if referenced_table not in table_names:
+                        continue
+                    constraint = f'{table_name}_{column}_fkey'
+                    conn.execute(text(f'ALTER TABLE "{table_name}" DROP CONSTRAINT IF EXISTS "{constraint}"'))
+                    conn.execute(text(f'ALTER TABLE "{table_name}" ADD CONSTRAINT "{constraint}" FOREIGN KEY ("{column}") '
+                                      f'REFERENCES "{referenced_table}" ("{referenced_column}")'))
+
+    def refresh_summary_tables(self, engine: Engine, full_refresh=False):
+        '''
+        This function brings the summary tables which answer the business questions up to date, so
+        the questions can be answered without joining and scanning the orders table each time.
+
+        The sales summaries (ORDER_SUMMARY_TABLES) are built from summary_order_totals, the orders
+        aggregated by every dimension column they group by, which is only a few thousand rows. The
+        largest orders_table 'index' in the totals is kept as their high-water mark in
+        etl_watermarks. On later runs only the orders past it are aggregated and merged into the
+        totals, and the sales summaries are rebuilt from them. Orders are appended with the index
+        continuing on from the rows already loaded, so those are exactly the orders added since.
+
+        The totals are rebuilt from the whole orders table instead on the first run, when
+        full_refresh is set, or once the high-water mark has been forgotten because the orders
+        table or a dimension it joins was replaced or had rows updated or deleted (see
+        _forget_order_totals). Rows inserted into a dimension don't change the totals, as long as
+        every order summarised matched its dimensions, which build_summary_tables in main.py
+        ensures by adding the foreign keys first.
+
+        The other summaries only read the dimension tables, so they are rebuilt from their queries
+        in SUMMARY_TABLES every time without scanning the orders table. Everything happens in a
+        single transaction, so readers keep seeing the previous summaries until all of the new
+        ones are ready.
+
+        Args:
+            engine: SQLAlchemy engine object returned from init_db_engine.
+            full_refresh: whether to rebuild the totals from the whole orders table even if they could be updated.
+
+        Returns:
+            refresh: dict of whether the totals were 'rebuilt', and the number of 'orders' aggregated.
+        '''
+        with engine.begin() as conn:
+            high_water_mark = None
+            summary_table_names = ['summary_order_totals', 'etl_watermarks', *SUMMARY_TABLES]
+            if not full_refresh and all(inspect(conn).has_table(table_name) for table_name in summary_table_names):
+                high_water_mark = conn.execute(text("SELECT high_water_mark FROM etl_watermarks "
+                                                    "WHERE table_name = 'summary_order_totals'")).scalar()
+            last_index = conn.execute(text('SELECT MAX("index") FROM orders_table')).scalar()
+            last_index = -1 if last_index is None else last_index
+            if high_water_mark is None:
+                conn.execute(text('DROP TABLE IF EXISTS summary_order_totals'))
+                conn.execute(text(f'CREATE TABLE summary_order_totals AS {ORDER_TOTALS_QUERY}'), {'after_index': -1})
+            elif last_index > high_water_mark:
+                # The totals are small, so the new orders' totals are merged in by aggregating both again
+                conn.execute(text(f'CREATE TEMPORARY TABLE etl_new_order_totals ON COMMIT DROP AS {ORDER_TOTALS_QUERY}'),
+                             {'after_index': high_water_mark})
+                conn.execute(text("""
+                    CREATE TEMPORARY TABLE etl_merged_order_totals ON COMMIT DROP AS
+                    SELECT has_product, has_store, has_date, store_type, country_code, year, month,
+                           SUM(number_of_sales) AS number_of_sales,
+                           SUM(product_quantity) AS product_quantity,
+                           SUM(sales) AS sales
+                    FROM (SELECT * FROM summary_order_totals UNION ALL SELECT * FROM etl_new_order_totals) AS totals
+                    GROUP BY 1, 2, 3, 4, 5, 6, 7"""))
+                conn.execute(text('DELETE FROM summary_order_totals'))
+                conn.execute(text('INSERT INTO summary_order_totals SELECT * FROM etl_merged_order_totals'))
+            orders_added = high_water_mark is None or last_index > high_water_mark
+            for table_name, query in {**SUMMARY_TABLES, **ORDER_SUMMARY_TABLES}.items():
+                if table_name in ORDER_SUMMARY_TABLES and not orders_added:
+                    continue
+                conn.execute(text(f'DROP TABLE IF EXISTS "{table_name}"'))
+                conn.execute(text(f'CREATE TABLE "{table_name}" AS {query}'))
+                conn.execute(text(f'ANALYZE "{table_name}"'))
+            conn.execute(text('ANALYZE summary_order_totals'))
+            self.write_watermark(conn, 'summary_order_totals', last_index)
+        return {'rebuilt': high_water_mark is None, 'orders': last_index - (-1 if high_water_mark is None else high_water_mark)}
+
+    def _copy_insert(self, table, conn, keys, data_iter):
+        '''
+        This function loads a chunk of rows into a PostgreSQL table using COPY FROM STDIN.
+
+        It is passed to DataFrame.to_sql as its insertion method. The chunk is written to an
+        in-memory CSV buffer which is then streamed to the database through the psycopg2 cursor.
+
+        COPY reads an unquoted empty field as NULL and a quoted one as an empty string. Text is
+        always quoted and nulls are written unquoted, so empty strings load as empty strings,
+        the same as with an INSERT.
+
+        Args:
+            table: the pandas SQLTable being loaded.
+            conn: the SQLAlchemy connection used by to_sql.
+            keys: list of column names in the chunk.
+            data_iter: iterable of row tuples in the chunk.
+        '''
+        buffer = io.StringIO()
+        csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(
+            tuple(_CSV_NULL if value is None else value for value in row) for row in data_iter)
+        buffer.seek(0)
+        columns = ', '.join(f'"{key}"' for key in keys)
+        table_name = f'"{table.schema}"."{table.name}"' if table.schema else f'"{table.name}"'
+        with conn.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv)", buffer)
+
+
+class _CsvNull:
+    '''
+    This class stands in for nulls in the rows written by DatabaseConnector._copy_insert.
+
+    csv.QUOTE_NONNUMERIC quotes every field which isn't a number, including None. Defining
+    __float__ makes this look like a number, so it is written as an unquoted empty field,
+    which COPY reads as NULL.
+    '''
+    def __float__(self):
+        return 0.0
+
+    def __str__(self):
+        return ''
+
+
+_CSV_NULL = _CsvNull()
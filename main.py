@@ -1,22 +1,141 @@
+import argparse
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from sqlalchemy import inspect
+from sqlalchemy import text
 from database_utils import DatabaseConnector
 from data_extraction import DataExtractor
 from data_cleaning import DataCleaning
+from profiling import MetricsRecorder
+from streaming import prefetch
 
 
 # instantialising DatabaseConnector, DataExtractor and DataCleaning
 connection = DatabaseConnector()
 extractor = DataExtractor()
 cleaner = DataCleaning()
+# Records metrics for every call to the connection, extractor and cleaner methods
+metrics = MetricsRecorder()
+for pipeline_object in (connection, extractor, cleaner):
+    metrics.instrument(pipeline_object)
+# Name of a stage to run under cProfile, set with --profile
+profiled_stage = None
 # Assigning database credentials to variables
 rds_db_creds = 'db_creds.yaml'
 sales_data_creds = 'sales_data_creds.yaml'
+# Names of the tables read from the RDS
+rds_user_table = 'legacy_users'
+rds_orders_table = 'orders_table'
+# Number of key ranges each RDS table is read as in parallel, set with --read-partitions
+read_partitions = 1
 # Assigning API key to variable
 api_key_header = 'api_key_header.yaml'
 # Assigning API endpoints and api key as variables to connect to store data API
 num_stores_endpoint = 'https://aqj7u5id95.execute-api.eu-west-1.amazonaws.com/prod/number_stores'
 retrieve_store_endpoint_base = 'https://aqj7u5id95.execute-api.eu-west-1.amazonaws.com/prod/store_details/'
+# Number of stores fetched from the API at the same time, set with --store-workers
+store_workers = 8
+# When True, the orders table is fully reloaded instead of only loading new orders, and the
+# dimension tables are replaced even if their raw data hasn't changed
+full_refresh = False
+# When True, raw data is read from the snapshots saved by earlier runs instead of being extracted
+replay = False
+# Number of worker processes each table is cleaned with, set with --clean-workers
+clean_workers = 1
+# When True, full loads of the orders table stream through extract, clean and upload in chunks
+# of chunk_rows rows, set with --stream and --chunk-rows
+stream = False
+chunk_rows = 100000
+# Orders extracted and cleaned by the orders_extract stage, waiting to be uploaded by the orders stage
+prepared_orders = None
 
 
+def extract_raw_data(name, source, extract_function, *args, **kwargs):
+    '''
+    This function extracts raw data and saves a snapshot of it, or replays an earlier snapshot.
+
+    If replay is False, extract_function is called with the given arguments and its result is
+    saved as a Parquet snapshot under name. If replay is True, the snapshot is loaded instead so
+    only the cleaning and uploading steps are run.
+
+    Args:
+        name: name of the snapshot, e.g. 'raw_user_data'.
+        source: description of where the data comes from, recorded in the snapshot.
+        extract_function: DataExtractor method which extracts the raw data.
+    
+    Returns:
+        raw_data: a pandas dataframe of the raw data.
+    '''
+    if replay:
+        raw_data, snapshot_metadata = extractor.load_snapshot(name)
+        print(f"Replaying {name} snapshot of {snapshot_metadata['source']} fetched at {snapshot_metadata['fetched_at']}.")
+        return raw_data
+    raw_data = extract_function(*args, **kwargs)
+    extractor.save_snapshot(raw_data, name, source)
+    return raw_data
+
+
+def load_dimension(table_name, raw_data, clean_function):
+    '''
+    This function cleans and uploads a dimension table, unless its raw data is unchanged since
+    it was last loaded.
+
+    The fingerprint of the raw data, combined with the fingerprint of the cleaning code and
+    options (DataCleaning.cleaning_fingerprint), is compared with the one recorded by the table's
+    last load. If they match, cleaning and uploading are skipped. Otherwise the data is cleaned and only
+    the rows which have changed are inserted, updated or deleted (see upload_changes), and the
+    new fingerprint is recorded in the same transaction. With full_refresh set the table is
+    always cleaned and replaced. Rows rejected by the table's cleaning rules replace the contents
+    of its quarantine table, quarantine_<table_name>, in the same transaction.
+
+    Args:
+        table_name: name of the table in the sales_data database, e.g. 'dim_card_details'.
+        raw_data: a pandas dataframe of the raw extracted data.
+        clean_function: function which takes the raw data and returns it cleaned.
+    '''
+    sales_db_creds = connection.read_db_creds(sales_data_creds)
+    sales_db_engine = connection.init_db_engine(sales_db_creds)
+    fingerprint = f'{extractor.fingerprint(raw_data)}-{cleaner.cleaning_fingerprint()}'
+    if not full_refresh and inspect(sales_db_engine).has_table(table_name) \
+            and connection.read_fingerprint(sales_db_engine, table_name) == fingerprint:
+        print(f"{table_name} is unchanged since its last load.")
+        return
+    clean_data = clean_function(raw_data)
+    with sales_db_engine.begin() as conn:
+        changes = connection.upload_changes(conn, clean_data, table_name, full_reload=full_refresh)
+        connection.write_fingerprint(conn, table_name, fingerprint)
+        if table_name in cleaner.quarantine:
+            connection.upload_to_db(conn, cleaner.quarantine[table_name], f'quarantine_{table_name}')
+    print(f"{table_name}: {changes['inserted']} rows inserted, {changes['updated']} updated, {changes['deleted']} deleted.")
+    if changes['duplicates']:
+        print(f"{table_name}: {changes['duplicates']} rows with a missing {connection.table_schemas[table_name]['primary_key']}, "
+              f"or replaced by a later row with the same one, were not loaded, and are kept in duplicates_{table_name}.")
+    if table_name in cleaner.quarantine:
+        # Counted per rule, so a row failing several rules appears in each of their counts
+        rejections = ', '.join(f'{rule_name}: {count}' for rule_name, count in cleaner.rejection_counts[table_name].items() if count)
+        print(f"{table_name}: {len(cleaner.quarantine[table_name])} rows quarantined in quarantine_{table_name}"
+              + (f" (rows failing each rule, {rejections})." if rejections else "."))
+
+
+def find_rds_table(rds_engine, table_name):
+    '''
+    This function checks that a table exists in the RDS before it is read.
+
+    Args:
+        rds_engine: SQLAlchemy engine of the RDS.
+        table_name: name of the table to be read, e.g. rds_orders_table.
+
+    Returns:
+        table_name: the name of the table.
+    '''
+    table_list = connection.list_db_tables(rds_engine)
+    if table_name not in table_list:
+        raise ValueError(f'Sorry, there is no {table_name} table in the RDS.\nIts tables are: {", ".join(table_list)}.')
+    return table_name
+
 def upload_user_data():
     '''
     This function cleans and uploads user_data to the new PostgreSQL database.
@@ -24,20 +143,20 @@ def upload_user_data():
     First, this function reads the credentials of the Amazon RDS where user data is stored
     and connects to it. Then the user_data table is extracted and cleaned. After this, the
     function connects to the new PostgreSQL database, then cleaned user data is uploaded
-    to the PostgreSQL database under the name 'dim_users.'
+    to the PostgreSQL database under the name 'dim_users.' Nothing is cleaned or uploaded if
+    the user data is unchanged since the last run, and otherwise only the users which have
+    changed are applied (see load_dimension).
     '''
-    # Create SQLAlchemy engine from RDS credentials, get list of tables and indexes for
-    # raw user data. Raw user data then sent to data_cleaning.py.
+    # Create SQLAlchemy engine from RDS credentials, check the user data table exists and
+    # read it. Raw user data then sent to data_cleaning.py.
     rds_creds = connection.read_db_creds(rds_db_creds)
     rds_engine = connection.init_db_engine(rds_creds)
-    table_list = connection.list_db_tables(rds_engine)
-    user_data = table_list[1]
-    raw_user_data = extractor.read_rds_table(rds_engine, user_data)
-    clean_user_data = cleaner.clean_user_data(raw_user_data)
-    # Create SQLAlchemy engine from PostgreSQL credentials, uploads clean user data.
-    sales_db_creds = connection.read_db_creds(sales_data_creds)
-    sales_db_engine = connection.init_db_engine(sales_db_creds)
-    connection.upload_to_db(sales_db_engine, clean_user_data, 'dim_users')
+    user_data = find_rds_table(rds_engine, rds_user_table)
+    raw_user_data = extract_raw_data('raw_user_data', user_data, extractor.read_rds_table, rds_engine, user_data,
+                                     partitions=read_partitions)
+    # Cleans and uploads user data to sales_data database if it has changed
+    load_dimension('dim_users', raw_user_data,
+                   lambda raw_data: cleaner.clean_parallel(cleaner.clean_user_data, raw_data, n_workers=clean_workers))
     
 def upload_card_data():
     '''
@@ -45,16 +164,16 @@ def upload_card_data():
 
     First, this function takes in a link to the PDF containing the card data and cleans
     it. After this, the function connects to the PostgreSQL database and uploads the data
-    under the name 'dim_card_details.'
+    under the name 'dim_card_details.' Nothing is cleaned or uploaded if the card data is
+    unchanged since the last run (see load_dimension).
     '''
     # Uses link to retrieve raw card data from PDF. Card data sent to data_cleaning.py 
     link = 'https://data-handling-public.s3.eu-west-1.amazonaws.com/card_details.pdf'
-    raw_card_data = extractor.retrieve_pdf_data(link)
-    clean_card_data = cleaner.clean_card_data(raw_card_data)
-    # Create SQLAlchemy engine from PostgreSQL credentials, uploads clean card data.
-    sales_db_creds = connection.read_db_creds(sales_data_creds) # gather database credentials from file
-    sales_db_engine = connection.init_db_engine(sales_db_creds) # create engine from credentials
-    connection.upload_to_db(sales_db_engine, clean_card_data, 'dim_card_details') # upload clean data to sales_data database
+    raw_card_data = extract_raw_data('raw_card_data', link, extractor.retrieve_pdf_data, link,
+                                     max_workers=clean_workers or os.cpu_count())
+    # Cleans and uploads card data to sales_data database if it has changed
+    load_dimension('dim_card_details', raw_card_data,
+                   lambda raw_data: cleaner.clean_parallel(cleaner.clean_card_data, raw_data, n_workers=clean_workers))
 
 def list_num_stores():
     '''
@@ -63,6 +182,7 @@ def list_num_stores():
     '''
     num_stores = extractor.list_number_of_stores(num_stores_endpoint, api_key_header)
     print(num_stores)
+    return num_stores
 
 def upload_store_data():
     '''
@@ -70,91 +190,398 @@ def upload_store_data():
 
 
     This function takes in the retrieve_store_endpoint_base and api key defined at the start
-    of this script and makes a get request for each store. The data is collated and cleaned
-    before being uploaded to the new PostgreSQL database under the name 'dim_store_details'
+    of this script and makes a get request for each store, with up to store_workers requests
+    sent at the same time. The data is collated and cleaned
+    before being uploaded to the new PostgreSQL database under the name 'dim_store_details',
+    unless it is unchanged since the last run (see load_dimension).
     '''
     # Retrieves number of stores from num_stores_endpoint and extracts store data for each store
-    num_stores = list_num_stores()
-    store_data = extractor.retrieve_stores_data(retrieve_store_endpoint_base, api_key_header, num_stores)
-    clean_store_data = cleaner.clean_store_data(store_data)
-    # Create SQLAlchemy engine from PostgreSQL credentials, uploads clean store data.
-    sales_db_creds = connection.read_db_creds(sales_data_creds)
-    sales_db_engine = connection.init_db_engine(sales_db_creds)
-    connection.upload_to_db(sales_db_engine, clean_store_data, 'dim_store_details')
+    if replay:
+        store_data = extract_raw_data('raw_store_data', retrieve_store_endpoint_base, None)
+    else:
+        num_stores = list_num_stores()
+        store_data = extract_raw_data('raw_store_data', retrieve_store_endpoint_base, extractor.retrieve_stores_data,
+                                      retrieve_store_endpoint_base, api_key_header, num_stores, max_workers=store_workers)
+    # Cleans and uploads store data if it has changed
+    load_dimension('dim_store_details', store_data,
+                   lambda raw_data: cleaner.clean_parallel(cleaner.clean_store_data, raw_data, n_workers=clean_workers))
 
 def upload_product_details():
     '''
     This function cleans and uploads details of the business' products to the new PostgreSQL database.
 
     The raw product data is downloaded from the AWS S3 bucket URL and then cleaned. After cleaning,
-    the product data is uploaded to the new PostgreSQL database under the name 'dim_products.
+    the product data is uploaded to the new PostgreSQL database under the name 'dim_products,
+    unless it is unchanged since the last run (see load_dimension).
     '''
     # Retrieves raw_product_details from AWS s3 bucket
     product_address = 's3://data-handling-public/products.csv'
-    raw_product_details = extractor.extract_from_s3(product_address)
-    # Converts product weights into kg then cleans data
-    clean_weight_product_details = cleaner.convert_product_weights(raw_product_details)
-    clean_product_details = cleaner.clean_product_data(clean_weight_product_details)
-    # Create SQLAlchemy engine from PostgreSQL credentials, uploads clean product data.
-    sales_db_creds = connection.read_db_creds(sales_data_creds)
-    sales_db_engine = connection.init_db_engine(sales_db_creds)
-    connection.upload_to_db(sales_db_engine, clean_product_details, 'dim_products')
+    raw_product_details = extract_raw_data('raw_product_details', product_address, extractor.extract_from_s3, product_address)
 
-def upload_orders_table():
+    def clean_product_details(raw_data):
+        # Converts product weights into kg then cleans data
+        clean_weight_product_details = cleaner.clean_parallel(cleaner.convert_product_weights, raw_data,
+                                                              n_workers=clean_workers)
+        return cleaner.clean_product_data(clean_weight_product_details)
+
+    # Cleans and uploads product data if it has changed
+    load_dimension('dim_products', raw_product_details, clean_product_details)
+
+def extract_orders_table():
     '''
-    This function cleans and uploads order data to the new PostgreSQL database.
+    This function extracts and cleans the order data uploaded by upload_orders_table.
+
+    It is run as the 'orders_extract' stage, at the same time as the dimension stages, as it
+    only reads the sales_data database. The cleaned orders are kept in prepared_orders until
+    the 'orders' stage uploads them.
 
     First, this function reads the credentials of the Amazon RDS where order data is stored
-    and connects to it. Then the orders_table is extracted and cleaned. After this, the function
-    connects to the new PostgreSQL database, then cleaned order data is uploaded to the PostgreSQL
-    database under the name 'orders_table.'
+    and connects to it. Then the orders_table is extracted and cleaned.
+
+    Orders are loaded incrementally. The largest source 'index' loaded so far is kept as a
+    high-water mark in the sales_data database, and only orders past it are extracted and
+    cleaned. The whole table is extracted instead on the first run, or when full_refresh or
+    replay is set. If stream is set, a full reload is left to upload_orders_table, which
+    streams it through extracting, cleaning and uploading in chunks.
     '''
-    # Create SQLAlchemy engine from RDS credentials, get list of tables and indexes for
-    # raw orders table. Raw orders table then sent to data_cleaning.py.
+    global prepared_orders
+    # Create SQLAlchemy engine from RDS credentials, check the orders table exists and
+    # read it. Raw orders table then sent to data_cleaning.py.
     rds_creds = connection.read_db_creds(rds_db_creds)
     rds_engine = connection.init_db_engine(rds_creds)
-    table_list = connection.list_db_tables(rds_engine)
-    order_table = table_list[2]
-    raw_orders_table = extractor.read_rds_table(rds_engine, order_table)
-    clean_orders_table = cleaner.clean_orders_data(raw_orders_table)
-    # Create SQLAlchemy engine from PostgreSQL credentials, uploads clean orders table.
+    order_table = find_rds_table(rds_engine, rds_orders_table)
+    sales_db_creds = connection.read_db_creds(sales_data_creds)
+    sales_db_engine = connection.init_db_engine(sales_db_creds)
+    high_water_mark = None
+    if not (full_refresh or replay) and inspect(sales_db_engine).has_table('orders_table'):
+        high_water_mark = connection.read_watermark(sales_db_engine, 'orders_table')
+    if high_water_mark is None and stream and not replay:
+        prepared_orders = {'stream': (rds_engine, order_table)}
+        return
+    if high_water_mark is None:
+        # Only full extracts are snapshotted, so replaying always reloads the whole table
+        raw_orders_table = extract_raw_data('raw_orders_table', order_table, extractor.read_rds_table, rds_engine, order_table,
+                                            partitions=read_partitions)
+    else:
+        raw_orders_table = extractor.read_rds_table(rds_engine, order_table, after_index=high_water_mark,
+                                                    partitions=read_partitions)
+    if raw_orders_table.empty:
+        prepared_orders = {'clean_orders_table': None}
+        return
+    prepared_orders = {
+        'high_water_mark': high_water_mark,
+        'new_high_water_mark': raw_orders_table['index'].max(),
+        'clean_orders_table': cleaner.clean_parallel(cleaner.clean_orders_data, raw_orders_table, n_workers=clean_workers),
+    }
+
+def upload_orders_table():
+    '''
+    This function uploads the order data cleaned by extract_orders_table to the new PostgreSQL database.
+
+    It is run as the 'orders' stage, once the dimension tables are loaded, as their replacement
+    drops the orders table's foreign keys. If the 'orders_extract' stage didn't run (e.g. with
+    --only orders), the orders are extracted and cleaned here first. Cleaned order data is
+    uploaded to the PostgreSQL database under the name 'orders_table', appended to the orders
+    already loaded unless the whole table was extracted.
+
+    If stream is set, a full reload is streamed instead: chunks are read from the RDS, cleaned
+    and uploaded by three threads at once, with at most two chunks queued between each of them,
+    so memory use stays bounded however large the table is. Streamed loads are not snapshotted.
+    '''
+    global prepared_orders
+    if prepared_orders is None:
+        extract_orders_table()
+    orders, prepared_orders = prepared_orders, None
     sales_db_creds = connection.read_db_creds(sales_data_creds)
     sales_db_engine = connection.init_db_engine(sales_db_creds)
-    connection.upload_to_db(sales_db_engine, clean_orders_table, 'orders_table')
+    if 'stream' in orders:
+        stream_orders_table(*orders['stream'], sales_db_engine)
+        return
+    clean_orders_table = orders['clean_orders_table']
+    if clean_orders_table is None:
+        print("No new orders to upload.")
+        return
+    # Uploads clean orders table and records the new high-water mark in one transaction
+    with sales_db_engine.begin() as conn:
+        if orders['high_water_mark'] is None:
+            connection.upload_to_db(conn, clean_orders_table, 'orders_table')
+        else:
+            # Continues the index column on from the rows already in the table
+            clean_orders_table.index += conn.execute(text("SELECT COUNT(*) FROM orders_table")).scalar()
+            connection.upload_to_db(conn, clean_orders_table, 'orders_table', if_exists='append')
+        connection.write_watermark(conn, 'orders_table', orders['new_high_water_mark'])
+    print(f"{len(clean_orders_table)} orders uploaded.")
+
+def stream_orders_table(rds_engine, order_table, sales_db_engine):
+    '''
+    This function reloads the whole orders table in chunks, overlapping extracting, cleaning and uploading.
+
+    Args:
+        rds_engine: SQLAlchemy engine of the RDS the orders are read from.
+        order_table: name of the orders table in the RDS.
+        sales_db_engine: SQLAlchemy engine of the sales_data database.
+    '''
+    high_water_marks = []
+
+    def raw_orders_chunks():
+        for raw_chunk in extractor.stream_rds_table(rds_engine, order_table, chunk_size=chunk_rows):
+            high_water_marks.append(raw_chunk['index'].max())
+            yield raw_chunk
+
+    raw_chunks = prefetch(raw_orders_chunks())
+    clean_chunks = prefetch(cleaner.clean_chunks(cleaner.clean_orders_data, raw_chunks))
+    # Uploads every chunk and records the new high-water mark in one transaction
+    with sales_db_engine.begin() as conn:
+        rows_uploaded = connection.upload_chunks(conn, clean_chunks, 'orders_table')
+        if high_water_marks:
+            connection.write_watermark(conn, 'orders_table', max(high_water_marks))
+    print(f"{rows_uploaded} orders uploaded.")
 
 def upload_date_events():
     '''
     This function cleans and uploads data of when sales were made to the new PostgreSQL database.
 
     This sale date date is downloaded from the AWS S3 bucket URL and then cleaned. After cleaning,
-    the sale date events data is uploaded to the new PostgreSQL database under the name 'dim_date_times'.
-
+    the sale date events data is uploaded to the new PostgreSQL database under the name 'dim_date_times',
+    unless it is unchanged since the last run (see load_dimension).
     '''
     # Retrieves date events json file from AWS s3 bucket
-    # Raw date events file is then cleaned and uploaded to sales_data database
+    # Raw date events file is then cleaned and uploaded to sales_data database if it has changed
     date_events_address = 's3://data-handling-public/date_details.json'
-    raw_date_events = extractor.extract_from_s3(date_events_address)
-    clean_date_events = cleaner.clean_date_events(raw_date_events)
-    # Create SQLAlchemy engine from PostgreSQL credentials, uploads clean date events data.
+    raw_date_events = extract_raw_data('raw_date_events', date_events_address, extractor.extract_from_s3, date_events_address)
+    load_dimension('dim_date_times', raw_date_events, cleaner.clean_date_events)
+
+def build_summary_tables():
+    '''
+    This function prepares the sales_data database for the business queries once the data is loaded.
+
+    The foreign keys linking the orders table to the dimension tables are added (each table's
+    primary key and indexes are built when it is loaded), then the summary tables answering the
+    questions in Milestone_4_Queries.zip are brought up to date. Only the orders added since the
+    last run are aggregated into the sales summaries, unless full_refresh is set or the tables
+    they are built from have changed (see DatabaseConnector.refresh_summary_tables).
+    '''
     sales_db_creds = connection.read_db_creds(sales_data_creds)
     sales_db_engine = connection.init_db_engine(sales_db_creds)
-    connection.upload_to_db(sales_db_engine, clean_date_events, 'dim_date_times')
+    connection.create_foreign_keys(sales_db_engine)
+    refresh = connection.refresh_summary_tables(sales_db_engine, full_refresh=full_refresh)
+    if refresh['rebuilt']:
+        print(f"Summary tables rebuilt from all {refresh['orders']} orders.")
+    else:
+        print(f"{refresh['orders']} new orders added to the summary tables.")
+
+def restore_foreign_keys(results):
+    '''
+    This function adds back the foreign keys linking the orders table to the dimension tables
+    after a run which loaded a dimension table without the summaries stage, e.g. main.py --only stores.
 
-upload_user_data()
-print("User data has now been cleaned and uploaded to the PostgreSQL database.")
+    Replacing or changing a dimension table drops the foreign keys referencing it, and they are
+    otherwise only added again by build_summary_tables. Nothing is done if the orders table
+    doesn't exist (see DatabaseConnector.create_foreign_keys).
 
-upload_card_data()
-print("Card data has now been cleaned and uploaded to the PostgreSQL database.")
+    Args:
+        results: dict returned from run_stages.
 
-upload_store_data()
-print("Store data has now been cleaned and uploaded to the PostgreSQL database.")
+    Returns:
+        (status, seconds): 'done' or 'failed', and the wall time it took, or None if nothing was done.
+    '''
+    dimension_loaded = any(results.get(name, ('',))[0] == 'done' for name in DIMENSION_STAGES)
+    if not dimension_loaded or results.get('summaries', ('',))[0] == 'done':
+        return None
+    start = time.perf_counter()
+    try:
+        sales_db_creds = connection.read_db_creds(sales_data_creds)
+        sales_db_engine = connection.init_db_engine(sales_db_creds)
+        with metrics.stage('foreign_keys'):
+            connection.create_foreign_keys(sales_db_engine)
+    except Exception:
+        print("Adding back the orders table's foreign keys failed:")
+        traceback.print_exc()
+        return 'failed', time.perf_counter() - start
+    print("The orders table's foreign keys have been added back.")
+    return 'done', time.perf_counter() - start
 
-upload_product_details()
-print("Product details have now been cleaned and uploaded to the PostgreSQL database.")  
+# Pipeline stages: name -> (upload function, stages it depends on, message printed on success).
+# Orders are extracted and cleaned alongside the dimension tables, but only uploaded after them,
+# as replacing a dimension table drops the orders table's foreign keys, so appended orders are
+# never checked against the dimensions of the last run.
+STAGES = {
+    'orders_extract': (extract_orders_table, [], "Order data has now been extracted and cleaned."),
+    'users': (upload_user_data, [], "User data has now been cleaned and uploaded to the PostgreSQL database."),
+    'cards': (upload_card_data, [], "Card data has now been cleaned and uploaded to the PostgreSQL database."),
+    'stores': (upload_store_data, [], "Store data has now been cleaned and uploaded to the PostgreSQL database."),
+    'products': (upload_product_details, [], "Product details have now been cleaned and uploaded to the PostgreSQL database."),
+    'orders': (upload_orders_table, ['orders_extract', 'users', 'cards', 'stores', 'products', 'dates'],
+               "Order data has now been uploaded to the PostgreSQL database."),
+    'dates': (upload_date_events, [], "Date event date has now been cleaned and uploaded to the PostgreSQL database."),
+    'summaries': (build_summary_tables, ['users', 'cards', 'stores', 'products', 'orders', 'dates'],
+                  "Foreign keys and summary tables have now been rebuilt in the PostgreSQL database."),
+}
+# Stages which load a dimension table, dropping the orders table's foreign keys referencing it
+DIMENSION_STAGES = ['users', 'cards', 'stores', 'products', 'dates']
 
-upload_orders_table()
-print("Order data has now been cleaned and uploaded to the PostgreSQL database.")
+def run_stages(stage_names, max_workers=4):
+    '''
+    This function runs the chosen pipeline stages, overlapping stages which do not depend on each other.
+
+    Stages are submitted to a thread pool as soon as every stage they depend on has finished. A
+    dependency which was not chosen to run is treated as already satisfied. If a stage fails, any
+    stages depending on it are skipped. Once all stages are done, a table of each stage's status
+    and run time is printed. The traceback of a failed stage is printed when it fails.
+
+    Args:
+        stage_names: list of names from STAGES to run.
+        max_workers: the maximum number of stages run at the same time.
+
+    Returns:
+        results: dict of stage name to a (status, seconds) tuple.
+    '''
+    pending = list(stage_names)
+    results = {}
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name in list(pending):
+                dependencies = [dep for dep in STAGES[name][1] if dep in stage_names]
+                if any(results.get(dep, ('',))[0] in ('failed', 'skipped') for dep in dependencies):
+                    results[name] = ('skipped', 0.0)
+                    pending.remove(name)
+                elif all(dep in results for dep in dependencies):
+                    running[executor.submit(time_stage, name)] = name
+                    pending.remove(name)
+            if not running:
+                if pending:
+                    raise ValueError(f'Stages {pending} have circular dependencies.')
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+    print_stage_timings(results)
+    return results
+
+def time_stage(name):
+    '''
+    This function runs a single pipeline stage and times it.
+
+    Metrics of the calls made by the stage are labelled with its name. If the stage was chosen
+    with --profile, it is run under cProfile and the stats are saved to profile_{name}.prof.
+
+    Args:
+        name: name of the stage in STAGES.
+
+    Returns:
+        (status, seconds): 'done' or 'failed', and the wall time the stage took.
+    '''
+    upload_function, _, message = STAGES[name]
+    start = time.perf_counter()
+    try:
+        with metrics.stage(name):
+            if name == profiled_stage:
+                with metrics.profile(f'profile_{name}.prof'):
+                    upload_function()
+            else:
+                upload_function()
+    except Exception:
+        print(f"Stage '{name}' failed:")
+        traceback.print_exc()
+        return 'failed', time.perf_counter() - start
+    print(message)
+    return 'done', time.perf_counter() - start
+
+def print_stage_timings(results):
+    '''
+    This function prints a table of the status and run time of each pipeline stage.
+
+    Args:
+        results: dict returned from run_stages.
+    '''
+    print(f"\n{'stage':<14} {'status':<8} {'seconds':>8}")
+    for name, (status, seconds) in results.items():
+        print(f"{name:<14} {status:<8} {seconds:>8.2f}")
+
+def parse_args():
+    '''
+    This function parses the command line arguments used to choose which stages to run.
+    '''
+    parser = argparse.ArgumentParser(description='Extracts, cleans and uploads retail data to the sales_data database.')
+    parser.add_argument('--only', nargs='+', choices=list(STAGES), metavar='STAGE',
+                        help=f'only run these stages ({", ".join(STAGES)}).')
+    parser.add_argument('--skip', nargs='+', choices=list(STAGES), default=[], metavar='STAGE',
+                        help='run every stage except these.')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='maximum number of stages run at the same time. Use 1 to run them one after another.')
+    parser.add_argument('--replay', action='store_true',
+                        help='clean and upload the raw data snapshots saved by the last run instead of extracting it again.')
+    parser.add_argument('--lean-dtypes', action='store_true',
+                        help='store cleaned data with categorical and downcast datatypes, making cleaned tables '
+                             'smaller. Values are unchanged, and peak memory while cleaning is not reduced.')
+    parser.add_argument('--profile', choices=list(STAGES), metavar='STAGE',
+                        help='run this stage under cProfile, saving the stats to profile_STAGE.prof.')
+    parser.add_argument('--metrics-file', default='etl_metrics.jsonl',
+                        help='JSON lines file the metrics of every method call are appended to.')
+    parser.add_argument('--prometheus-file',
+                        help='if given, a Prometheus textfile of the run\'s metrics is written here.')
+    parser.add_argument('--measure-result-bytes', action='store_true',
+                        help='also record the in-memory size of every dataframe returned by a method. Off by default, '
+                             'as measuring the size of string columns reads every value.')
+    parser.add_argument('--backend', choices=['pandas', 'duckdb'], default='pandas',
+                        help='engine used to clean the orders table.')
+    parser.add_argument('--clean-workers', type=int, default=1,
+                        help='number of processes each table is cleaned with, and the card details PDF is read '
+                             'with. Use 0 for one per core.')
+    parser.add_argument('--store-workers', type=int, default=8,
+                        help='number of stores fetched from the store API at the same time. Use 1 to fetch them one at a time.')
+    parser.add_argument('--store-requests-per-second', type=float,
+                        help='maximum rate of requests sent to the store API. Unlimited by default.')
+    parser.add_argument('--store-cache-ttl', type=float,
+                        help='seconds a cached store is used without asking the store API whether it has changed. '
+                             'By default every cached store is revalidated.')
+    parser.add_argument('--read-partitions', type=int, default=1,
+                        help='number of key ranges each RDS table is read as at the same time, over separate connections.')
+    parser.add_argument('--stream', action='store_true',
+                        help='stream full loads of the orders table through extract, clean and upload in chunks.')
+    parser.add_argument('--chunk-rows', type=int, default=100000,
+                        help='number of rows in each chunk when streaming.')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='reload the whole orders table instead of only the orders added since the last run, '
+                             'and replace the dimension tables even if their raw data is unchanged.')
+    return parser.parse_args()
 
-upload_date_events()
-print("Date event date has now been cleaned and uploaded to the PostgreSQL database.")
-print("All data has now been cleaned and uploaded to the PostgreSQL database!")
\ No newline at end of file
+if __name__ == '__main__':
+    args = parse_args()
+    full_refresh = args.full_refresh
+    replay = args.replay
+    clean_workers = args.clean_workers
+    read_partitions = args.read_partitions
+    store_workers = args.store_workers
+    # The store API client is created on first use, so its options are set before any stage runs
+    extractor.store_api_options = {'requests_per_second': args.store_requests_per_second,
+                                   'cache_ttl': args.store_cache_ttl, 'pool_size': max(1, store_workers)}
+    stream = args.stream
+    chunk_rows = args.chunk_rows
+    cleaner.lean_dtypes = args.lean_dtypes
+    cleaner.backend = args.backend
+    profiled_stage = args.profile
+    metrics.jsonl_path = args.metrics_file
+    metrics.measure_result_bytes = args.measure_result_bytes
+    # The orders extracted by orders_extract are only used by the orders stage
+    skipped_stages = args.skip + (['orders_extract'] if 'orders' in args.skip else [])
+    stage_names = [name for name in (args.only or STAGES) if name not in skipped_stages]
+    results = run_stages(stage_names, max_workers=args.workers)
+    foreign_keys_result = restore_foreign_keys(results)
+    if foreign_keys_result:
+        results['foreign_keys'] = foreign_keys_result
+    s3_cache_stats = extractor.s3_cache_stats
+    if s3_cache_stats['hits'] or s3_cache_stats['misses']:
+        print(f"S3 cache: {s3_cache_stats['hits']} hits, {s3_cache_stats['misses']} misses, "
+              f"{s3_cache_stats['bytes_saved'] / 1024 ** 2:.1f} MiB of downloads saved")
+    if args.prometheus_file:
+        metrics.write_prometheus(args.prometheus_file)
+    for store_api_client in extractor.store_api_clients.values():
+        print(store_api_client.report())
+    failed_stages = [name for name, (status, _) in results.items() if status == 'failed']
+    if failed_stages:
+        sys.exit(f"Stages failed: {', '.join(failed_stages)}.")
+    if all(status == 'done' for status, _ in results.values()):
+        print("All data has now been cleaned and uploaded to the PostgreSQL database!")
@@ -0,0 +1,259 @@
+import cProfile
+import functools
+import inspect
+import json
+import os
+import pstats
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from pandas import DataFrame
+
+# Bytes downloaded or read from a source by the calling thread, added to by count_bytes_transferred
+_transferred = threading.local()
+
+
+def count_bytes_transferred(num_bytes):
+    '''
+    This function adds to the bytes transferred by the current thread's call, so that the
+    instrumented extractor method making the call records them.
+
+    Extractor paths call it with the size of each download, including 0 when a cached copy is
+    used, so a call which transferred nothing is told apart from one whose transfer isn't measured.
+
+    Args:
+        num_bytes: the number of bytes downloaded or read.
+    '''
+    _transferred.total = getattr(_transferred, 'total', 0) + num_bytes
+    _transferred.counts = getattr(_transferred, 'counts', 0) + 1
+
+
+def _read_status_kib(field):
+    '''
+    This function returns a field of /proc/self/status, such as VmHWM or VmRSS, in KiB.
+    '''
+    with open('/proc/self/status') as status_file:
+        for line in status_file:
+            if line.startswith(f'{field}:'):
+                return int(line.split()[1])
+    return None
+
+
+class MetricsRecorder:
+    '''
+    This class records metrics for every call made to the methods of the pipeline's classes.
+
+    Each call to an instrumented method of DataExtractor, DataCleaning or DatabaseConnector records
+    its wall time, CPU time, rows in and out, the bytes it downloaded or read from its source, the
+    peak memory while it ran and the process' peak memory so far. The in-memory size of the
+    dataframe it returned is also recorded when measure_result_bytes is set; it is off by default
+    because measuring the size of string columns reads every value. Records are appended to a JSON
+    lines file as they happen, and can also be written out as a Prometheus textfile at the end of a run.
+
+    The peak memory of a call is measured by resetting the kernel's resident set high-water mark
+    (VmHWM) through /proc/self/clear_refs when the call starts. Stages run in threads of the same
+    process, so it is the peak of the whole process while the call ran, including any stages
+    running at the same time. Where clear_refs can't be written it is recorded as None.
+
+    Functions:
+        instrument: wraps the public methods of an object so that their calls are recorded.
+        stage: context manager which labels the records of calls made within a pipeline stage.
+        profile: context manager which runs cProfile and saves its output.
+        write_prometheus: writes the totals of the recorded metrics in the Prometheus text format.
+    '''
+    def __init__(self, jsonl_path='etl_metrics.jsonl', measure_result_bytes=False):
+        '''
+        This function sets up an empty list of records.
+
+        Args:
+            jsonl_path: file the records are appended to as JSON lines.
+            measure_result_bytes: whether to record the deep in-memory size of each returned dataframe.
+        '''
+        self.jsonl_path = jsonl_path
+        self.measure_result_bytes = measure_result_bytes
+        self.records = []
+        self._lock = threading.Lock()
+        self._current = threading.local()
+        # Peak RSS (in KiB) seen so far by each running call, and by the whole process
+        self._call_peaks = {}
+        self._process_peak_kib = 0
+        self._peak_lock = threading.Lock()
+        self._can_reset_peak = None
+
+    def instrument(self, instance):
+        '''
+        This function replaces each public method of an object with a wrapper which records its calls.
+
+        Generator methods (e.g. DataExtractor.stream_rds_table) are left as they are, as their work
+        happens after the call has returned.
+
+        Args:
+            instance: the object to instrument, e.g. the DataExtractor used by main.py.
+
+        Returns:
+            instance: the same object, now instrumented.
+        '''
+        for name, method in inspect.getmembers(instance, inspect.ismethod):
+            if name.startswith('_') or inspect.isgeneratorfunction(method):
+                continue
+            setattr(instance, name, self._wrap(f'{type(instance).__name__}.{name}', method))
+        return instance
+
+    def _wrap(self, method_name, method):
+        '''
+        This function wraps a method so that each call to it is recorded by _record.
+        '''
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            call_id = object()
+            self._start_peak(call_id)
+            transferred_start = (getattr(_transferred, 'total', 0), getattr(_transferred, 'counts', 0))
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
+            status = 'failed'
+            result = None
+            try:
+                result = method(*args, **kwargs)
+                status = 'done'
+                return result
+            finally:
+                wall_seconds = time.perf_counter() - wall_start
+                cpu_seconds = time.thread_time() - cpu_start
+                peak_kib = self._end_peak(call_id)
+                transferred = getattr(_transferred, 'total', 0) - transferred_start[0]
+                transferred_counted = getattr(_transferred, 'counts', 0) > transferred_start[1]
+                rows_in = sum(len(arg) for arg in list(args) + list(kwargs.values()) if isinstance(arg, DataFrame))
+                measure_bytes = self.measure_result_bytes and isinstance(result, DataFrame)
+                self._record({
+                    'stage': getattr(self._current, 'stage', None),
+                    'method': method_name,
+                    'status': status,
+                    'wall_seconds': round(wall_seconds, 6),
+                    'cpu_seconds': round(cpu_seconds, 6),
+                    'rows_in': rows_in,
+                    'rows_out': len(result) if isinstance(result, DataFrame) else None,
+                    'bytes_transferred': transferred if transferred_counted else None,
+                    'result_bytes': int(result.memory_usage(deep=True).sum()) if measure_bytes else None,
+                    'peak_rss_mib': round(peak_kib / 1024, 1) if peak_kib is not None else None,
+                    'process_peak_rss_mib': round(self._process_peak_kib / 1024, 1),
+                    'timestamp': time.time(),
+                })
+        return wrapper
+
+    def _fold_peak(self):
+        '''
+        This function reads VmHWM and raises the peak of every running call, and of the process, to it.
+        It is called with _peak_lock held.
+        '''
+        hwm_kib = _read_status_kib('VmHWM')
+        if hwm_kib is None:
+            # Outside Linux, ru_maxrss is the process' high-water mark (in KiB on Linux, bytes on macOS)
+            hwm_kib = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        for peak_id, peak_kib in self._call_peaks.items():
+            self._call_peaks[peak_id] = max(peak_kib, hwm_kib)
+        self._process_peak_kib = max(self._process_peak_kib, hwm_kib)
+
+    def _start_peak(self, call_id):
+        '''
+        This function resets VmHWM to the current RSS at the start of a call, first folding the
+        old high-water mark into the peaks of the calls already running.
+        '''
+        with self._peak_lock:
+            self._fold_peak()
+            if self._can_reset_peak is not False:
+                try:
+                    with open('/proc/self/clear_refs', 'w') as clear_refs:
+                        clear_refs.write('5')
+                    self._can_reset_peak = True
+                except OSError:
+                    self._can_reset_peak = False
+            if self._can_reset_peak:
+                self._call_peaks[call_id] = _read_status_kib('VmRSS')
+
+    def _end_peak(self, call_id):
+        '''
+        This function returns the peak RSS in KiB since the call started, or None if VmHWM can't be reset.
+        '''
+        with self._peak_lock:
+            self._fold_peak()
+            return self._call_peaks.pop(call_id, None)
+
+    def _record(self, record):
+        '''
+        This function stores a record and appends it to the JSON lines file.
+        '''
+        with self._lock:
+            self.records.append(record)
+            with open(self.jsonl_path, 'a') as jsonl_file:
+                jsonl_file.write(json.dumps(record) + '\n')
+
+    @contextmanager
+    def stage(self, stage_name):
+        '''
+        This function labels every call made by the current thread with stage_name until the
+        with block exits.
+
+        Args:
+            stage_name: name of the pipeline stage being run.
+        '''
+        self._current.stage = stage_name
+        try:
+            yield
+        finally:
+            self._current.stage = None
+
+    @contextmanager
+    def profile(self, output_path, top=25):
+        '''
+        This function runs cProfile over the with block, saves the stats to output_path and
+        prints the functions with the highest cumulative time.
+
+        Args:
+            output_path: file the cProfile stats are saved to. It can be opened with pstats or snakeviz.
+            top: the number of functions printed.
+        '''
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_path)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(top)
+
+    def write_prometheus(self, textfile_path):
+        '''
+        This function writes the total wall time, CPU time, calls, rows and bytes transferred of each
+        method, the largest peak memory of a call to each method, and the process' peak memory, in
+        the Prometheus text format, for collection by node_exporter's textfile collector.
+
+        Args:
+            textfile_path: the .prom file to write.
+        '''
+        totals = {}
+        for record in self.records:
+            labels = f'stage="{record["stage"]}",method="{record["method"]}"'
+            total = totals.setdefault(labels, {'calls': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0, 'rows_out': 0,
+                                               'bytes_transferred': 0, 'peak_rss_mib': None})
+            total['calls'] += 1
+            total['wall_seconds'] += record['wall_seconds']
+            total['cpu_seconds'] += record['cpu_seconds']
+            total['rows_out'] += record['rows_out'] or 0
+            total['bytes_transferred'] += record['bytes_transferred'] or 0
+            if record['peak_rss_mib'] is not None:
+                total['peak_rss_mib'] = max(total['peak_rss_mib'] or 0, record['peak_rss_mib'])
+        lines = []
+        for metric in ['calls', 'wall_seconds', 'cpu_seconds', 'rows_out', 'bytes_transferred']:
+            lines.append(f'# TYPE etl_method_{metric}_total counter')
+            lines.extend(f'etl_method_{metric}_total{{{labels}}} {total[metric]}' for labels, total in totals.items())
+        lines.append('# TYPE etl_method_peak_rss_mib gauge')
+        lines.extend(f'etl_method_peak_rss_mib{{{labels}}} {total["peak_rss_mib"]}' for labels, total in totals.items()
+                     if total['peak_rss_mib'] is not None)
+        peak_rss = max((record['process_peak_rss_mib'] for record in self.records), default=0)
+        lines.append('# TYPE etl_process_peak_rss_mib gauge')
+        lines.append(f'etl_process_peak_rss_mib {peak_rss}')
+        # Written to a temporary file first so the collector never reads a half-written file
+        with open(f'{textfile_path}.tmp', 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.replace(f'{textfile_path}.tmp', textfile_path)
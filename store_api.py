@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    '''
+    This class limits how many requests per second are sent to an API.
+
+    Tokens are added to the bucket at a steady rate, up to a burst of one second's worth. Each
+    request takes a token, waiting until one is available if the bucket is empty.
+
+    Functions:
+        acquire: takes a token from the bucket, blocking until one is available.
+    '''
+    def __init__(self, requests_per_second):
+        '''
+        This function fills the bucket with one second's worth of tokens.
+
+        Args:
+            requests_per_second: the number of tokens added to the bucket every second.
+        '''
+        self.rate = requests_per_second
+        self.capacity = max(1.0, requests_per_second)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        This function takes a token from the bucket, sleeping until one is available.
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class StoreApiClient:
+    '''
+    This class is a client for the store details API.
+
+    All requests go through one pooled keep-alive session, with retries and exponential backoff
+    on 429 and 5xx responses, and can be limited to a requests-per-second budget. Each store's
+    JSON is cached on disk along with its ETag and Last-Modified headers. A cached store is used
+    without a request while it is younger than cache_ttl; after that it is revalidated with a
+    conditional GET, so only stores whose details have changed are downloaded again.
+
+    Functions:
+        get_number_of_stores: returns the number of stores in the business.
+        get_store: returns the details of a single store.
+        get_stores: returns the details of every store, fetched concurrently.
+        report: returns a summary of the cache hit ratio and requests saved.
+        close: closes the session's connections.
+    '''
+    def __init__(self, api_key_header, cache_dir='store_cache', cache_ttl=None, requests_per_second=None,
+                 pool_size=8, timeout=10, retries=3, backoff_factor=0.5):
+        '''
+        This function creates the session used for requests to the API.
+
+        Args:
+            api_key_header: a dictionary containing the API key, or the path of the YAML file it
+                            is stored in. It is sent as headers on every request.
+            cache_dir: directory in which each store's JSON is cached. None disables the cache.
+            cache_ttl: seconds a cached store is used without revalidating it. None always revalidates.
+            requests_per_second: the maximum rate of requests sent to the API. None is unlimited.
+            pool_size: the maximum number of connections kept open by the session.
+            timeout: seconds to wait for each request before giving up.
+            retries: how many times a request is retried after a 429 or 5xx response.
+            backoff_factor: base delay (in seconds) of the exponential backoff between retries.
+        '''
+        import requests
+        from requests.adapters import HTTPAdapter
+        from urllib3.util.retry import Retry
+        if isinstance(api_key_header, str):
+            with open(api_key_header, 'r') as api_key_header_file:
+                api_key_header = yaml.safe_load(api_key_header_file)
+        retry_policy = Retry(total=retries, backoff_factor=backoff_factor,
+                             status_forcelist=[429, 500, 502, 503, 504],
+                             allowed_methods=['GET', 'HEAD'], raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry_policy)
+        self.session = requests.Session()
+        self.session.headers.update(api_key_header)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.cache_dir = os.path.abspath(cache_dir) if cache_dir else None
+        self.cache_ttl = cache_ttl
+        self.rate_limiter = TokenBucket(requests_per_second) if requests_per_second else None
+        self.stats = {'requests': 0, 'fresh_hits': 0, 'revalidated': 0, 'downloaded': 0, 'bytes_downloaded': 0}
+        self._stats_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        '''
+        This function closes the session's connections.
+        '''
+        self.session.close()
+
+    def _get(self, endpoint, headers=None):
+        '''
+        This function sends a GET request through the session once the rate limit allows it.
+        '''
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        self._count('requests')
+        response = self.session.get(endpoint, headers=headers, timeout=self.timeout)
+        self._count('bytes_downloaded', len(response.content))
+        return response
+
+    def _count(self, stat, amount=1):
+        with self._stats_lock:
+            self.stats[stat] += amount
+
+    def get_number_of_stores(self, num_stores_endpoint):
+        '''
+        This function returns the number of stores in the business.
+
+        Args:
+            num_stores_endpoint: a link to the API which returns the number of stores.
+
+        Returns:
+            num_stores: the number of stores in the business.
+        '''
+        response = self._get(num_stores_endpoint)
+        response.raise_for_status()
+        return response.json()['number_stores']
+
+    def get_store(self, retrieve_store_endpoint):
+        '''
+        This function returns the details of a single store, using the cache where possible.
+
+        If the cached copy is younger than cache_ttl it is returned without a request. Otherwise
+        a conditional GET is sent with the cached ETag and Last-Modified values; a 304 response
+        means the cached copy is still current. Any other successful response replaces the cache.
+
+        Args:
+            retrieve_store_endpoint: the store details endpoint of the store.
+
+        Returns:
+            store: a dict of the store's details.
+        '''
+        cache_path = None
+        cached = None
+        if self.cache_dir:
+            cache_path = os.path.join(self.cache_dir, hashlib.sha256(retrieve_store_endpoint.encode()).hexdigest() + '.json')
+            if os.path.exists(cache_path):
+                with open(cache_path, 'r') as cache_file:
+                    cached = json.load(cache_file)
+        if cached and self.cache_ttl is not None and time.time() - cached['fetched_at'] < self.cache_ttl:
+            self._count('fresh_hits')
+            return cached['store']
+        validators = {}
+        if cached and cached.get('etag'):
+            validators['If-None-Match'] = cached['etag']
+        if cached and cached.get('last_modified'):
+            validators['If-Modified-Since'] = cached['last_modified']
+        response = self._get(retrieve_store_endpoint, headers=validators)
+        if response.status_code == 304 and cached:
+            self._count('revalidated')
+            store = cached['store']
+        else:
+            response.raise_for_status()
+            self._count('downloaded')
+            store = response.json()
+        if cache_path:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            cached = {'store': store, 'fetched_at': time.time(),
+                      'etag': response.headers.get('ETag') or (cached or {}).get('etag'),
+                      'last_modified': response.headers.get('Last-Modified') or (cached or {}).get('last_modified')}
+            # Written to a temporary file first so a concurrent reader never sees half a file
+            temp_path = f'{cache_path}.{threading.get_ident()}.part'
+            with open(temp_path, 'w') as cache_file:
+                json.dump(cached, cache_file)
+            os.replace(temp_path, cache_path)
+        return store
+
+    def get_stores(self, retrieve_store_endpoint_base, num_stores, max_workers=1):
+        '''
+        This function returns the details of every store in the business.
+
+        Args:
+            retrieve_store_endpoint_base: partial endpoint url, to which each store's number is added.
+            num_stores: the number of stores returned from get_number_of_stores.
+            max_workers: the number of stores fetched at the same time.
+
+        Returns:
+            stores: a list of dicts of each store's details, in store order.
+        '''
+        endpoints = [retrieve_store_endpoint_base + str(store) for store in range(num_stores)]
+        if max_workers > 1:
+            # executor.map yields results in submission order, keeping stores sorted
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                return list(executor.map(self.get_store, endpoints))
+        return [self.get_store(endpoint) for endpoint in endpoints]
+
+    def report(self):
+        '''
+        This function summarises how many store lookups were served from the cache.
+
+        Returns:
+            summary: a one-line description of the cache hit ratio and requests saved.
+        '''
+        lookups = self.stats['fresh_hits'] + self.stats['revalidated'] + self.stats['downloaded']
+        hits = self.stats['fresh_hits'] + self.stats['revalidated']
+        hit_ratio = hits / lookups if lookups else 0
+        return (f"Store API: {lookups} stores, {hit_ratio:.0%} cache hit ratio, "
+                f"{self.stats['fresh_hits']} requests and {hits} downloads saved")
@@ -0,0 +1,77 @@
+import queue
+import threading
+
+
+class _ProducerError:
+    '''
+    This class carries an exception raised while producing chunks across to the consuming thread.
+    '''
+    def __init__(self, error):
+        self.error = error
+
+
+def prefetch(chunks, max_queued=2):
+    '''
+    This function produces the chunks of an iterable in a background thread, so that producing
+    the next chunk overlaps with whatever is done with the current one.
+
+    Chunks are passed through a bounded queue. Once max_queued chunks are waiting, the producing
+    thread blocks until one is taken, so a fast producer can't run ahead of a slow consumer and
+    fill up memory (backpressure). Chaining prefetch calls gives a pipeline where each stage runs
+    in its own thread, e.g. extracting, cleaning and uploading a table at the same time:
+
+        raw_chunks = prefetch(extractor.stream_rds_table(rds_engine, 'orders_table'))
+        clean_chunks = prefetch(cleaner.clean_chunks(cleaner.clean_orders_data, raw_chunks))
+        connection.upload_chunks(sales_db_engine, clean_chunks, 'orders_table')
+
+    An exception raised while producing a chunk is raised again where the chunk would have been
+    yielded. If the consumer stops early, the producing thread stops and closes the iterable.
+
+    Args:
+        chunks: an iterable of chunks, e.g. a generator of pandas dataframes.
+        max_queued: the maximum number of chunks produced ahead of the consumer.
+
+    Yields:
+        chunk: each chunk of the iterable, in order.
+    '''
+    chunk_queue = queue.Queue(maxsize=max_queued)
+    finished = object()
+    stopped = threading.Event()
+
+    def put(item):
+        # Waits for space in the queue, giving up if the consumer has stopped
+        while not stopped.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for chunk in chunks:
+                if not put(chunk):
+                    return
+            put(finished)
+        except BaseException as error:
+            put(_ProducerError(error))
+        finally:
+            # Generators are closed here, in the thread running them, e.g. to release a connection
+            close = getattr(chunks, 'close', None)
+            if close:
+                close()
+
+    producer = threading.Thread(target=produce, name='prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = chunk_queue.get()
+            if item is finished:
+                return
+            if isinstance(item, _ProducerError):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        producer.join()
@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+
+from benchmarks import make_orders_table
+from data_cleaning import DataCleaning
+
+pytest.importorskip('duckdb')
+
+
+@pytest.fixture(scope='module')
+def orders_corpus(tmp_path_factory):
+    '''
+    A small orders table shared by both backends, as a dataframe and as a Parquet file.
+    '''
+    raw_orders_table = make_orders_table(1_000)
+    parquet_path = tmp_path_factory.mktemp('orders') / 'orders_table.parquet'
+    raw_orders_table.to_parquet(parquet_path)
+    return raw_orders_table, str(parquet_path)
+
+
+@pytest.mark.parametrize('input_kind', ['dataframe', 'parquet'])
+def test_duckdb_backend_matches_pandas(orders_corpus, input_kind):
+    raw_orders_table, parquet_path = orders_corpus
+    expected = DataCleaning(backend='pandas').clean_orders_data(raw_orders_table.copy())
+    raw_input = raw_orders_table.copy() if input_kind == 'dataframe' else parquet_path
+    pd.testing.assert_frame_equal(DataCleaning(backend='duckdb').clean_orders_data(raw_input), expected)
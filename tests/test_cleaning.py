@@ -0,0 +1,73 @@
+import os
+
+import pandas as pd
+
+from benchmarks import (legacy_clean_card_data, legacy_clean_date_events, legacy_clean_store_data,
+                        legacy_convert_product_weights, make_card_data, make_date_events, make_store_data)
+from cleaning_rules import CleaningRules
+from data_cleaning import DataCleaning
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def test_convert_product_weights_matches_original_on_products_csv():
+    '''
+    Every weight format in the products.csv sample, including multipacks, stray characters,
+    unknown units and nulls, converts exactly as the original row-by-row conversion did.
+    '''
+    products = pd.read_csv(os.path.join(FIXTURES, 'products.csv'), index_col=0)
+    pd.testing.assert_frame_equal(DataCleaning().convert_product_weights(products.copy()),
+                                  legacy_convert_product_weights(products.copy()), check_exact=True)
+
+
+def test_clean_store_data_matches_original_apart_from_coordinates():
+    raw_store_data = make_store_data(500)
+    coordinates = ['longitude', 'latitude']
+    clean_store_data = DataCleaning().clean_store_data(raw_store_data.copy())
+    pd.testing.assert_frame_equal(clean_store_data.drop(columns=coordinates),
+                                  legacy_clean_store_data(raw_store_data.copy()).drop(columns=coordinates))
+
+
+def test_clean_store_data_keeps_coordinate_signs_and_decimals():
+    raw_store_data = make_store_data(3)
+    raw_store_data['continent'] = ['Europe', 'eeAmerica', 'Europe']
+    raw_store_data['longitude'] = ['-0.12752', '53.4810236', 'N/A']
+    raw_store_data['latitude'] = ['51.62907', '-2.13576891', '1e']
+    clean_store_data = DataCleaning().clean_store_data(raw_store_data)
+    assert clean_store_data['longitude'].tolist()[:2] == [-0.12752, 53.4810236]
+    assert clean_store_data['latitude'].tolist()[:2] == [51.62907, -2.13576891]
+    assert clean_store_data['longitude'].isna().tolist()[2]
+
+
+def test_clean_card_data_rules_match_original():
+    raw_card_data = make_card_data(2_000)
+    cleaner = DataCleaning()
+    pd.testing.assert_frame_equal(cleaner.clean_card_data(raw_card_data.copy()),
+                                  legacy_clean_card_data(raw_card_data.copy()), check_dtype=False)
+    assert len(cleaner.quarantine['dim_card_details']) == len(raw_card_data) - len(legacy_clean_card_data(raw_card_data.copy()))
+
+
+def test_clean_date_events_rules_match_original():
+    raw_date_events = make_date_events(2_000)
+    pd.testing.assert_frame_equal(DataCleaning().clean_date_events(raw_date_events.copy()),
+                                  legacy_clean_date_events(raw_date_events.copy()), check_dtype=False)
+
+
+def test_lean_dtypes_keep_values():
+    raw_store_data = make_store_data(3)
+    raw_store_data['continent'] = 'Europe'
+    raw_store_data['longitude'] = ['53.4810236', '-2.13576891', '0.5']
+    full = DataCleaning().clean_store_data(raw_store_data.copy())
+    lean = DataCleaning(lean_dtypes=True).clean_store_data(raw_store_data.copy())
+    pd.testing.assert_frame_equal(lean, full, check_dtype=False, check_categorical=False, check_exact=True)
+
+
+
+def test_rejection_counts_are_per_rule():
+    raw_data = pd.DataFrame({'provider': ['VISA', 'NULL', 'NULL'], 'code': ['A', 'A', 'B']})
+    rules = CleaningRules({'provider': {'allowed': ['VISA']}, 'code': {'allowed': ['A']}})
+    clean_data, rejected_data, rejection_counts = rules.apply(raw_data)
+    assert len(clean_data) == 1 and len(rejected_data) == 2
+    # The last row fails both rules, so it is counted by each
+    assert rejection_counts == {'provider.allowed': 2, 'code.allowed': 1}
+    assert rejected_data['rejected_by'].tolist() == ['provider.allowed', 'provider.allowed, code.allowed']
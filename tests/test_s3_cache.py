@@ -0,0 +1,48 @@
+import io
+
+import boto3
+import pandas as pd
+import pytest
+from botocore.response import StreamingBody
+from botocore.stub import Stubber
+
+from data_extraction import DataExtractor
+
+BUCKET, KEY = 'test-bucket', 'date_details.json'
+VERSIONS = {'"v1"': pd.DataFrame({'month': ['1', '2']}).to_json().encode(),
+            '"v2"': pd.DataFrame({'month': ['3', '4', '5']}).to_json().encode()}
+
+
+@pytest.fixture
+def stubbed_s3():
+    s3_client = boto3.client('s3', region_name='eu-west-1', aws_access_key_id='test', aws_secret_access_key='test')
+    with Stubber(s3_client) as stubber:
+        yield s3_client, stubber
+        stubber.assert_no_pending_responses()
+
+
+def expect_head(stubber, etag):
+    stubber.add_response('head_object', {'ETag': etag, 'ContentLength': len(VERSIONS[etag])},
+                         {'Bucket': BUCKET, 'Key': KEY})
+
+
+def expect_download(stubber, etag):
+    # download_file asks for the object's size and then gets its body
+    expect_head(stubber, etag)
+    stubber.add_response('get_object', {'ETag': etag, 'ContentLength': len(VERSIONS[etag]),
+                                        'Body': StreamingBody(io.BytesIO(VERSIONS[etag]), len(VERSIONS[etag]))})
+
+
+def test_s3_cache_hit_skips_download_and_new_etag_downloads_again(stubbed_s3, tmp_path):
+    s3_client, stubber = stubbed_s3
+    extractor = DataExtractor(s3_cache_dir=str(tmp_path), s3_client=s3_client)
+    # Every request has to be queued, so an unexpected download fails the test
+    for etag, downloads in [('"v1"', True), ('"v1"', False), ('"v2"', True)]:
+        expect_head(stubber, etag)
+        if downloads:
+            expect_download(stubber, etag)
+        raw_data = extractor.extract_from_s3(f's3://{BUCKET}/{KEY}')
+        stubber.assert_no_pending_responses()
+        pd.testing.assert_frame_equal(raw_data, pd.read_json(io.BytesIO(VERSIONS[etag])))
+    assert extractor.s3_cache_stats['hits'] == 1
+    assert extractor.s3_cache_stats['misses'] == 2